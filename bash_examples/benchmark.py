@@ -0,0 +1,57 @@
+import pandas as pd
+from omegaconf import DictConfig, OmegaConf,ListConfig
+import os
+import hydra
+from inference import load_ts
+from dsipts import beauty_string
+import traceback
+
+VERBOSE = True
+
+
+
+@hydra.main(version_base=None)
+def benchmark(conf:DictConfig)-> None:
+    """Inference throughput (samples/s) of all the models specified, for each execution engine (eager, torch.compile, TorchScript)
+
+    Args:
+        conf (DictConfig): the same config used in `compare.py` plus the (optional) keys `engines`, `warmup` and `n_batches`. See the examples in the repo
+    """
+    if not os.path.exists(os.path.join(conf.dirpath,'csv')):
+        os.makedirs(os.path.join(conf.dirpath,'csv'))
+
+    if isinstance( conf.models,list) or isinstance( conf.models,ListConfig):
+        files =  conf.models
+    else:
+        ff = os.path.join(conf.models,'config_used')
+        files = [os.path.join(ff,f) for f in os.listdir(ff)]
+
+    res = []
+    for conf_tmp in files:
+        beauty_string(f'Processing file: {conf_tmp}','block',VERBOSE)
+        conf_tmp =  OmegaConf.load(conf_tmp)
+        try:
+            ts = load_ts(conf_tmp)
+            if ts is None or ts.stacked:
+                continue
+            tmp = ts.benchmark_inference(batch_size = conf.get('batch_size',conf_tmp.inference.batch_size),
+                                         num_workers = conf_tmp.inference.num_workers,
+                                         set = conf.set,
+                                         engines = list(conf.get('engines',['eager','compile','script'])),
+                                         warmup = conf.get('warmup',2),
+                                         n_batches = conf.get('n_batches',None))
+            tmp['model'] = f'{conf_tmp.model.type}_{conf_tmp.ts.name}_{conf_tmp.ts.version}'
+            res.append(tmp)
+        except Exception as _:
+            beauty_string(f'#######can not benchmark model {conf_tmp.model.type}_{conf_tmp.ts.name}_{conf_tmp.ts.version} {traceback.format_exc()}','',True)
+
+    if len(res)==0:
+        beauty_string('No model benchmarked','block',True)
+        return
+    res = pd.concat(res,ignore_index=True)
+    beauty_string(res,'',VERBOSE)
+    res.to_csv(os.path.join(conf.dirpath,'csv',f'{conf.name}_benchmark.csv'),index=False)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,90 @@
+import argparse
+import time
+import torch
+import numpy as np
+import pandas as pd
+from torch.utils.data import DataLoader
+from dsipts import TimeSeries, Categorical, Diffusion, beauty_string
+from dsipts.data_structure.utils import collate_batch
+
+
+def get_data(length:int=3000,past_steps:int=64,future_steps:int=16,batch_size:int=64)->tuple:
+    """Synthetic time series with a weekly (multiplicative) and a monthly (additive) categorical variable
+
+    :meta private:
+    """
+    settimana = Categorical('settimanale',1,[1,1,1,1,1,1,1],7,'multiplicative',[0.9,0.8,0.7,0.6,0.5,0.99,0.99])
+    mese = Categorical('mensile',1,[31,28,20,10,33],5,'additive',[10,20,-10,20,0])
+    ts = TimeSeries('diffusion_benchmark')
+    ts.set_verbose(False)
+    ts.generate_signal(length=length,categorical_variables=[settimana,mese],noise_mean=1,type=0)
+    train,_,test = ts.split_for_train(perc_train=0.7,perc_valid=0.1,past_steps=past_steps,future_steps=future_steps)
+    train_dl = DataLoader(train,batch_size=batch_size,shuffle=True,drop_last=True,collate_fn=collate_batch)
+    test_dl = DataLoader(test,batch_size=256,shuffle=False,drop_last=False,collate_fn=collate_batch)
+    return train_dl,test_dl,[len(ts.dataset[c].unique()) for c in ts.cat_var]
+
+
+def benchmark_diffusion(steps:list,diffusion_steps:int=20,epochs:int=30,past_steps:int=64,future_steps:int=16,subnet:int=1,learn_var:bool=False,seed:int=0)->pd.DataFrame:
+    """Accuracy and latency of the Diffusion inference using all the diffusion steps (standard reverse process) or a strided subset of them
+
+    Args:
+        steps (list): numbers of inference steps to test (the full reverse process is always included)
+        diffusion_steps (int, optional): number of diffusion steps (subnets). Defaults to 20.
+        epochs (int, optional): training epochs. Defaults to 30.
+        past_steps (int, optional): past steps. Defaults to 64.
+        future_steps (int, optional): future steps. Defaults to 16.
+        subnet (int, optional): subnet type. Defaults to 1.
+        learn_var (bool, optional): learn the posterior variance. Defaults to False.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: MAE on the test set and milliseconds per batch for each number of inference steps
+    """
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    train_dl,test_dl,embs = get_data(past_steps=past_steps,future_steps=future_steps)
+    model = Diffusion(d_model=32,out_channels=1,past_steps=past_steps,future_steps=future_steps,past_channels=1,future_channels=0,embs=embs,
+                      learn_var=learn_var,cosine_alpha=True,diffusion_steps=diffusion_steps,beta=0.03,gamma=0.01,
+                      n_layers_RNN=1,d_head=16,n_head=2,dropout_rate=0.1,activation='torch.nn.GELU',subnet=subnet,perc_subnet_learning_for_step=0.2,
+                      optim_config={'lr':1e-3},verbose=False)
+    optimizer = model.configure_optimizers()
+    model.train()
+    for epoch in range(epochs):
+        for batch in train_dl:
+            loss = model(batch)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        beauty_string(f'epoch {epoch} loss {loss.item():.4f}','',True)
+
+    model.eval()
+    res = []
+    ##None is the standard reverse process
+    for n in [None]+sorted(steps,reverse=True):
+        model.inference_steps = n
+        torch.manual_seed(seed)
+        errors = []
+        times = []
+        with torch.no_grad():
+            for batch in test_dl:
+                t0 = time.perf_counter()
+                out = model.inference(batch)
+                times.append(time.perf_counter()-t0)
+                errors.append((out[:,:,:,0]-batch['y']).abs().flatten())
+        res.append({'sampler':'standard' if n is None else 'strided','steps':diffusion_steps if n is None else n,
+                    'mae':torch.cat(errors).mean().item(),'ms_per_batch':1000*np.mean(times)})
+        beauty_string(res[-1],'',True)
+    return pd.DataFrame(res)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Accuracy vs number of steps of the Diffusion inference")
+    parser.add_argument("-s", "--steps", type=int, nargs='+', default=[20,10,5,2], help="inference steps")
+    parser.add_argument("-t", "--diffusion_steps", type=int, default=20, help="diffusion steps of the model")
+    parser.add_argument("-e", "--epochs", type=int, default=30, help="training epochs")
+    parser.add_argument("-v", "--learn_var", action='store_true', help="learn the posterior variance")
+    parser.add_argument("-o", "--output", type=str, default='diffusion_benchmark.csv', help="output file")
+    args = parser.parse_args()
+    res = benchmark_diffusion(args.steps,args.diffusion_steps,args.epochs,learn_var=args.learn_var)
+    beauty_string(res,'',True)
+    res.to_csv(args.output,index=False)
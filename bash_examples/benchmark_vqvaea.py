@@ -0,0 +1,59 @@
+import argparse
+import time
+import torch
+import pandas as pd
+from omegaconf import OmegaConf
+from dsipts import VQVAEA, beauty_string
+
+
+def benchmark_vqvaea(past_steps:list,jitters:list,batch_size:int=64,hidden_channels:int=32,d_model:int=32,repeat:int=5)->pd.DataFrame:
+    """Time of a training step (forward, backward and optimizer step) of the VQ-VAE part of VQVAEA
+
+    Args:
+        past_steps (list): lengths of the input sequences (the future steps are half of them)
+        jitters (list): jitter probabilities
+        batch_size (int, optional): batch size. Defaults to 64.
+        hidden_channels (int, optional): hidden channels of the VQ-VAE. Defaults to 32.
+        d_model (int, optional): dimension of the latent vectors. Defaults to 32.
+        repeat (int, optional): number of timed steps (the best one is reported). Defaults to 5.
+
+    Returns:
+        pd.DataFrame: milliseconds for each length and jitter probability
+    """
+    ##some modules of the package enable the anomaly detection when imported, it is not part of the measure
+    torch.autograd.set_detect_anomaly(False)
+    res = []
+    for length in past_steps:
+        batch = {'x_num_past':torch.randn(batch_size,length,1),
+                 'y':torch.randn(batch_size,length//2,1),
+                 'idx_target':torch.zeros(batch_size,1,dtype=torch.long)}
+        for jitter in jitters:
+            model = VQVAEA(past_steps=length,future_steps=length//2,past_channels=1,future_channels=0,hidden_channels=hidden_channels,embs=[],
+                           d_model=d_model,max_voc_size=64,num_layers=2,dropout_rate=0.1,commitment_cost=0.25,decay=0.99,n_heads=4,out_channels=1,
+                           epoch_vqvae=1,jitter=jitter,optim_config=OmegaConf.create({'lr_vqvae':1e-3,'weight_decay_vqvae':0.0,'lr_gpt':1e-3,'weight_decay_gpt':0.0}),verbose=False)
+            model.train()
+            optimizer = model.configure_optimizers()
+            times = []
+            for i in range(repeat+1):
+                t0 = time.perf_counter()
+                _, loss = model(batch)
+                loss.backward()
+                optimizer.step()
+                optimizer.zero_grad()
+                if i>0:
+                    times.append(time.perf_counter()-t0)
+            res.append({'past_steps':length,'jitter':jitter,'ms':1000*min(times)})
+            beauty_string(res[-1],'',True)
+    return pd.DataFrame(res)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the VQVAEA training step")
+    parser.add_argument("-l", "--lengths", type=int, nargs='+', default=[64,256,1024], help="past steps")
+    parser.add_argument("-j", "--jitters", type=float, nargs='+', default=[0.0,0.12], help="jitter probabilities")
+    parser.add_argument("-b", "--batch_size", type=int, default=64, help="batch size")
+    parser.add_argument("-o", "--output", type=str, default='vqvaea_benchmark.csv', help="output file")
+    args = parser.parse_args()
+    res = benchmark_vqvaea(args.lengths,args.jitters,args.batch_size)
+    beauty_string(res.pivot_table(index='jitter',columns='past_steps',values='ms'),'',True)
+    res.to_csv(args.output,index=False)
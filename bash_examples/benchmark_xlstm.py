@@ -0,0 +1,63 @@
+import argparse
+import time
+import torch
+import pandas as pd
+from dsipts.models.xlstm.xLSTM import xLSTM
+from dsipts import beauty_string
+
+## implementations of the recurrences: attribute to set in the sLSTM/mLSTM modules
+IMPLEMENTATIONS = {'slstm':{'script':('use_script',True),'eager':('use_script',False)},
+                   'mlstm':{'chunkwise':('chunk_size',16),'recurrent':('chunk_size',1)}}
+
+
+def benchmark_xlstm(lengths:list,batch_size:int=32,hidden_size:int=32,num_layers:int=2,num_blocks:int=2,repeat:int=3)->pd.DataFrame:
+    """Time of the forward (inference) and of the forward+backward (training) pass of the xLSTM encoder for different sequence lengths
+
+    Args:
+        lengths (list): sequence lengths
+        batch_size (int, optional): batch size. Defaults to 32.
+        hidden_size (int, optional): hidden size. Defaults to 32.
+        num_layers (int, optional): layers of each block. Defaults to 2.
+        num_blocks (int, optional): number of blocks. Defaults to 2.
+        repeat (int, optional): number of timed runs (the best one is reported). Defaults to 3.
+
+    Returns:
+        pd.DataFrame: milliseconds for each lstm type, implementation, length and mode
+    """
+    ##some modules of the package enable the anomaly detection when imported, it is not part of the measure
+    torch.autograd.set_detect_anomaly(False)
+    res = []
+    for lstm_type,implementations in IMPLEMENTATIONS.items():
+        model = xLSTM(hidden_size,hidden_size,num_layers,num_blocks,lstm_type=lstm_type)
+        for implementation,(attribute,value) in implementations.items():
+            for block in model.blocks:
+                setattr(block.lstm,attribute,value)
+            for length in lengths:
+                x = torch.randn(batch_size,length,hidden_size)
+                for mode in ['inference','train']:
+                    times = []
+                    for i in range(repeat+1):
+                        t0 = time.perf_counter()
+                        if mode=='inference':
+                            with torch.no_grad():
+                                model(x)
+                        else:
+                            model(x)[0].sum().backward()
+                        ##the first run compiles the scripted functions
+                        if i>0:
+                            times.append(time.perf_counter()-t0)
+                    res.append({'lstm_type':lstm_type,'implementation':implementation,'length':length,'mode':mode,'ms':1000*min(times)})
+                    beauty_string(res[-1],'',True)
+    return pd.DataFrame(res)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the xLSTM recurrences")
+    parser.add_argument("-l", "--lengths", type=int, nargs='+', default=[64,128,256,512,1024], help="sequence lengths")
+    parser.add_argument("-b", "--batch_size", type=int, default=32, help="batch size")
+    parser.add_argument("-s", "--hidden_size", type=int, default=32, help="hidden size")
+    parser.add_argument("-o", "--output", type=str, default='xlstm_benchmark.csv', help="output file")
+    args = parser.parse_args()
+    res = benchmark_xlstm(args.lengths,args.batch_size,args.hidden_size)
+    beauty_string(res.pivot_table(index=['lstm_type','implementation','mode'],columns='length',values='ms'),'',True)
+    res.to_csv(args.output,index=False)
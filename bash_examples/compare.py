@@ -50,6 +50,7 @@ def compare(conf:DictConfig)-> None:
         conf_tmp.inference.set = conf.set
         conf_tmp.inference.rescaling = conf.rescaling
         conf_tmp.inference.batch_size = conf.get('batch_size',conf_tmp.inference.batch_size)
+        conf_tmp.inference.stream = conf.get('stream',False)
 
         beauty_string(f'PROCESSING {conf_tmp.model.type}_{conf_tmp.ts.name}_{conf_tmp.ts.version}','section',VERBOSE)
 
@@ -57,7 +58,8 @@ def compare(conf:DictConfig)-> None:
             tmp,predictions, losses = inference(conf_tmp)
             if tmp is not None:
                 tmp['model'] = f'{conf_tmp.model.type}_{conf_tmp.ts.name}_{conf_tmp.ts.version}'
-                predictions['model'] = f'{conf_tmp.model.type}_{conf_tmp.ts.name}_{conf_tmp.ts.version}'
+                if predictions is not None:
+                    predictions['model'] = f'{conf_tmp.model.type}_{conf_tmp.ts.name}_{conf_tmp.ts.version}'
                 if losses is not None:
                     losses['epoch'] = list(range(losses.shape[0]))
                     losses = losses.melt(id_vars='epoch')
@@ -69,7 +71,8 @@ def compare(conf:DictConfig)-> None:
                 losses.value = np.log(losses.value)
                 res.append(tmp )
                 tot_losses.append(losses)
-                tot_predictions.append(predictions)
+                if predictions is not None:
+                    tot_predictions.append(predictions)
             else:
                 beauty_string(f'Can not load model {conf_tmp.model.type}_{conf_tmp.ts.name}_{conf_tmp.ts.version} check function inference and load_model','',True)
 
@@ -80,7 +83,8 @@ def compare(conf:DictConfig)-> None:
             pass
 
     tot_losses = pd.concat(tot_losses,ignore_index=True)
-    tot_predictions = pd.concat(tot_predictions,ignore_index=True)
+    if len(tot_predictions)>0:
+        tot_predictions = pd.concat(tot_predictions,ignore_index=True)
 
     res = pd.concat(res,ignore_index=True)
     res.MAPE = np.round(res.MAPE/100,4)
@@ -127,7 +131,10 @@ def compare(conf:DictConfig)-> None:
     '''
     tot_losses.to_csv(os.path.join(conf.dirpath,'csv',f'{conf.name}_{conf.set}_LOSSES.csv'))
     res.to_csv(os.path.join(conf.dirpath,'csv',f'{conf.name}_{conf.set}_errors.csv'))
-    tot_predictions.to_csv(os.path.join(conf.dirpath,'csv',f'{conf.name}_{conf.set}_tot_predictions.csv'))
+    if len(tot_predictions)>0:
+        tot_predictions.to_csv(os.path.join(conf.dirpath,'csv',f'{conf.name}_{conf.set}_tot_predictions.csv'))
+    else:
+        beauty_string('Streaming mode: the predictions of each model are in the predictions folder of the inference output path','info',VERBOSE)
 
 
 
@@ -2,9 +2,10 @@
 import argparse
 import pandas as pd
 from omegaconf import DictConfig, OmegaConf
-from dsipts import TimeSeries, beauty_string, extend_time_df
+from dsipts import TimeSeries, beauty_string, extend_time_df, write_chunks
+import numpy as np
 import os
-from typing import List
+from typing import List, Union
 from datetime import timedelta 
 from utils import mse, mape, load_model
 VERBOSE = True
@@ -55,20 +56,62 @@ def inference_stacked(conf:DictConfig,ts:TimeSeries)->List[pd.DataFrame]:
     return res
 
 
-def inference(conf:DictConfig)->List[pd.DataFrame]:
-    """Make inference on a selected set starting from a configuration file
+def inference_stream(conf:DictConfig,ts:TimeSeries)->pd.DataFrame:
+    """Streaming inference: the predictions are written chunk by chunk in `output_path/predictions` (format given by `conf.inference.format`, csv or parquet) 
+    and the errors are accumulated lag by lag, so that the memory does not depend on the size of the set
 
     Args:
-        conf (DictConfig): inference configuration, usually the one generated by the train with all the paths and parameters. See the examples in the repo
+        conf (DictConfig): inference configuration
+        ts (TimeSeries): timeseries with the loaded model
 
     Returns:
-        List[pd.DataFrame]:  3 dataframes:
-            errors : containing the errors
-            res : containing the predictions
-            losses : containing the losses during the train
+        pd.DataFrame: the errors (same of `inference`)
     """
+    feat = '_median' if ts.model.use_quantiles else '_pred'
+    stats = {}
+    def chunks():
+        for chunk in ts.iterate_inference_on_set(batch_size = conf.inference.batch_size,
+                                                 num_workers = conf.inference.num_workers,
+                                                 set = conf.inference.set,
+                                                 rescaling =conf.inference.rescaling,
+                                                 engine = conf.inference.get('engine','eager')):
+            for c in ts.target_variables:
+                x = chunk[f'{c}{feat}'].values.astype(float)
+                y = chunk[c].values.astype(float)
+                ok = ~np.isnan(x*y)
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    ape = 100*np.abs((x-y)/y)
+                ok_ape = ok & np.isfinite(ape)
+                tmp = pd.DataFrame({'lag':chunk.lag.values,
+                                    'se':np.where(ok,(x-y)**2,0),'n':ok,
+                                    'ape':np.where(ok_ape,ape,0),'n_ape':ok_ape}).groupby('lag').sum()
+                stats[c] = tmp if c not in stats else stats[c].add(tmp,fill_value=0)
+            yield chunk
+
+    if not os.path.exists(os.path.join(conf.inference.output_path,'predictions')):
+        os.makedirs(os.path.join(conf.inference.output_path,'predictions'))
+    filename = os.path.join(conf.inference.output_path,'predictions',f'{conf.model.type}_{ts.name}_{conf.ts.version}_{conf.inference.set}.{conf.inference.get("format","csv")}')
+    n = write_chunks(chunks(),filename)
+    beauty_string(f'{n} predictions written in {filename}','info',VERBOSE)
+
+    errors = []
+    for c in ts.target_variables:
+        tmp = stats[c]
+        errors.append(pd.DataFrame({'lag':tmp.index.values,'MSE':(tmp.se/tmp.n).values,'MAPE':(tmp.ape/tmp.n_ape).values,'variable':c})[['lag','MSE','variable','MAPE']])
+    errors = pd.concat(errors,ignore_index=True)
+    beauty_string(errors,'',VERBOSE)
+    return errors
+
+
+def load_ts(conf:DictConfig)->Union[TimeSeries,None]:
+    """Load the timeseries and the trained model
 
+    Args:
+        conf (DictConfig): inference configuration, see `inference`
 
+    Returns:
+        Union[TimeSeries,None]: the timeseries with the model or None if the model can not be loaded
+    """
     if conf.dataset.dataset == 'incube': 
         from load_data.load_data_incube import load_data
     elif conf.dataset.dataset == 'pollen': 
@@ -85,17 +128,54 @@ def inference(conf:DictConfig)->List[pd.DataFrame]:
     loaded = load_model(ts,conf)
     if loaded:
         beauty_string('Model successfully loaded','block',VERBOSE)
-    else:
-        beauty_string('Model NOT loaded','block',True)
+        return ts
+    beauty_string('Model NOT loaded','block',True)
+    return None
+
+
+def inference(conf:DictConfig)->List[pd.DataFrame]:
+    """Make inference on a selected set starting from a configuration file
+
+    Args:
+        conf (DictConfig): inference configuration, usually the one generated by the train with all the paths and parameters. See the examples in the repo
+
+    Returns:
+        List[pd.DataFrame]:  3 dataframes:
+            errors : containing the errors
+            res : containing the predictions (None if `conf.inference.stream` is True, the predictions are written in `output_path/predictions`)
+            losses : containing the losses during the train
+    """
+
+    ts = load_ts(conf)
+    if ts is None:
         return None, None, None
 
+    if not os.path.exists(os.path.join(conf.inference.output_path,'csv')):
+        os.makedirs(os.path.join(conf.inference.output_path,'csv'))
+    filename = os.path.join(conf.inference.output_path,'csv',f'{conf.model.type}_{ts.name}_{conf.ts.version}_{conf.inference.set}.csv')
+
+    if conf.inference.get('stream',False) and not ts.stacked:
+        ##the predictions are written in a file chunk by chunk and the errors are accumulated
+        errors = inference_stream(conf,ts)
+        errors.to_csv(filename,index=False)
+        return errors, None, ts.losses
+
     if ts.stacked:
         res = inference_stacked(conf,ts)
+    elif conf.inference.get('processes',None) is not None:
+        ##CPU inference with a process for each shard of the set
+        res = ts.parallel_inference_on_set(batch_size = conf.inference.batch_size,
+                                n_processes = conf.inference.processes,
+                                shard_by = conf.inference.get('shard_by','group'),
+                                set = conf.inference.set,
+                                rescaling =conf.inference.rescaling,
+                                engine = conf.inference.get('engine','eager'))
     else:
         res = ts.inference_on_set(batch_size = conf.inference.batch_size,
                                 num_workers = conf.inference.num_workers,
                                 set = conf.inference.set,
-                                rescaling =conf.inference.rescaling)
+                                rescaling =conf.inference.rescaling,
+                                engine = conf.inference.get('engine','eager'))
 
     errors = []
     feat = '_median' if ts.model.use_quantiles else '_pred'
@@ -110,10 +190,6 @@ def inference(conf:DictConfig)->List[pd.DataFrame]:
     errors = pd.concat(errors,ignore_index=True)
     beauty_string(errors,'',VERBOSE)
 
-    if not os.path.exists(os.path.join(conf.inference.output_path,'csv')):
-        os.makedirs(os.path.join(conf.inference.output_path,'csv'))
-    filename = os.path.join(conf.inference.output_path,'csv',f'{conf.model.type}_{ts.name}_{conf.ts.version}_{conf.inference.set}.csv')
-
     errors.to_csv(filename,index=False)
     return errors,res, ts.losses
 
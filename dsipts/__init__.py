@@ -1,10 +1,12 @@
 from .data_management.monash import Monash,get_freq
 from .data_structure.data_structure import TimeSeries,Categorical
-from .data_structure.utils import extend_time_df
+from .data_structure.online import OnlinePredictor
+from .data_structure.utils import extend_time_df, write_chunks
 from .models.RNN import RNN
 from .models.LinearTS import LinearTS
 from .data_management.public_datasets import read_public_dataset
 from .models.base import Base
+from .models.losses import register_loss, CustomLoss
 from .models.Persistent import Persistent
 from .models.D3VAE import D3VAE
 from .models.DilatedConv import DilatedConv
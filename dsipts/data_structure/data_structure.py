@@ -1,7 +1,7 @@
 import numpy as np
 import plotly.express as px
 import pandas as pd
-from typing import List
+from typing import List, Iterable, Iterator
 from sklearn.preprocessing import LabelEncoder
 from sklearn.preprocessing import * 
 from torch.utils.data import DataLoader
@@ -12,12 +12,15 @@ from typing import Union
 import os
 import torch
 import pickle
-from .utils import extend_time_df,MetricsCallback, MyDataset, ActionEnum,beauty_string
+import hashlib
+from .utils import extend_time_df,iterate_chunks,GroupScaler,GroupLabelEncoder,MetricsCallback, MyDataset, MyLazyDataset, MyMemmapDataset, ActionEnum,beauty_string,get_valid_starts,gather_windows,collate_batch,shard_indices,get_cache_key,save_datasets,load_datasets
 from datetime import datetime
 from ..models.base import Base
 from ..models.utils import weight_init_zeros,weight_init
+from ..models.inference import InferenceEngine, benchmark_inference, parallel_inference
 import logging 
 from .modifiers import *
+from .online import OnlinePredictor
 from aim.pytorch_lightning import AimLogger
 import time
 
@@ -254,14 +257,7 @@ class TimeSeries():
             else:
                 differences = dataset[dataset[group]==dataset[group].unique()[0]].time.diff()[1:]
                 
-     
-            if isinstance(dataset.time[0], datetime):
-                freq = pd.to_timedelta(differences.min())   
-            else:
-                if int(dataset.time[0])==dataset.time[0]: ##ONLY THINK THAT WORKS IN GENERAL
-                    freq = int(differences.min())
-                else:
-                    raise TypeError("time must be integer or datetime")
+            freq = self._detect_freq(dataset.time[0],differences)
             self.freq = freq 
             
             
@@ -276,6 +272,55 @@ class TimeSeries():
                 self.freq = pd.to_timedelta(self.freq)   
             
                 
+        self._set_variables(dataset,enrich_cat,past_variables,future_variables,target_variables,cat_var,check_past,group,silly_model)
+
+    def _get_group_scalers(self)->tuple:
+        """Scalers used when `normalize_per_group` is True. For the timeseries saved with the previous versions (one sklearn scaler per column and group) they are built on the fly
+
+        Returns:
+            tuple: GroupScaler and GroupLabelEncoder
+
+        :meta private:
+        """
+        if '_GROUP_' in self.scaler_num:
+            return self.scaler_num['_GROUP_'],self.scaler_cat['_GROUP_']
+        groups = self.scaler_cat[self.group].classes_
+        return GroupScaler.from_scalers(self.scaler_num,self.num_var,groups),GroupLabelEncoder.from_encoders(self.scaler_cat,[c for c in self.cat_var if c!=self.group],groups)
+
+    def _detect_freq(self,first_time:Union[datetime,int],differences:pd.Series)->Union[pd.Timedelta,int]:
+        """Frequency of the series as minimum of the time differences
+
+        Args:
+            first_time (Union[datetime,int]): a time value, used for checking the type of the temporal column
+            differences (pd.Series): time differences of a single series
+
+        Returns:
+            Union[pd.Timedelta,int]: the frequency
+
+        :meta private:
+        """
+        if isinstance(first_time, datetime):
+            freq = pd.to_timedelta(differences.min())   
+        else:
+            if int(first_time)==first_time: ##ONLY THINK THAT WORKS IN GENERAL
+                freq = int(differences.min())
+            else:
+                raise TypeError("time must be integer or datetime")
+        return freq
+
+    def _set_variables(self,dataset:pd.DataFrame,
+                       enrich_cat:List[str],
+                       past_variables:List[str],
+                       future_variables:List[str],
+                       target_variables:List[str],
+                       cat_var:List[str],
+                       check_past:bool,
+                       group:Union[None,str],
+                       silly_model:bool)->None:
+        """Set the dataset and the variables, see `load_signal` for the arguments
+
+        :meta private:
+        """
         assert len(target_variables)>0, 'Provide at least one column for target'
         assert 'time'  in dataset.columns, 'The temporal column must be called time'
         if set(target_variables).intersection(set(past_variables))!= set(target_variables): 
@@ -310,6 +355,67 @@ class TimeSeries():
             beauty_string('YOU ARE TRAINING A SILLY MODEL WITH THE TARGETS IN THE INPUTS','section',self.verbose) 
             self.future_variables+=self.target_variables
             
+
+    def load_signal_chunks(self,chunks:Union[str,List[str],Iterable[pd.DataFrame]],
+                           enrich_cat:List[str] = [],
+                           past_variables:List[str]=[],
+                           future_variables:List[str]=[],
+                           target_variables:List[str]=[],
+                           cat_var:List[str]=[],
+                           check_past:bool=True,
+                           group:Union[None,str]=None,
+                           silly_model:bool=False)->None:
+        """ Streaming version of `load_signal` for very long inputs or inputs splitted in several files (by time and/or by group).
+            The chunks are deduplicated and splitted by group while they are read, then each group is sorted, deduplicated and its holes are filled.
+            The final dataset is built column by column releasing the groups, in this way the peak memory is close to a single copy of the data (plus the temporary copies of one group). Differently from `load_signal` the holes are checked for each group independently.
+
+        Args:
+            chunks (Union[str,List[str],Iterable[pd.DataFrame]]): a CSV/Parquet file, a list of CSV/Parquet files or an iterable of dataframes (e.g. `pd.read_csv(..., chunksize=...)`). The column indicating the time must be called `time`
+            enrich_cat (List[str], optional): see `load_signal`. Defaults to [].
+            past_variables (List[str], optional): see `load_signal`. Defaults to [].
+            future_variables (List[str], optional): see `load_signal`. Defaults to [].
+            target_variables (List[str], optional): see `load_signal`. Defaults to [].
+            cat_var (List[str], optional): see `load_signal`. Defaults to [].
+            check_past (bool, optional): see `load_signal`. Defaults to True.
+            group (str or None, optional): see `load_signal`. Defaults to None
+            silly_model (bool, optional): see `load_signal`. Defaults to False.
+        """
+        beauty_string('Loading the signal by chunks','block',self.verbose)
+        pieces = {}
+        for chunk in iterate_chunks(chunks):
+            chunk = chunk.drop_duplicates(subset=['time'] if group is None else [group,'time'],  keep='first')
+            if group is None:
+                pieces.setdefault(None,[]).append(chunk)
+            else:
+                for g, tmp in chunk.groupby(group,sort=False):
+                    pieces.setdefault(g,[]).append(tmp)
+            del chunk
+
+        freq = None
+        tot = []
+        for g in list(pieces.keys()):
+            tmp = pd.concat(pieces.pop(g),ignore_index=True)
+            tmp.sort_values(by='time',kind='stable',inplace=True)
+            tmp.drop_duplicates(subset=['time'],  keep='first', inplace=True, ignore_index=True)
+            differences = tmp.time.diff()[1:]
+            if freq is None:
+                freq = self._detect_freq(tmp.time[0],differences)
+                beauty_string(f'Detected minumum frequency: {freq}','section',self.verbose)
+            if differences.nunique()>1:
+                beauty_string(f"There are holes in the group {g} i will try to extend the dataframe inserting NAN",'info',self.verbose)
+                tmp = extend_time_df(tmp,freq,group).merge(tmp,how='left')
+            ##the groups are stored by column so that they can be released while the dataset is built
+            tot.append({c:tmp[c].copy() for c in tmp.columns})
+            del tmp
+        ##one column at a time: the peak memory is a single copy of the data plus one column
+        dataset = {}
+        for c in list(tot[0].keys()):
+            dataset[c] = pd.concat([columns.pop(c) for columns in tot],ignore_index=True)
+        del tot
+        dataset = pd.DataFrame(dataset,copy=False)
+        self.freq = freq
+        self._set_variables(dataset,enrich_cat,past_variables,future_variables,target_variables,cat_var,check_past,group,silly_model)
+
     def plot(self):
         """  
         Easy way to control the loaded data
@@ -335,8 +441,9 @@ class TimeSeries():
                            shift:int=0,
                            keep_entire_seq_while_shifting:bool=False,
                            starting_point:Union[None,dict]=None,
-                           skip_step:int=1
-                         
+                           skip_step:int=1,
+                           lazy:bool=False,
+                           memmap_dir:Union[str,None]=None
                            )->MyDataset:
         """ Create the dataset for the training/inference step
 
@@ -348,6 +455,8 @@ class TimeSeries():
             keep_entire_seq_while_shifting (bool, optional): if the dataset is shifted, you may want the future data be of length future_step+shift (like informer), default false
             starting_point (Union[None,dict], optional): a dictionary indicating if a sample must be considered. It is checked for the first lag in the future (useful in the case your model has to predict only starting from hour 12). Defaults to None.
             skip_step (int, optional): list of the categortial variables (same for past and future). Usual there is a skip of one between two saples but for debugging  or training time purposes you can skip some samples. Defaults to 1.
+            lazy (bool, optional): if True the samples are not materialized, a `MyLazyDataset` is returned and the windows are sliced when requested. Useful for long past_steps. Defaults to False.
+            memmap_dir (Union[str,None], optional): if not None the dataset is lazy and the normalized series are written in this folder and memory mapped (see `MyMemmapDataset`). Useful for datasets larger than the RAM. Defaults to None.
         Returns:
             MyDataset: class thath extends torch.utils.data.Dataset (see utils)
                 keys of a batch:
@@ -360,14 +469,6 @@ class TimeSeries():
         """
         beauty_string('Creating data loader','block',self.verbose)
         
-        x_num_past_samples = []
-        x_num_future_samples = []
-        x_cat_past_samples = []
-        x_cat_future_samples = []
-        y_samples = []
-        t_samples = []
-        g_samples = []
-        
         if starting_point is not None:
             kk = list(starting_point.keys())[0]
             assert kk not in self.cat_var, beauty_string('CAN NOT USE FEATURE {kk} as starting point it may have a different value due to the normalization step, please add a second column with a suitable name','info',True)
@@ -383,21 +484,13 @@ class TimeSeries():
             
             
         if self.normalize_per_group:
-            tot = []
-            groups = data[self.group].unique()
-            
+            scaler_num, scaler_cat = self._get_group_scalers()
             data[self.group] = self.scaler_cat[self.group].transform(data[self.group].values.ravel()).flatten()
-            
-            for group in groups:
-                tmp = data[data['_GROUP_']==group].copy()
-                
-                for c in self.num_var:
-                    tmp[c] = self.scaler_num[f'{c}_{group}'].transform(tmp[c].values.reshape(-1,1)).flatten()
-                for c in self.cat_var:      
-                    if c!=self.group:                         
-                        tmp[c] = self.scaler_cat[f'{c}_{group}'].transform(tmp[c].values.ravel()).flatten()
-                tot.append(tmp)
-            data = pd.concat(tot,ignore_index=True)
+            codes = data[self.group].values
+            if len(scaler_num.columns)>0:
+                data[scaler_num.columns] = scaler_num.transform(data[scaler_num.columns].values,codes)
+            if len(scaler_cat.columns)>0:
+                data[scaler_cat.columns] = scaler_cat.transform(data[scaler_cat.columns].values,codes)
         else:
             for c in self.cat_var:
                 data[c] = self.scaler_cat[c].transform(data[c].values.ravel()).flatten()
@@ -421,78 +514,75 @@ class TimeSeries():
             skip_stacked = future_steps*future_steps-future_steps
         else:
             skip_stacked = 0
-        for group in data['_GROUP_'].unique():
-            tmp = data[data['_GROUP_']==group]
-            groups = tmp['_GROUP_'].values  
-            t = tmp.time.values 
-            x_num_past = tmp[self.past_variables].values
-            if len(self.future_variables)>0:
-                x_num_future = tmp[self.future_variables].values
-            if len(self.cat_var)>0:
-                x_cat = tmp[self.cat_var].values
-            y_target = tmp[self.target_variables].values
 
-        
-            if starting_point is not None:
-                check = tmp[list(starting_point.keys())[0]].values == starting_point[list(starting_point.keys())[0]]
-            else:
-                check = [True]*len(y_target)
-            
-            for i in range(past_steps,tmp.shape[0]-future_steps-skip_stacked,skip_step):
-                if check[i]:
-
-                    if len(self.future_variables)>0:
-                        if keep_entire_seq_while_shifting:
-                            xx = x_num_future[i-shift+skip_stacked:i+future_steps+skip_stacked].mean()
-                        else:
-                            xx = x_num_future[i-shift+skip_stacked:i+future_steps-shift+skip_stacked].mean()
-                    else:
-                        xx = 0.0
-                    if np.isfinite(x_num_past[i-past_steps:i].min() + y_target[i+skip_stacked:i+future_steps+skip_stacked].min() + xx):
-                        
-                        x_num_past_samples.append(x_num_past[i-past_steps:i])
-                        if len(self.future_variables)>0:
-                            if keep_entire_seq_while_shifting:
-                                x_num_future_samples.append(x_num_future[i-shift+skip_stacked:i+future_steps+skip_stacked])
-                            else:
-                                x_num_future_samples.append(x_num_future[i-shift+skip_stacked:i+future_steps-shift+skip_stacked])
-                        if len(self.cat_var)>0:
-                            x_cat_past_samples.append(x_cat[i-past_steps:i])
-                            if keep_entire_seq_while_shifting:
-                                x_cat_future_samples.append(x_cat[i-shift+skip_stacked:i+future_steps+skip_stacked])
-                            else:
-                                x_cat_future_samples.append(x_cat[i-shift+skip_stacked:i+future_steps-shift+skip_stacked])
-                        y_samples.append(y_target[i+skip_stacked:i+future_steps+skip_stacked])
-                        t_samples.append(t[i+skip_stacked:i+future_steps+skip_stacked])
-                        g_samples.append(groups[i])
-
-    
-        
-        if len(self.future_variables)>0:
-            try:
-                x_num_future_samples = np.stack(x_num_future_samples)
-            except Exception as e:
-                beauty_string('WARNING x_num_future_samples is empty and it should not','info',True)
-        y_samples = np.stack(y_samples)
-        t_samples = np.stack(t_samples)   
-        g_samples = np.stack(g_samples)
+        ## rows of the same group are placed contiguously so that the windows can be gathered all at once
+        positions = data.groupby('_GROUP_',sort=False).indices
+        rows = np.concatenate([positions[group] for group in data['_GROUP_'].unique()])
+        ##same type of the original implementation (numpy array of the group labels, e.g. <U for strings, not object)
+        groups = np.array(data['_GROUP_'].values[rows].tolist())
+        t = data.time.values[rows]
+        x_num_past = data[self.past_variables].values[rows]
+        x_num_future = data[self.future_variables].values[rows] if len(self.future_variables)>0 else None
+        x_cat = data[self.cat_var].values[rows] if len(self.cat_var)>0 else None
+        y_target = data[self.target_variables].values[rows]
+        if starting_point is not None:
+            check = data[list(starting_point.keys())[0]].values[rows] == starting_point[list(starting_point.keys())[0]]
+        else:
+            check = None
 
-        if len(self.cat_var)>0:
-            x_cat_past_samples = np.stack(x_cat_past_samples)
-            x_cat_future_samples = np.stack(x_cat_future_samples)
-        x_num_past_samples = np.stack(x_num_past_samples)
+        starts = []
+        offset = 0
+        for group in data['_GROUP_'].unique():
+            n = len(positions[group])
+            sl = slice(offset,offset+n)
+            starts.append(offset+get_valid_starts(x_num_past[sl],
+                                                  y_target[sl],
+                                                  x_num_future[sl] if x_num_future is not None else None,
+                                                  check[sl] if check is not None else None,
+                                                  past_steps,
+                                                  future_steps,
+                                                  shift,
+                                                  keep_entire_seq_while_shifting,
+                                                  skip_stacked,
+                                                  skip_step))
+            offset+=n
+        starts = np.concatenate(starts)
+        if len(starts)==0:
+            beauty_string('WARNING there are no valid samples in this dataset','info',True)
+
+        future_length = future_steps+shift if keep_entire_seq_while_shifting else future_steps
         if self.stacked:
             mod = 0
         else:
             mod = 1.0
-        dd = {'y':y_samples.astype(np.float32),
-
-              'x_num_past':(x_num_past_samples*mod).astype(np.float32)}
+        if lazy or memmap_dir is not None:
+            series = {'y':y_target.astype(np.float32),
+                      'x_num_past':(x_num_past*mod).astype(np.float32)}
+            windows = {'y':('y',skip_stacked,future_steps),
+                       'x_num_past':('x_num_past',-past_steps,past_steps)}
+            if len(self.cat_var)>0:
+                series['x_cat'] = x_cat
+                windows['x_cat_past'] = ('x_cat',-past_steps,past_steps)
+                windows['x_cat_future'] = ('x_cat',-shift+skip_stacked,future_length)
+            if len(self.future_variables)>0:
+                series['x_num_future'] = x_num_future.astype(np.float32)
+                windows['x_num_future'] = ('x_num_future',-shift+skip_stacked,future_length)
+            if memmap_dir is not None:
+                return MyMemmapDataset(memmap_dir,series,windows,t,groups,starts,idx_target,idx_target_future)
+            return MyLazyDataset(series,windows,t,groups,starts,idx_target,idx_target_future)
+
+        y_samples = gather_windows(y_target,starts+skip_stacked,future_steps,np.float32)
+        t_samples = gather_windows(t,starts+skip_stacked,future_steps)
+        g_samples = groups[starts]
+        x_num_past_samples = gather_windows(x_num_past,starts-past_steps,past_steps,np.float32)
+        x_num_past_samples*=mod
+        dd = {'y':y_samples,
+              'x_num_past':x_num_past_samples}
         if len(self.cat_var)>0:
-            dd['x_cat_past'] = x_cat_past_samples
-            dd['x_cat_future'] = x_cat_future_samples
+            dd['x_cat_past'] = gather_windows(x_cat,starts-past_steps,past_steps)
+            dd['x_cat_future'] = gather_windows(x_cat,starts-shift+skip_stacked,future_length)
         if len(self.future_variables)>0:
-            dd['x_num_future'] = x_num_future_samples.astype(np.float32)
+            dd['x_num_future'] = gather_windows(x_num_future,starts-shift+skip_stacked,future_length,np.float32)
         
         return MyDataset(dd,t_samples,g_samples,idx_target,idx_target_future)
     
@@ -512,7 +602,10 @@ class TimeSeries():
                         skip_step:int=1,
                         normalize_per_group: bool=False,
                         check_consecutive: bool=True,
-                        scaler: str='StandardScaler()' 
+                        scaler: str='StandardScaler()',
+                        lazy: bool=False,
+                        memmap_dir: Union[str,None]=None,
+                        cache_dir: Union[str,None]=None
                         )->List[DataLoader]:
         """Split the data and create the datasets.
 
@@ -532,6 +625,10 @@ class TimeSeries():
             normalize_per_group (boolean, optional): if true and self.group is not None, the variables are scaled respect to the groups. Default False
             check_consecutive (boolean, optional): if false it skips the check on the consecutive ranges. Default True
             scaler: instance of a sklearn.preprocessing scaler. Default 'StandardScaler()'
+            lazy (boolean, optional): see `create_data_loader`. Default False
+            memmap_dir (str or None, optional): see `create_data_loader`. Default None
+            cache_dir (str or None, optional): if not None the datasets and the fitted scalers are saved in this folder, using a key computed on the data and on the parameters. 
+            The next call with the same data and parameters will load them (memory mapped) skipping the whole procedure. Default None
         Returns:
             List[DataLoader,DataLoader,DataLoadtrainer]: three dataloader used for training or inference
         """
@@ -545,6 +642,24 @@ class TimeSeries():
             beauty_string('Empty dataset','info', True)
             return None, None, None
         
+        if cache_dir is not None:
+            params = dict(perc_train=perc_train,perc_valid=perc_valid,range_train=range_train,range_validation=range_validation,range_test=range_test,
+                          past_steps=past_steps,future_steps=future_steps,shift=shift,keep_entire_seq_while_shifting=keep_entire_seq_while_shifting,
+                          starting_point=starting_point,skip_step=skip_step,normalize_per_group=normalize_per_group,scaler=scaler,lazy=lazy,memmap_dir=memmap_dir,
+                          past_variables=self.past_variables,future_variables=self.future_variables,target_variables=self.target_variables,
+                          cat_var=self.cat_var,group=self.group,stacked=self.stacked,
+                          scalers=hashlib.sha1(pickle.dumps((self.scaler_cat,self.scaler_num))).hexdigest() if self.is_trained else None)
+            cache_path = os.path.join(cache_dir,get_cache_key(self.dataset,params))
+            cached = load_datasets(cache_path)
+            if cached is not None:
+                beauty_string(f'Loading datasets from cache {cache_path}','section',self.verbose)
+                datasets,meta = cached
+                if not self.is_trained:
+                    self.scaler_cat = meta['scaler_cat']
+                    self.scaler_num = meta['scaler_num']
+                    self.normalize_per_group = meta['normalize_per_group']
+                return datasets['train'],datasets['validation'],datasets['test']
+
         if range_train is None:
             if self.group is None:
                 beauty_string(f'Split temporally using perc_train: {perc_train} and perc_valid:{perc_valid}','section',self.verbose)
@@ -598,23 +713,21 @@ class TimeSeries():
                 self.normalize_per_group = True
                 self.scaler_cat[self.group] =  LabelEncoder()
                 self.scaler_cat[self.group].fit(train[self.group].values.ravel())  
-                for group in train[self.group].unique():
-                    tmp = train[train[self.group]==group]
-
-                    for c in self.num_var:
-                        self.scaler_num[f'{c}_{group}'] =  eval(scaler)
-                        self.scaler_num[f'{c}_{group}'].fit(tmp[c].values.reshape(-1,1))
-                    for c in self.cat_var:
-                        if c!=self.group:                               
-                            self.scaler_cat[f'{c}_{group}'] =  LabelEncoder()
-                            self.scaler_cat[f'{c}_{group}'].fit(tmp[c].values.ravel())  
+                codes = self.scaler_cat[self.group].transform(train[self.group].values.ravel())
+                self.scaler_num['_GROUP_'] = GroupScaler(scaler).fit(train[self.num_var].values,codes,self.num_var)
+                cat_var = [c for c in self.cat_var if c!=self.group]
+                self.scaler_cat['_GROUP_'] = GroupLabelEncoder().fit(train[cat_var].values,codes,cat_var)
         
-        dl_train = self.create_data_loader(train,past_steps,future_steps,shift,keep_entire_seq_while_shifting,starting_point,skip_step)
-        dl_validation = self.create_data_loader(validation,past_steps,future_steps,shift,keep_entire_seq_while_shifting,starting_point,skip_step)
+        dl_train = self.create_data_loader(train,past_steps,future_steps,shift,keep_entire_seq_while_shifting,starting_point,skip_step,lazy,memmap_dir)
+        dl_validation = self.create_data_loader(validation,past_steps,future_steps,shift,keep_entire_seq_while_shifting,starting_point,skip_step,lazy,memmap_dir)
         if test.shape[0]>0:
-            dl_test = self.create_data_loader(test,past_steps,future_steps,shift,keep_entire_seq_while_shifting,starting_point,skip_step)
+            dl_test = self.create_data_loader(test,past_steps,future_steps,shift,keep_entire_seq_while_shifting,starting_point,skip_step,lazy,memmap_dir)
         else:
             dl_test = None
+        if cache_dir is not None:
+            beauty_string(f'Saving datasets in cache {cache_path}','section',self.verbose)
+            save_datasets(cache_path,{'train':dl_train,'validation':dl_validation,'test':dl_test},
+                          {'scaler_cat':self.scaler_cat,'scaler_num':self.scaler_num,'normalize_per_group':self.normalize_per_group})
         return dl_train,dl_validation,dl_test
             
     def set_model(self,model:Base,config:dict=None,custom_init:bool=False):
@@ -699,8 +812,8 @@ class TimeSeries():
             self.modifier = modifier
         else:
             self.modifier = None
-        train_dl = DataLoader(train, batch_size = batch_size , shuffle=True,drop_last=True,num_workers=num_workers,persistent_workers=persistent_workers)
-        valid_dl = DataLoader(validation, batch_size = batch_size , shuffle=False,drop_last=True,num_workers=num_workers,persistent_workers=persistent_workers)
+        train_dl = DataLoader(train, batch_size = batch_size , shuffle=True,drop_last=True,num_workers=num_workers,persistent_workers=persistent_workers,collate_fn=collate_batch)
+        valid_dl = DataLoader(validation, batch_size = batch_size , shuffle=False,drop_last=True,num_workers=num_workers,persistent_workers=persistent_workers,collate_fn=collate_batch)
    
         checkpoint_callback = ModelCheckpoint(dirpath=dirpath,
                                      monitor='val_loss',
@@ -813,7 +926,10 @@ class TimeSeries():
                          num_workers:int=4,
                          split_params:Union[None,dict]=None,set:str='test',
                          rescaling:bool=True,
-                         data:Union[None,torch.utils.data.Dataset]=None)->pd.DataFrame:
+                         data:Union[None,torch.utils.data.Dataset]=None,
+                         as_arrays:bool=False,
+                         engine:str='eager',
+                         num_samples:Union[int,None]=None)->Union[pd.DataFrame,dict]:
         """This function allows to get the prediction on a particular set (train, test or validation). 
 
         Args:
@@ -823,12 +939,173 @@ class TimeSeries():
             set (str, optional): trai, validation or test. Defaults to 'test'.
             rescaling (bool, optional):  If rescaling is true the output will be rescaled to the initial values. . Defaults to True.
             data (None or pd.DataFrame, optional). If not None the inference is performed on the given data. In the case of custom data please call inference because it will normalize the data for you!
+            as_arrays (bool, optional): if True the pandas step is skipped and a dictionary with the arrays `y_pred` (BxLxCxQ), `y` (BxLxC), `time` (BxL) and `groups` (B) is returned. Defaults to False.
+            engine (str, optional): `eager`, `compile` (torch.compile) or `script` (TorchScript), see `InferenceEngine`. The model is always executed in inference mode. Defaults to 'eager'.
+            num_samples (Union[int,None], optional): for the stochastic models (e.g. Diffusion, D3VAE), if not None the prediction is given by the quantiles 0.1, 0.5 and 0.9 of `num_samples` Monte Carlo samples computed in a single batched pass (the columns are `_low`, `_median` and `_high`). Defaults to None.
         Returns:
-            pd.DataFrame: the predicted values in a pandas format
+            Union[pd.DataFrame,dict]: the predicted values in a pandas format (or the arrays, see `as_arrays`)
         """
         
         beauty_string('Inference on a set (train, validation o test)','block',self.verbose)
      
+        dl = self._get_inference_loader(batch_size,num_workers,split_params,set,data)
+        runner = InferenceEngine(self.model,engine=engine,num_samples=num_samples,verbose=self.verbose)
+        beauty_string(f'Device used: {self.model.device}','info',self.verbose)
+        
+        res = []
+        real = []
+        for batch in dl:
+            res.append(runner(batch).detach().cpu().numpy())
+            real.append(batch['y'].numpy())
+       
+        res = np.vstack(res)
+ 
+        real = np.vstack(real)
+        return self._postprocess(res,real,dl.dataset.t,dl.dataset.groups,rescaling,as_arrays,self.model.use_quantiles or num_samples is not None)
+
+    def parallel_inference_on_set(self,batch_size:int=100,
+                                  n_processes:Union[int,None]=None,
+                                  num_threads:Union[int,None]=None,
+                                  shard_by:str='group',
+                                  split_params:Union[None,dict]=None,set:str='test',
+                                  rescaling:bool=True,
+                                  data:Union[None,torch.utils.data.Dataset]=None,
+                                  as_arrays:bool=False,
+                                  engine:str='eager')->Union[pd.DataFrame,dict]:
+        """Same of `inference_on_set` but on CPU using several processes: the samples are split in shards (by group or by time) and each shard is predicted by a different process.
+        The weights of the model are placed in shared memory and the torch threads are divided among the processes. The output is the same of `inference_on_set`.
+
+        Args:
+            batch_size (int, optional): batch size of each process. Defaults to 100.
+            n_processes (Union[int,None], optional): number of processes, if None the number of cores. Defaults to None.
+            num_threads (Union[int,None], optional): torch threads of each process, if None the cores are divided among the processes. Defaults to None.
+            shard_by (str, optional): `group` (each group is predicted by a single process) or `time` (contiguous time ranges of the same size, better balanced). Defaults to 'group'.
+            split_params (Union[None,dict], optional): see `inference_on_set`. Defaults to None.
+            set (str, optional): see `inference_on_set`. Defaults to 'test'.
+            rescaling (bool, optional): see `inference_on_set`. Defaults to True.
+            data (None or pd.DataFrame, optional): see `inference_on_set`. Defaults to None.
+            as_arrays (bool, optional): see `inference_on_set`. Defaults to False.
+            engine (str, optional): see `inference_on_set`. Defaults to 'eager'.
+
+        Returns:
+            Union[pd.DataFrame,dict]: the predicted values in a pandas format (or the arrays, see `as_arrays`)
+        """
+        beauty_string('Parallel inference on a set (train, validation o test)','block',self.verbose)
+        dataset = self._get_inference_dataset(split_params,set,data)
+        if n_processes is None:
+            n_processes = os.cpu_count() or 1
+        shards = shard_indices(dataset,n_processes,shard_by)
+        beauty_string(f'{len(shards)} processes, shards of size {[len(x) for x in shards]}','info',self.verbose)
+        res,real = parallel_inference(self.model,dataset,shards,batch_size=batch_size,num_threads=num_threads,engine=engine)
+        return self._postprocess(res,real,dataset.t,dataset.groups,rescaling,as_arrays,self.model.use_quantiles)
+
+    def _postprocess(self,res:np.array,real:np.array,time:np.array,groups:np.array,rescaling:bool,as_arrays:bool,quantiles:bool)->Union[pd.DataFrame,dict]:
+        """Inverse of the modifier, rescaling and long format of the output of the model, see `inference_on_set`
+
+        :meta private:
+        """
+        if self.modifier is not None:
+            res,real = self.modifier.inverse_transform(res,real)
+
+        if rescaling:
+            beauty_string('Scaling back','info',self.verbose)
+            res,real = self._rescale(res,real,groups)
+        if as_arrays:
+            return {'y_pred':res,'y':real,'time':time,'groups':groups}
+        return self._to_long(res,real,time,groups,quantiles)
+
+    def iterate_inference_on_set(self,batch_size:int=100,
+                                 num_workers:int=4,
+                                 split_params:Union[None,dict]=None,set:str='test',
+                                 rescaling:bool=True,
+                                 data:Union[None,torch.utils.data.Dataset]=None,
+                                 as_arrays:bool=False,
+                                 engine:str='eager',
+                                 num_samples:Union[int,None]=None)->Iterator[Union[pd.DataFrame,dict]]:
+        """Streaming version of `inference_on_set`: the predictions are rescaled and yielded one batch at time, in this way the memory does not depend on the size of the set.
+        The chunks can be written incrementally in a file using `write_chunks`.
+
+        Args:
+            batch_size (int, optional): batch size, it is also the number of samples of each chunk. Defaults to 100.
+            num_workers (int, optional): see `inference_on_set`. Defaults to 4.
+            split_params (Union[None,dict], optional): see `inference_on_set`. Defaults to None.
+            set (str, optional): see `inference_on_set`. Defaults to 'test'.
+            rescaling (bool, optional): see `inference_on_set`. Defaults to True.
+            data (None or pd.DataFrame, optional): see `inference_on_set`. Defaults to None.
+            as_arrays (bool, optional): see `inference_on_set`. Defaults to False.
+            engine (str, optional): see `inference_on_set`. Defaults to 'eager'.
+            num_samples (Union[int,None], optional): see `inference_on_set`. Defaults to None.
+
+        Yields:
+            Union[pd.DataFrame,dict]: the predictions of a batch in the same format of `inference_on_set`
+        """
+        beauty_string('Streaming inference on a set (train, validation o test)','block',self.verbose)
+        dl = self._get_inference_loader(batch_size,num_workers,split_params,set,data)
+        runner = InferenceEngine(self.model,engine=engine,num_samples=num_samples,verbose=self.verbose)
+        beauty_string(f'Device used: {self.model.device}','info',self.verbose)
+        
+        offset = 0
+        for batch in dl:
+            res = runner(batch).detach().cpu().numpy()
+            real = batch['y'].numpy()
+            idx = slice(offset,offset+res.shape[0])
+            offset+=res.shape[0]
+            time = dl.dataset.get_t(idx)
+            groups = dl.dataset.groups[idx]
+            if self.modifier is not None:
+                res,real = self.modifier.inverse_transform(res,real)
+            if rescaling:
+                res,real = self._rescale(res,real,groups)
+            if as_arrays:
+                yield {'y_pred':res,'y':real,'time':time,'groups':groups}
+            else:
+                yield self._to_long(res,real,time,groups,self.model.use_quantiles or num_samples is not None)
+
+    def benchmark_inference(self,batch_size:int=100,
+                            num_workers:int=4,
+                            split_params:Union[None,dict]=None,set:str='test',
+                            data:Union[None,torch.utils.data.Dataset]=None,
+                            engines:List[str]=['eager','compile','script'],
+                            warmup:int=2,
+                            n_batches:Union[int,None]=None)->pd.DataFrame:
+        """Throughput (samples/s) of the model on a set for different execution engines (see `InferenceEngine`), the rescaling and the pandas steps are not included.
+
+        Args:
+            batch_size (int, optional): see `inference_on_set`. Defaults to 100.
+            num_workers (int, optional): see `inference_on_set`. Defaults to 4.
+            split_params (Union[None,dict], optional): see `inference_on_set`. Defaults to None.
+            set (str, optional): see `inference_on_set`. Defaults to 'test'.
+            data (None or pd.DataFrame, optional): see `inference_on_set`. Defaults to None.
+            engines (List[str], optional): engines to test. Defaults to ['eager','compile','script'].
+            warmup (int, optional): number of batches not timed. Defaults to 2.
+            n_batches (Union[int,None], optional): maximum number of timed batches, if None the whole set is used. Defaults to None.
+
+        Returns:
+            pd.DataFrame: one row for each engine with model, engine (the one actually used, in case of failure `eager`), device, samples, seconds and samples/s
+        """
+        beauty_string('Inference benchmark','block',self.verbose)
+        dl = self._get_inference_loader(batch_size,num_workers,split_params,set,data)
+        res = []
+        for engine in engines:
+            res.append(benchmark_inference(self.model,dl,engine=engine,warmup=warmup,n_batches=n_batches))
+            res[-1]['requested_engine'] = engine
+            beauty_string(f"{engine}: {res[-1]['samples/s']:.1f} samples/s",'info',self.verbose)
+        return pd.DataFrame(res)
+
+    def _get_inference_loader(self,batch_size:int,num_workers:int,split_params:Union[None,dict],set:str,data:Union[None,torch.utils.data.Dataset])->DataLoader:
+        """DataLoader used in `inference_on_set`, see there for the arguments
+
+        :meta private:
+        """
+        dataset = self._get_inference_dataset(split_params,set,data)
+        ##pinned memory allows asynchronous copies to the GPU (see `InferenceEngine`)
+        return DataLoader(dataset, batch_size = batch_size , shuffle=False,drop_last=False,num_workers=num_workers,collate_fn=collate_batch,pin_memory=torch.cuda.is_available())
+
+    def _get_inference_dataset(self,split_params:Union[None,dict],set:str,data:Union[None,torch.utils.data.Dataset])->torch.utils.data.Dataset:
+        """Dataset used in `inference_on_set`, see there for the arguments
+
+        :meta private:
+        """
         if data is None:
             if split_params is None:
                 beauty_string(f'splitting using train parameters {self.split_params}','section',self.verbose)
@@ -837,117 +1114,75 @@ class TimeSeries():
                 train,validation,test = self.split_for_train(**split_params)
 
         if set=='test':
-            if self.modifier is not None:
-                test = self.modifier.transform(test)
-            dl = DataLoader(test, batch_size = batch_size , shuffle=False,drop_last=False,num_workers=num_workers)
+            dataset = test
         elif set=='validation':
-            if self.modifier is not None:
-                validation = self.modifier.transform(validation)
-            dl = DataLoader(validation, batch_size = batch_size , shuffle=False,drop_last=False,num_workers=num_workers)
+            dataset = validation
         elif set=='train':
-            if self.modifier is not None:
-                train = self.modifier.transform(train)
-            dl = DataLoader(train, batch_size = batch_size , shuffle=False,drop_last=False,num_workers=num_workers)    
+            dataset = train
         elif set=='custom':
             if self.check_custom:
                 pass
             else:
                 beauty_string('If you are here something went wrong, please report it','section',self.verbose)
-            if self.modifier is not None:
-                data = self.modifier.transform(data)
-            dl = DataLoader(data, batch_size = batch_size , shuffle=False,drop_last=False,num_workers=num_workers)    
-  
+            dataset = data
         else:
             beauty_string('Select one of train, test, or validation set','section',self.verbose)
-        self.model.eval()
-        
-        res = []
-        real = []
-        self.model.to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
-        beauty_string(f'Device used: {self.model.device}','info',self.verbose)
-
-        for batch in dl:
-            res.append(self.model.inference(batch).cpu().detach().numpy())
-            real.append(batch['y'].cpu().detach().numpy())
-       
-        res = np.vstack(res)
- 
-        real = np.vstack(real)
-        time = dl.dataset.t
-        groups = dl.dataset.groups
-        #import pdb
-        #pdb.set_trace()
         if self.modifier is not None:
-            res,real = self.modifier.inverse_transform(res,real)
+            dataset = self.modifier.transform(dataset)
+        return dataset
 
-        ## BxLxCx3
-        if rescaling:
-            beauty_string('Scaling back','info',self.verbose)
-            if self.normalize_per_group is False:
-                for i, c in enumerate(self.target_variables):
-                    real[:,:,i] = self.scaler_num[c].inverse_transform(real[:,:,i].reshape(-1,1)).reshape(-1,real.shape[1])
-                    for j in range(res.shape[3]):
-                        res[:,:,i,j] = self.scaler_num[c].inverse_transform(res[:,:,i,j].reshape(-1,1)).reshape(-1,res.shape[1])
-            else:
-                for group in np.unique(groups):
-                    idx = np.where(groups==group)[0]
-                    for i, c in enumerate(self.target_variables):
-                        real[idx,:,i] = self.scaler_num[f'{c}_{group}'].inverse_transform(real[idx,:,i].reshape(-1,1)).reshape(-1,real.shape[1])
-                        for j in range(res.shape[3]):
-                            res[idx,:,i,j] = self.scaler_num[f'{c}_{group}'].inverse_transform(res[idx,:,i,j].reshape(-1,1)).reshape(-1,res.shape[1])
-
-        if self.model.use_quantiles:
-            time = pd.DataFrame(time,columns=[i+1 for i in range(res.shape[1])])
-            
-            if self.group is not None:
-                time[self.group] = groups
-                time = time.melt(id_vars=['region'])
-            else:
-                time = time.melt()
-            time.rename(columns={'value':'time','variable':'lag'},inplace=True)
+    def _rescale(self,res:np.array,real:np.array,groups:np.array)->tuple:
+        """Scale back the predictions (BxLxCxQ) and the real values (BxLxC) with one inverse transformation for each target (or one for all in the case of `normalize_per_group`)
 
-                
-            tot = [time]
+        :meta private:
+        """
+        ## real values and quantiles together: BxLxCx(1+Q)
+        tmp = np.concatenate([real[:,:,:,None],res],axis=3)
+        if self.normalize_per_group is False:
             for i, c in enumerate(self.target_variables):
-                tot.append(pd.DataFrame(real[:,:,i],columns=[i+1 for i in range(res.shape[1])]).melt().rename(columns={'value':c}).drop(columns=['variable']))
-                tot.append(pd.DataFrame(res[:,:,i,0],columns=[i+1 for i in range(res.shape[1])]).melt().rename(columns={'value':c+'_low'}).drop(columns=['variable']))
-                tot.append(pd.DataFrame(res[:,:,i,1],columns=[i+1 for i in range(res.shape[1])]).melt().rename(columns={'value':c+'_median'}).drop(columns=['variable']))
-                tot.append(pd.DataFrame(res[:,:,i,2],columns=[i+1 for i in range(res.shape[1])]).melt().rename(columns={'value':c+'_high'}).drop(columns=['variable']))
-
-            res = pd.concat(tot,axis=1)
-        
-            
-        ## BxLxCx1
+                tmp[:,:,i,:] = self.scaler_num[c].inverse_transform(tmp[:,:,i,:].reshape(-1,1)).reshape(tmp.shape[0],tmp.shape[1],-1)
         else:
-            time = pd.DataFrame(time,columns=[i+1 for i in range(res.shape[1])])#.melt()
+            codes = self.scaler_cat[self.group].transform(groups)
+            scaler_num, _ = self._get_group_scalers()
+            tmp = scaler_num.inverse_transform(tmp.transpose(0,1,3,2),codes,self.target_variables).transpose(0,1,3,2).astype(tmp.dtype)
+        return tmp[:,:,:,1:],tmp[:,:,:,0]
 
-            if self.group is not None:
-                time[self.group] = groups
-                time = time.melt(id_vars=['region'])
-            else:
-                time = time.melt()
-            time.rename(columns={'value':'time','variable':'lag'},inplace=True)
-                 
-
-            tot = [time]
-            for i, c in enumerate(self.target_variables):
-                tot.append(pd.DataFrame(real[:,:,i],columns=[i+1 for i in range(res.shape[1])]).melt().rename(columns={'value':c}).drop(columns=['variable']))
-                tot.append(pd.DataFrame(res[:,:,i,0],columns=[i+1 for i in range(res.shape[1])]).melt().rename(columns={'value':c+'_pred'}).drop(columns=['variable']))
-            res = pd.concat(tot,axis=1)
+    def _to_long(self,res:np.array,real:np.array,time:np.array,groups:np.array,quantiles:bool)->pd.DataFrame:
+        """Long format of the predictions: one row for each sample and lag (lag major order). If quantiles is True (quantile loss or Monte Carlo quantiles)
+        the last dimension of res contains the quantiles 0.1, 0.5 and 0.9, otherwise only the first element is used (e.g. regression or first class of a classifier)
 
-        res['prediction_time'] = res.apply(lambda x: x.time-self.freq*x.lag, axis=1)
+        :meta private:
+        """
+        N, L = res.shape[0], res.shape[1]
+        ## wide to long: the element (sample,lag) goes in the row lag*N+sample
+        tot = {}
+        if self.group is not None:
+            tot[self.group] = np.tile(groups,L)
+        tot['lag'] = np.repeat(np.arange(1,L+1),N)
+        tot['time'] = time.T.ravel()
+        suffixes = ['_low','_median','_high'] if quantiles else ['_pred']
+        for i, c in enumerate(self.target_variables):
+            tot[c] = real[:,:,i].T.ravel()
+            for j,suffix in enumerate(suffixes):
+                tot[c+suffix] = res[:,:,i,j].T.ravel()
+        res = pd.DataFrame(tot)
+        res['prediction_time'] = res.time-res.lag*self.freq
         return res
+
     def inference(self,batch_size:int=100,
                   num_workers:int=4,
                   split_params:Union[None,dict]=None,
                   rescaling:bool=True,
                   data:pd.DataFrame=None,
                   steps_in_future:int=0,
-                  check_holes_and_duplicates:bool=True)->pd.DataFrame:
+                  check_holes_and_duplicates:bool=True,
+                  as_arrays:bool=False,
+                  engine:str='eager',
+                  num_samples:Union[int,None]=None)->Union[pd.DataFrame,dict]:
         
         """similar to `inference_on_set`
         only change is split_params that must contain this keys but using the default can be sufficient:
-        'past_steps','future_steps','shift','keep_entire_seq_while_shifting','starting_point'
+        'past_steps','future_steps','shift','keep_entire_seq_while_shifting','starting_point','lazy','memmap_dir'
         
         skip_step is set to 1 for convenience (generally you want all the predictions)
         You can set split_params to None and use the standard parameters (at your own risck)
@@ -961,9 +1196,12 @@ class TimeSeries():
             data (pd.DataFrame, optional): startin dataset. Defaults to None.
             steps_in_future (int, optional): if>0 the dataset is extendend in order to make predictions in the future. Defaults to 0.
             check_holes_and_duplicates (bool, optional): if False the routine does not check for holes or for duplicates, set to False for stacked model. Defaults to True.
+            as_arrays (bool, optional): see inference_on_set. Defaults to False.
+            engine (str, optional): see inference_on_set. Defaults to 'eager'.
+            num_samples (Union[int,None], optional): see inference_on_set. Defaults to None.
 
         Returns:
-            pd.DataFrame: predicted values
+            Union[pd.DataFrame,dict]: predicted values
         """
         beauty_string('Inference on a custom dataset','block',self.verbose)
         
@@ -992,17 +1230,31 @@ class TimeSeries():
         if split_params is None:
             split_params = {}
             for c in self.split_params.keys():
-                if c in ['past_steps','future_steps','shift','keep_entire_seq_while_shifting','starting_point']:
+                if c in ['past_steps','future_steps','shift','keep_entire_seq_while_shifting','starting_point','lazy','memmap_dir']:
                     split_params[c] = self.split_params[c]
             split_params['skip_step']=1
             data = self.create_data_loader(dataset,**split_params)
         else:
             data = self.create_data_loader(data,**split_params)
 
-        res = self.inference_on_set(batch_size=batch_size,num_workers=num_workers,split_params=None,set='custom',rescaling=rescaling,data=data)
+        res = self.inference_on_set(batch_size=batch_size,num_workers=num_workers,split_params=None,set='custom',rescaling=rescaling,data=data,as_arrays=as_arrays,engine=engine,num_samples=num_samples)
         self.check_custom = False
         return res
         
+    def get_online_predictor(self,data:Union[pd.DataFrame,None]=None,engine:str='eager',device:Union[str,None]='cpu')->OnlinePredictor:
+        """Low latency predictor for real time forecasting: the new observations are added with `update` and `predict` returns the forecast of a group
+        without repeating the whole `inference` pipeline (see `OnlinePredictor`)
+
+        Args:
+            data (Union[pd.DataFrame,None], optional): history used for filling the buffers (at least `past_steps` rows for each group). Defaults to None.
+            engine (str, optional): see `InferenceEngine`. Defaults to 'eager'.
+            device (Union[str,None], optional): see `InferenceEngine`. Defaults to 'cpu'.
+
+        Returns:
+            OnlinePredictor: the predictor
+        """
+        return OnlinePredictor(self,data=data,engine=engine,device=device)
+
     def save(self, filename:str)->None:
         """save the timeseries object
 
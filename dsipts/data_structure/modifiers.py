@@ -124,8 +124,10 @@ class ModifierVVA(Modifier):
         idx_target =  train.idx_target
         assert len(idx_target)==1, print('This works only with single channel prediction')
         
-        samples,length,_ = train.data['y'].shape
-        tmp = train.data['x_num_past'][:,:,idx_target[0]].reshape(samples,-1,self.token_split)
+        ##each key is materialized once (the lazy datasets build the samples at each access)
+        y_train = train.get_data('y')
+        samples,length,_ = y_train.shape
+        tmp = train.get_data('x_num_past')[:,:,idx_target[0]].reshape(samples,-1,self.token_split)
         _,length_in, _ = tmp.shape
         length_out = length//self.token_split
         tmp = tmp.reshape(-1,self.token_split)
@@ -150,13 +152,15 @@ class ModifierVVA(Modifier):
         self.centroids = np.array(self.centroids) ##clusters x length x 3 
 
         x_train = clusters.reshape(-1,length_in)
-        samples = train.data['y'].shape[0]
-        y_train = cl.predict(train.data['y'].squeeze().reshape(samples,-1,self.token_split).reshape(-1,self.token_split)).reshape(-1,length_out)
-        samples = val.data['y'].shape[0]
-        y_validation = cl.predict(val.data['y'].squeeze().reshape(samples,-1,self.token_split).reshape(-1,self.token_split)).reshape(-1,length_out)
-        x_validation = cl.predict(val.data['x_num_past'][:,:,idx_target[0]].reshape(samples,-1,self.token_split).reshape(-1,self.token_split)).reshape(-1,length_in)
-        train_dataset = VVADataset(x_train,y_train,train.data['y'].squeeze(),train.t,length_in,length_out,self.max_voc_size)
-        validation_dataset = VVADataset(x_validation,y_validation,val.data['y'].squeeze(),val.t,length_in,length_out,self.max_voc_size)
+        y_train = y_train.squeeze()
+        samples = y_train.shape[0]
+        y_train_clusters = cl.predict(y_train.reshape(samples,-1,self.token_split).reshape(-1,self.token_split)).reshape(-1,length_out)
+        y_val = val.get_data('y').squeeze()
+        samples = y_val.shape[0]
+        y_validation = cl.predict(y_val.reshape(samples,-1,self.token_split).reshape(-1,self.token_split)).reshape(-1,length_out)
+        x_validation = cl.predict(val.get_data('x_num_past')[:,:,idx_target[0]].reshape(samples,-1,self.token_split).reshape(-1,self.token_split)).reshape(-1,length_in)
+        train_dataset = VVADataset(x_train,y_train_clusters,y_train,train.t,length_in,length_out,self.max_voc_size)
+        validation_dataset = VVADataset(x_validation,y_validation,y_val,val.t,length_in,length_out,self.max_voc_size)
         return train_dataset,validation_dataset
     
     
@@ -172,17 +176,19 @@ class ModifierVVA(Modifier):
     
         idx_target =  test.idx_target
 
-        samples,length,_ = test.data['y'].shape
-        tmp = test.data['x_num_past'][:,:,idx_target[0]].reshape(samples,-1,self.token_split)
+        y_test = test.get_data('y')
+        samples,length,_ = y_test.shape
+        tmp = test.get_data('x_num_past')[:,:,idx_target[0]].reshape(samples,-1,self.token_split)
         _,length_in, _ = tmp.shape
         length_out = length//self.token_split
         
         tmp = tmp.reshape(-1,self.token_split)
         clusters = self.cl.predict(tmp)
         x = clusters.reshape(-1,length_in)
-        y = self.cl.predict(test.data['y'].squeeze().reshape(samples,-1,self.token_split).reshape(-1,self.token_split)).reshape(-1,length_out)
+        y_test = y_test.squeeze()
+        y = self.cl.predict(y_test.reshape(samples,-1,self.token_split).reshape(-1,self.token_split)).reshape(-1,length_out)
       
-        return VVADataset(x,y,test.data['y'].squeeze(),test.t,length_in,length_out,self.max_voc_size)
+        return VVADataset(x,y,y_test,test.t,length_in,length_out,self.max_voc_size)
     
     def inverse_transform(self,res:np.array,real:np.array)->[np.array,np.array]:
         """The results must be reverted respect to the prediction task
@@ -193,21 +199,14 @@ class ModifierVVA(Modifier):
         Returns:
             np.array: inverse transofrmation of the predictions
         """
-        tot = []
-        for sample in res:
-            tmp_sample = []
-            for index in sample:
-                tmp = []
-                for i in index:
-                    tmp.append(self.centroids[i])
-                tmp = np.array(tmp)
-                if tmp.shape[0]==1:
-                    tmp2 = tmp[0,:,:]
-                else:
-                    tmp2 = tmp.mean(axis=0)
-                    tmp2[:,0] -= 1.96*tmp.std(axis=0)[:,0]  #using confidence interval
-                    tmp2[:,2] += 1.96*tmp.std(axis=0)[:,2]
-                tmp_sample.append(tmp2)
-            tot.append(np.vstack(tmp_sample))
-
-        return np.expand_dims(np.stack(tot),2),np.expand_dims(real,2)
+        ## N x tokens x samples x token_split x 3
+        tmp = self.centroids[np.asarray(res)]
+        if tmp.shape[2]==1:
+            tot = tmp[:,:,0]
+        else:
+            tot = tmp.mean(axis=2)
+            std = tmp.std(axis=2)
+            tot[...,0] -= 1.96*std[...,0]  #using confidence interval
+            tot[...,2] += 1.96*std[...,2]
+        tot = tot.reshape(tot.shape[0],-1,3)
+        return np.expand_dims(tot,2),np.expand_dims(real,2)
@@ -0,0 +1,358 @@
+import numpy as np
+import pandas as pd
+import torch
+from typing import Union
+from .utils import beauty_string, GroupScaler
+from ..models.inference import InferenceEngine
+
+##categorical columns computed from the time (see `TimeSeries.enrich`)
+ENRICHED = ['hour','dow','month','minute']
+##key of the missing values in the categorical mappings (NaN can not be used as dictionary key)
+NAN = '__NAN__'
+
+
+def _key(v):
+    """
+    :meta private:
+    """
+    return NAN if v!=v else v
+
+
+class OnlinePredictor():
+
+    def __init__(self,ts,data:Union[pd.DataFrame,None]=None,engine:str='eager',device:Union[str,None]='cpu'):
+        """Low latency forecasting of a trained `TimeSeries`, one new observation at time. For each group the last normalized rows are stored in a ring buffer,
+        `update` normalizes and appends new observations and `predict` runs a single forward pass using preallocated tensors, without building any dataframe or dataloader.
+        Usually it is created with `TimeSeries.get_online_predictor`
+
+        Args:
+            ts (TimeSeries): a trained timeseries (not stacked and without modifiers)
+            data (Union[pd.DataFrame,None], optional): history used for filling the buffers (same format of `TimeSeries.inference`). Defaults to None.
+            engine (str, optional): see `InferenceEngine`. Defaults to 'eager'.
+            device (Union[str,None], optional): see `InferenceEngine`, for a single forecast the CPU is usually faster. Defaults to 'cpu'.
+        """
+        assert not ts.stacked, beauty_string('The online predictor does not support stacked models','section',True)
+        assert getattr(ts,'modifier',None) is None, beauty_string('The online predictor does not support modifiers','section',True)
+        self.ts = ts
+        self.verbose = ts.verbose
+        self.group = ts.group
+        self.freq = ts.freq
+        ##the times are stored as numpy arrays (integers or datetime64)
+        self.step = self.freq if isinstance(self.freq,(int,np.integer)) else np.timedelta64(pd.Timedelta(self.freq).value,'ns')
+        self.past_variables = list(ts.past_variables)
+        self.future_variables = list(ts.future_variables)
+        self.target_variables = list(ts.target_variables)
+        self.cat_var = list(ts.cat_var)
+        self.past_steps = ts.split_params['past_steps']
+        self.future_steps = ts.split_params['future_steps']
+        self.shift = ts.split_params.get('shift',0)
+        keep = ts.split_params.get('keep_entire_seq_while_shifting',False)
+        self.future_length = self.future_steps+self.shift if keep else self.future_steps
+        ##rows after the last observation needed by the future windows
+        self.n_future = self.future_length-self.shift
+        self.capacity = max(self.past_steps,self.shift,1)
+        ##categorical columns that must be provided for the future rows
+        self.future_cat = [c for c in self.cat_var if c not in ENRICHED and c!=self.group]
+
+        self._build_scalers()
+        self._build_encoders()
+        self.runner = InferenceEngine(ts.model,engine=engine,device=device)
+        self.quantiles = ts.model.use_quantiles
+        self.buffers = {}
+        self._batch = self._allocate()
+        if data is not None:
+            self.update(data)
+
+    def _build_scalers(self)->None:
+        """Numerical scalers as affine transformations (scale, offset) for each group code, if a scaler is not linear the sklearn scalers are used
+
+        :meta private:
+        """
+        ts = self.ts
+        self.num_columns = list(ts.num_var)
+        probe = np.array([[0.0],[1.0],[2.0]])
+        if ts.normalize_per_group:
+            self.scaler_num, self.scaler_cat = ts._get_group_scalers()
+            self.group_classes = {g:i for i,g in enumerate(ts.scaler_cat[self.group].classes_)}
+            n_codes = len(self.group_classes)
+            codes = np.repeat(np.arange(n_codes),3)
+            x = np.tile(probe,(n_codes,len(self.num_columns)))
+            values = self.scaler_num.transform(x,codes,self.num_columns).reshape(n_codes,3,-1)
+        else:
+            self.scaler_num = ts.scaler_num
+            self.scaler_cat = ts.scaler_cat
+            self.group_classes = {g:i for i,g in enumerate(ts.scaler_cat[self.group].classes_)} if self.group is not None else {None:0}
+            values = np.stack([ts.scaler_num[c].transform(probe).ravel() for c in self.num_columns],axis=1)[None]
+        self.offset = values[:,0,:]
+        self.scale = values[:,1,:]-values[:,0,:]
+        self.linear = bool(np.allclose(values[:,2,:],self.offset+2*self.scale,equal_nan=True))
+        if not self.linear:
+            beauty_string('The scaler is not linear, the sklearn scalers will be used','info',self.verbose)
+        self.idx_past = [self.num_columns.index(c) for c in self.past_variables]
+        self.idx_future = [self.num_columns.index(c) for c in self.future_variables]
+        self.idx_target = [self.num_columns.index(c) for c in self.target_variables]
+
+    def _build_encoders(self)->None:
+        """Categorical encoders as dictionaries value --> label for each group code
+
+        :meta private:
+        """
+        self.cat_maps = []
+        for c in self.cat_var:
+            if c==self.group:
+                self.cat_maps.append(None)
+            elif self.ts.normalize_per_group:
+                table = self.scaler_cat.classes[self.scaler_cat.columns.index(c)]
+                self.cat_maps.append({code:{_key(v):l for v,l in zip(tmp.value.values,tmp.label.values)} for code,tmp in table.groupby('code')})
+            else:
+                mapping = {_key(v):i for i,v in enumerate(self.scaler_cat[c].classes_)}
+                self.cat_maps.append({code:mapping for code in self.group_classes.values()})
+
+    def _allocate(self)->dict:
+        """Preallocated batch (of size 1), the numpy arrays share the memory with the tensors
+
+        :meta private:
+        """
+        batch = {'x_num_past':torch.zeros(1,self.past_steps,len(self.past_variables)),
+                 'y':torch.zeros(1,self.future_steps,len(self.target_variables)),
+                 'idx_target':torch.tensor([[self.past_variables.index(c) for c in self.target_variables]])}
+        if len(self.cat_var)>0:
+            batch['x_cat_past'] = torch.zeros(1,self.past_steps,len(self.cat_var),dtype=torch.int64)
+            batch['x_cat_future'] = torch.zeros(1,self.future_length,len(self.cat_var),dtype=torch.int64)
+        if len(self.future_variables)>0:
+            batch['x_num_future'] = torch.zeros(1,self.future_length,len(self.future_variables))
+            idx_target_future = [self.future_variables.index(c) for c in self.target_variables if c in self.future_variables]
+            if len(idx_target_future)>0:
+                batch['idx_target_future'] = torch.tensor([idx_target_future])
+        self._arrays = {k:v.numpy()[0] for k,v in batch.items() if k.startswith('x_')}
+        return batch
+
+    def _code(self,group)->int:
+        """
+        :meta private:
+        """
+        if group not in self.group_classes:
+            raise ValueError(f'Unknown group {group}')
+        return self.group_classes[group]
+
+    def _scale(self,x:np.array,code:int,inverse:bool=False,idx:Union[list,None]=None)->np.array:
+        """(Inverse) scaling of the numerical columns (the columns are in the last dimension, `idx` selects a subset of `num_columns`)
+
+        :meta private:
+        """
+        idx = list(range(len(self.num_columns))) if idx is None else idx
+        if self.linear:
+            row = code if self.offset.shape[0]>1 else 0
+            offset = self.offset[row,idx]
+            scale = self.scale[row,idx]
+            return (x-offset)/scale if inverse else x*scale+offset
+        columns = [self.num_columns[i] for i in idx]
+        shape = x.shape
+        x = x.reshape(-1,len(idx))
+        if isinstance(self.scaler_num,GroupScaler):
+            fun = self.scaler_num.inverse_transform if inverse else self.scaler_num.transform
+            res = fun(x,np.full(x.shape[0],code),columns)
+        else:
+            res = np.stack([(self.scaler_num[c].inverse_transform if inverse else self.scaler_num[c].transform)(x[:,j:j+1]).ravel() for j,c in enumerate(columns)],axis=1)
+        return res.reshape(shape)
+
+    def _encode(self,values:dict,times:np.array,code:int,n:int,columns:list)->np.array:
+        """Encoded categorical columns (n x len(cat_var)), the enriched columns are computed from the time
+
+        :meta private:
+        """
+        res = np.empty((n,len(self.cat_var)),dtype=np.int64)
+        for j,c in enumerate(self.cat_var):
+            if c==self.group:
+                res[:,j] = code
+                continue
+            if c in ENRICHED:
+                raw = self._calendar(times,c)
+            else:
+                if c not in columns:
+                    raise ValueError(f'Missing categorical variable {c}')
+                raw = np.asarray(values[c]).reshape(-1)
+            mapping = self.cat_maps[j].get(code,{})
+            try:
+                res[:,j] = [mapping[_key(v)] for v in raw]
+            except KeyError as e:
+                raise ValueError(f'{c} contains previously unseen labels {e}')
+        return res
+
+    @staticmethod
+    def _calendar(times:np.array,column:str)->np.array:
+        """Same of `TimeSeries.enrich` computed directly on datetime64 arrays
+
+        :meta private:
+        """
+        if column=='hour':
+            return times.astype('datetime64[h]').astype(np.int64)%24
+        if column=='minute':
+            return times.astype('datetime64[m]').astype(np.int64)%60
+        if column=='dow':
+            ##1970-01-01 is a Thursday
+            return (times.astype('datetime64[D]').astype(np.int64)+3)%7
+        return times.astype('datetime64[M]').astype(np.int64)%12+1
+
+    def _times(self,start,n:int)->np.array:
+        """
+        :meta private:
+        """
+        return start+self.step*np.arange(n)
+
+    def _new_buffer(self,code:int)->dict:
+        """Ring buffer of a group: each row is written twice (at `pos` and `pos+capacity`) so that the last rows are always a contiguous slice
+
+        :meta private:
+        """
+        return {'code':code,
+                'pos':0,
+                'count':0,
+                'last_time':None,
+                'past':np.full((2*self.capacity,len(self.past_variables)),np.nan,dtype=np.float32),
+                'future':np.full((2*self.capacity,len(self.future_variables)),np.nan,dtype=np.float32),
+                'cat':np.zeros((2*self.capacity,len(self.cat_var)),dtype=np.int64)}
+
+    def _push(self,buffer:dict,num:np.array,cat:np.array)->None:
+        """Append rows (already normalized) to a ring buffer
+
+        :meta private:
+        """
+        n = num.shape[0]
+        if n>self.capacity:
+            num = num[-self.capacity:]
+            cat = cat[-self.capacity:]
+            buffer['pos'] = (buffer['pos']+n-self.capacity)%self.capacity
+            n = self.capacity
+        for i in range(n):
+            for p in (buffer['pos'],buffer['pos']+self.capacity):
+                buffer['past'][p] = num[i,self.idx_past]
+                buffer['future'][p] = num[i,self.idx_future]
+                buffer['cat'][p] = cat[i]
+            buffer['pos'] = (buffer['pos']+1)%self.capacity
+        buffer['count']+=n
+
+    def update(self,data:Union[pd.DataFrame,dict],group=None)->None:
+        """Add new observations. The rows must be consecutive and after the last observation of the group, the missing timestamps are filled with NaN
+        (the forecast is not possible until `past_steps` valid rows are available again)
+
+        Args:
+            data (Union[pd.DataFrame,dict]): a dataframe (one or more rows, also of different groups) or a dictionary column --> value for a single observation.
+                It must contain `time`, the past and future variables and the categorical variables not computed from the time.
+            group (optional): group of the observation if `data` is a dictionary. Defaults to None.
+        """
+        if isinstance(data,dict):
+            if self.group is not None and group is None:
+                group = data[self.group]
+            self._update_group(group,{k:[v] for k,v in data.items()},[data['time']])
+            return
+        if self.group is None:
+            self._update_group(None,data,data.time.values)
+        else:
+            for g,tmp in data.groupby(self.group,sort=False):
+                self._update_group(g,tmp,tmp.time.values)
+
+    def _update_group(self,group,data:Union[pd.DataFrame,dict],times:np.array)->None:
+        """
+        :meta private:
+        """
+        code = self._code(group)
+        if group not in self.buffers:
+            self.buffers[group] = self._new_buffer(code)
+        buffer = self.buffers[group]
+        times = self._as_times(times)
+        order = np.argsort(times,kind='stable')
+        if buffer['last_time'] is not None:
+            if times[order[0]]<=buffer['last_time']:
+                raise ValueError(f'The observations must be after the last one ({buffer["last_time"]})')
+            ##holes are filled with NaN as in `load_signal`
+            expected = self._times(buffer['last_time']+self.step,int((times[order[-1]]-buffer['last_time'])/self.step))
+        else:
+            expected = self._times(times[order[0]],int((times[order[-1]]-times[order[0]])/self.step)+1)
+        n = len(expected)
+        positions = np.searchsorted(expected,times[order])
+        if np.any(positions>=n) or np.any(expected[np.minimum(positions,n-1)]!=times[order]):
+            raise ValueError(f'The observations must be on the time grid with frequency {self.freq}')
+        num = np.full((n,len(self.num_columns)),np.nan)
+        for j,c in enumerate(self.num_columns):
+            if c in data:
+                num[positions,j] = np.asarray(data[c],dtype=float)[order]
+        num = self._scale(num,code)
+        cat = np.zeros((n,len(self.cat_var)),dtype=np.int64)
+        columns = [c for c in data.keys()] if isinstance(data,dict) else list(data.columns)
+        raw = {c:np.asarray(data[c])[order] for c in self.future_cat if c in columns}
+        ##the categorical values of the holes are not used (the samples are not valid)
+        cat[positions] = self._encode(raw,expected[positions],code,len(positions),columns)
+        self._push(buffer,num,cat)
+        buffer['last_time'] = expected[-1]
+
+    def _as_times(self,times:np.array)->np.array:
+        """
+        :meta private:
+        """
+        if isinstance(self.freq,(int,np.integer)):
+            return np.asarray(times)
+        return np.asarray(pd.to_datetime(np.asarray(times)),dtype='datetime64[ns]')
+
+    def predict(self,group=None,future:Union[pd.DataFrame,dict,None]=None,as_frame:bool=False)->Union[np.array,pd.DataFrame]:
+        """Forecast of the next `future_steps` of a group starting after its last observation
+
+        Args:
+            group (optional): the group (None if the timeseries has no groups). Defaults to None.
+            future (Union[pd.DataFrame,dict,None], optional): values of the future variables and of the categorical variables not computed from the time for the
+                future timestamps (`future_steps` rows, `future_steps-shift` if the sequence is not kept while shifting). Defaults to None.
+            as_frame (bool, optional): if True a dataframe in the same format of `TimeSeries.inference` is returned. Defaults to False.
+
+        Returns:
+            Union[np.array,pd.DataFrame]: the rescaled forecast (future_steps x targets x quantiles) or a dataframe
+        """
+        if group not in self.buffers:
+            raise ValueError(f'No observations for the group {group}')
+        buffer = self.buffers[group]
+        code = buffer['code']
+        end = buffer['pos']+self.capacity
+        arrays = self._arrays
+        past = buffer['past'][end-self.past_steps:end]
+        if buffer['count']<self.past_steps or not np.isfinite(past.min()):
+            raise ValueError(f'Not enough valid observations for the group {group}')
+        arrays['x_num_past'][:] = past
+        if self.n_future>0 and (len(self.future_variables)>0 or len(self.future_cat)>0):
+            if future is None:
+                raise ValueError(f'Provide the future values of {self.future_variables+self.future_cat}')
+        if len(self.cat_var)>0:
+            arrays['x_cat_past'][:] = buffer['cat'][end-self.past_steps:end]
+            arrays['x_cat_future'][:self.shift] = buffer['cat'][end-self.shift:end]
+            if self.n_future>0:
+                times = self._times(buffer['last_time']+self.step,self.n_future)
+                columns = list(future.keys()) if future is not None else []
+                arrays['x_cat_future'][self.shift:] = self._encode(future,times,code,self.n_future,columns)
+        if len(self.future_variables)>0:
+            arrays['x_num_future'][:self.shift] = buffer['future'][end-self.shift:end]
+            if self.n_future>0:
+                x = np.column_stack([np.asarray(future[c],dtype=float) for c in self.future_variables])
+                arrays['x_num_future'][self.shift:] = self._scale(x,code,idx=self.idx_future)
+            if not np.isfinite(arrays['x_num_future'].sum()):
+                raise ValueError(f'Missing future values for the group {group}')
+        res = self.runner(self._batch).detach().cpu().numpy()[0]
+        res = self._scale(res.transpose(0,2,1),code,inverse=True,idx=self.idx_target).transpose(0,2,1)
+        if as_frame:
+            return self._to_frame(res,buffer,group)
+        return res
+
+    def _to_frame(self,res:np.array,buffer:dict,group)->pd.DataFrame:
+        """
+        :meta private:
+        """
+        L = res.shape[0]
+        tot = {}
+        if self.group is not None:
+            tot[self.group] = np.repeat(group,L)
+        tot['lag'] = np.arange(1,L+1)
+        tot['time'] = self._times(buffer['last_time']+self.step,L)
+        suffixes = ['_low','_median','_high'] if self.quantiles else ['_pred']
+        for i, c in enumerate(self.target_variables):
+            for j,suffix in enumerate(suffixes):
+                tot[c+suffix] = res[:,i,j]
+        res = pd.DataFrame(tot)
+        res['prediction_time'] = res.time-res.lag*self.freq
+        return res
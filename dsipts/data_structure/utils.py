@@ -1,13 +1,19 @@
 from enum import Enum
-from typing import Union
+from typing import Union, Iterable
 import pandas as pd
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from pytorch_lightning import Callback
 import torch
 import os
+import shutil
+import pickle
+import hashlib
 import logging
 from typing import Union
+from sklearn.preprocessing import *
 def beauty_string(message:str,type:str,verbose:bool):
     
     size = 150
@@ -39,7 +45,7 @@ def extend_time_df(x:pd.DataFrame,freq:Union[str,int],group:Union[str,None]=None
 
     Args:
         x (pd.DataFrame): dataframe containing the column time
-        freq (str): frequency (in pandas notation) of the resulting dataframe
+        freq (str): frequency (in pandas notation, timedelta or integer) of the resulting dataframe
         group (string or None): if not None the min max are computed by the group column, default None
         global_minmax (bool): if True the min_max is computed globally for each group. Usually used for stacked model
     Returns:
@@ -54,24 +60,217 @@ def extend_time_df(x:pd.DataFrame,freq:Union[str,int],group:Union[str,None]=None
             empty = pd.DataFrame({'time':pd.date_range(x.time.min(),x.time.max(),freq=freq)})
 
     else:
-        
+        ## one pass on the groups (in order of appearance): the grid is built repeating the starting times and adding the steps
+        groups = x.groupby(group,sort=False).time
         if global_minmax:
-            _min = pd.DataFrame({group:x[group].unique(),'time':x.time.min()})
-            _max = pd.DataFrame({group:x[group].unique(),'time':x.time.max()})
+            _min = pd.Series(x.time.min(),index=groups.size().index)
+            _max = pd.Series(x.time.max(),index=groups.size().index)
+        else:
+            _min = groups.min()
+            _max = groups.max()
 
+        if isinstance(freq,int):
+            lengths = np.maximum(-((_min.values-_max.values)//freq),0)
         else:
-            _min = x.groupby(group).time.min().reset_index()
-            _max = x.groupby(group).time.max().reset_index()
-        empty = []
-        for c in x[group].unique():
-            if isinstance(freq,int):
-                empty.append(pd.DataFrame({group:c,'time':np.arange(_min.time[_min[group]==c].values[0],_max.time[_max[group]==c].values[0],freq)}))
+            try:
+                freq = pd.to_timedelta(freq)
+            except ValueError:
+                ##non fixed frequency (e.g. month), the grid can not be built with the steps
+                empty = [pd.DataFrame({group:c,'time':pd.date_range(_min[c],_max[c],freq=freq)}) for c in _min.index]
+                return pd.concat(empty,ignore_index=True)
+            lengths = ((_max-_min)//freq).values.astype(int)+1
+        lengths = np.maximum(lengths,0)
+        offsets = np.cumsum(lengths)-lengths
+        steps = np.arange(lengths.sum())-np.repeat(offsets,lengths)
+        starts = _min.repeat(lengths).reset_index(drop=True)
+        empty = pd.DataFrame({group:np.repeat(_min.index.values,lengths),
+                              'time':starts + (steps*freq if isinstance(freq,int) else pd.to_timedelta(steps*freq.value,unit='ns'))})
+    return empty
+
 
+def iterate_chunks(chunks:Union[str,list,Iterable[pd.DataFrame]])-> Iterable[pd.DataFrame]:
+    """Utility for reading the data one chunk at time
+
+    Args:
+        chunks (Union[str,list,Iterable[pd.DataFrame]]): a CSV/Parquet file, a list of CSV/Parquet files or an iterable of dataframes
+
+    Yields:
+        pd.DataFrame: a chunk of data (file or dataframe), if the column time is a string it is converted to datetime
+    """
+    if isinstance(chunks,(str,pd.DataFrame)):
+        chunks = [chunks]
+    for chunk in chunks:
+        if isinstance(chunk,str):
+            if chunk.endswith('.parquet') or chunk.endswith('.pq'):
+                chunk = pd.read_parquet(chunk)
             else:
-                empty.append(pd.DataFrame({group:c,'time':pd.date_range(_min.time[_min[group]==c].values[0],_max.time[_max[group]==c].values[0],freq=freq)}))
-            
-        empty = pd.concat(empty,ignore_index=True)
-    return empty
+                chunk = pd.read_csv(chunk)
+        assert 'time' in chunk.columns, 'The temporal column must be called time'
+        if chunk.time.dtype==object:
+            ##shallow copy: the column is replaced without modifying the dataframe of the caller
+            chunk = chunk.copy(deep=False)
+            chunk['time'] = pd.to_datetime(chunk.time)
+        yield chunk
+
+
+def get_valid_starts(x_num_past:np.array,
+                     y_target:np.array,
+                     x_num_future:Union[np.array,None],
+                     check:Union[np.array,None],
+                     past_steps:int,
+                     future_steps:int,
+                     shift:int=0,
+                     keep_entire_seq_while_shifting:bool=False,
+                     skip_stacked:int=0,
+                     skip_step:int=1)-> np.array:
+    """Compute, for a single group, the positions of the first future lag of all the valid samples. 
+    A sample is valid if the starting point check is satisfied and if the past window, the target window and the future window do not contain NaN values
+    (same test as `np.isfinite(past.min()+y.min()+future.mean())`). The windows are never materialized: the reductions are computed on `sliding_window_view`s.
+
+    Args:
+        x_num_past (np.array): past numerical variables (time x channels)
+        y_target (np.array): target variables (time x channels)
+        x_num_future (Union[np.array,None]): future numerical variables (time x channels) or None if there are no future variables
+        check (Union[np.array,None]): boolean array of the starting point condition or None
+        past_steps (int): past context length
+        future_steps (int): future lags to predict
+        shift (int, optional): see `TimeSeries.create_data_loader`. Defaults to 0.
+        keep_entire_seq_while_shifting (bool, optional): see `TimeSeries.create_data_loader`. Defaults to False.
+        skip_stacked (int, optional): offset used by the stacked models. Defaults to 0.
+        skip_step (int, optional): see `TimeSeries.create_data_loader`. Defaults to 1.
+
+    Returns:
+        np.array: sorted positions (relative to the group) of the first future lag of each valid sample
+    """
+    starts = np.arange(past_steps,x_num_past.shape[0]-future_steps-skip_stacked,skip_step)
+    if len(starts)==0:
+        return starts
+    if check is not None:
+        starts = starts[np.asarray(check)[starts]]
+        if len(starts)==0:
+            return starts
+    past_min = sliding_window_view(x_num_past,past_steps,axis=0).min(axis=(1,2))[starts-past_steps]
+    y_min = sliding_window_view(y_target,future_steps,axis=0).min(axis=(1,2))[starts+skip_stacked]
+    if x_num_future is not None:
+        length = future_steps+shift if keep_entire_seq_while_shifting else future_steps
+        future_mean = sliding_window_view(x_num_future,length,axis=0).mean(axis=(1,2))[starts-shift+skip_stacked]
+    else:
+        future_mean = 0.0
+    return starts[np.isfinite(past_min+y_min+future_mean)]
+
+
+def gather_windows(x:np.array,starts:np.array,length:int,dtype:Union[np.dtype,None]=None)-> np.array:
+    """Collect all the windows `x[s:s+length]` for `s` in `starts` in a single preallocated array
+
+    Args:
+        x (np.array): array to slice along the first axis
+        starts (np.array): starting position of each window
+        length (int): length of the windows
+        dtype (Union[np.dtype,None], optional): dtype of the result, if None the dtype of `x` is used. Defaults to None.
+
+    Returns:
+        np.array: array of shape (len(starts), length, ...)
+    """
+    res = np.empty((len(starts),length)+x.shape[1:],dtype=x.dtype if dtype is None else dtype)
+    for j in range(length):
+        res[:,j] = x[starts+j]
+    return res
+
+
+def get_cache_key(data:pd.DataFrame,params:dict)-> str:
+    """Content addressed key used for caching the datasets: fingerprint of the data and of the parameters used for generating the samples
+
+    Args:
+        data (pd.DataFrame): the dataset
+        params (dict): parameters (split parameters, variables, scalers...), they must have a stable representation
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha1()
+    h.update(str(list(data.columns)).encode())
+    h.update(pd.util.hash_pandas_object(data,index=True).values.tobytes())
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+
+def _load_array(filename:str)->np.array:
+    """Load an array memory mapping it when possible (arrays of python objects can not be mapped)
+    
+    :meta private:
+    """
+    try:
+        return np.load(filename,mmap_mode='r')
+    except ValueError:
+        return np.load(filename,allow_pickle=True)
+
+
+def save_datasets(path:str,datasets:dict,meta:dict)->None:
+    """Save some datasets on disk: each array is saved in a `.npy` file, the other attributes (and `meta`) are pickled.
+    The files are written in a temporary folder and then moved in `path` so a partial cache is never read.
+
+    Args:
+        path (str): destination folder
+        datasets (dict): name --> dataset (`MyDataset` or `MyLazyDataset`) or None
+        meta (dict): other information to store (for example the fitted scalers)
+    """
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path,exist_ok=True)
+    content = {}
+    for name,dataset in datasets.items():
+        if dataset is None:
+            content[name] = None
+            continue
+        attributes = {}
+        arrays = {}
+        for k,v in dataset.__dict__.items():
+            if isinstance(v,np.ndarray):
+                np.save(os.path.join(tmp_path,f'{name}__{k}.npy'),v,allow_pickle=True)
+                arrays[k] = None
+            elif isinstance(v,dict) and len(v)>0 and all(isinstance(x,np.ndarray) for x in v.values()):
+                for kk,x in v.items():
+                    np.save(os.path.join(tmp_path,f'{name}__{k}__{kk}.npy'),x,allow_pickle=True)
+                arrays[k] = list(v.keys())
+            else:
+                attributes[k] = v
+        content[name] = (dataset.__class__,attributes,arrays)
+    with open(os.path.join(tmp_path,'meta.pkl'),'wb') as f:
+        pickle.dump({'datasets':content,'meta':meta},f)
+    try:
+        os.rename(tmp_path,path)
+    except OSError:
+        ##someone else has written the same cache
+        shutil.rmtree(tmp_path,ignore_errors=True)
+
+
+def load_datasets(path:str)->Union[None,tuple]:
+    """Load the datasets saved with `save_datasets`, the arrays are memory mapped (no copies)
+
+    Args:
+        path (str): cache folder
+
+    Returns:
+        Union[None,tuple]: None if the cache is not present, otherwise the dictionary of the datasets and the meta information
+    """
+    if not os.path.exists(os.path.join(path,'meta.pkl')):
+        return None
+    with open(os.path.join(path,'meta.pkl'),'rb') as f:
+        content = pickle.load(f)
+    datasets = {}
+    for name,v in content['datasets'].items():
+        if v is None:
+            datasets[name] = None
+            continue
+        cls,attributes,arrays = v
+        dataset = cls.__new__(cls)
+        dataset.__dict__.update(attributes)
+        for k,keys in arrays.items():
+            if keys is None:
+                setattr(dataset,k,_load_array(os.path.join(path,f'{name}__{k}.npy')))
+            else:
+                setattr(dataset,k,{kk:_load_array(os.path.join(path,f'{name}__{k}__{kk}.npy')) for kk in keys})
+        datasets[name] = dataset
+    return datasets,content['meta']
 
 
 class MetricsCallback(Callback):
@@ -149,6 +348,522 @@ class MyDataset(Dataset):
             sample['idx_target_future'] = self.idx_target_future
         return sample
 
+    def get_data(self,key:str)->np.array:
+        """All the samples of a single key
+
+        Args:
+            key (str): key of the data (e.g. `y` or `x_num_past`)
+
+        Returns:
+            np.array: the samples
+        """
+        return self.data[key]
+
+    def get_t(self,idxs:Union[slice,np.array])->np.array:
+        """Time array of some samples
+
+        Args:
+            idxs (Union[slice,np.array]): indexes of the samples
+
+        Returns:
+            np.array: the time array related to the target variables of the selected samples
+        """
+        return self.t[idxs]
+
+    def _add_idx_target(self,sample:dict,batch_size:int)->dict:
+        """Attach the target indexes once per batch (as an expanded view, same shape of the default collate)
+        
+        :meta private:
+        """
+        if self.idx_target is not None:
+            sample['idx_target'] = torch.tensor(self.idx_target).expand(batch_size,-1)
+        if self.idx_target_future is not None:
+            sample['idx_target_future'] = torch.tensor(self.idx_target_future).expand(batch_size,-1)
+        return sample
+
+    def __getitems__(self, idxs):
+        """Batched version of `__getitem__` used by the DataLoader: it returns a single dictionary of already stacked tensors. Use it with `collate_batch`
+
+        Args:
+            idxs (list): indexes of the samples in the batch
+
+        Returns:
+            dict: the batch
+        """
+        idxs = np.asarray(idxs)
+        sample = {}
+        for k in self.data:
+            sample[k] = torch.from_numpy(self.data[k][idxs])
+        return self._add_idx_target(sample,len(idxs))
+
+
+class MyLazyDataset(MyDataset):
+
+    def __init__(self, series:dict,windows:dict,t:np.array,groups:np.array,starts:np.array,idx_target:Union[np.array,None],idx_target_future:Union[np.array,None])->torch.utils.data.Dataset:
+        """
+            Lazy version of `MyDataset`. Instead of storing all the (overlapping) samples it stores the normalized series (groups placed contiguously) and 
+            the positions of the valid samples: the windows are sliced only when an item is requested. The returned items have the same keys of `MyDataset`
+
+        Args:
+            series (dict): a dictionary of contiguous arrays (time x channels), for example `x_num_past`, `x_num_future`, `x_cat` and `y`
+            windows (dict): a dictionary key --> (series key, offset, length). The item `key` of the sample starting at `s` is `series[series key][s+offset:s+offset+length]`
+            t (np.array): the time array of the series
+            groups (np.array): the group array of the series
+            starts (np.array): the position (in the series) of the first future lag of each sample
+            idx_target (Union[np.array,None]): you can specify the index in the past data that represent the input features (for differntial analysis or detrending strategies)
+            idx_target_future (Union[np.array,None]): you can specify the index in the future data that represent the input features (for differntial analysis or detrending strategies)
+
+        Returns:
+            torch.utils.data.Dataset: a torch Dataset to be used in a Dataloader
+        """
+        self.series = series
+        self.windows = windows
+        self.time = t
+        self.starts = starts
+        self.groups = groups[starts]
+        self.idx_target = np.array(idx_target) if idx_target is not None else None
+        self.idx_target_future = np.array(idx_target_future) if idx_target_future is not None else None
+
+    @property
+    def data(self)->dict:
+        """Materialize all the samples of all the keys at each access. Be carefull, it can require a lot of memory: use `get_data` for the keys you need
+
+        Returns:
+            dict: same dictionary used in `MyDataset`
+        """
+        return {k:self.get_data(k) for k in self.windows}
+
+    def get_data(self,key:str)->np.array:
+        """Materialize all the samples of a single key
+
+        Args:
+            key (str): key of the data (e.g. `y` or `x_num_past`)
+
+        Returns:
+            np.array: the samples
+        """
+        series_key,offset,length = self.windows[key]
+        return gather_windows(self.series[series_key],self.starts+offset,length)
+
+    @property
+    def t(self)->np.array:
+        """
+        Returns:
+            np.array: the time array related to the target variables
+        """
+        _,offset,length = self.windows['y']
+        return gather_windows(self.time,self.starts+offset,length)
+
+    def get_t(self,idxs:Union[slice,np.array])->np.array:
+        """Time array of some samples, only the selected windows are sliced
+
+        Args:
+            idxs (Union[slice,np.array]): indexes of the samples
+
+        Returns:
+            np.array: the time array related to the target variables of the selected samples
+        """
+        _,offset,length = self.windows['y']
+        return gather_windows(self.time,self.starts[idxs]+offset,length)
+
+    def __len__(self):
+        
+        return len(self.starts)
+
+    def __getitem__(self, idxs):
+        sample = {}
+        start = self.starts[idxs]
+        for k,(key,offset,length) in self.windows.items():
+            sample[k] = self.series[key][start+offset:start+offset+length]
+        if self.idx_target is not None:
+            sample['idx_target'] = self.idx_target
+        if self.idx_target_future is not None:
+            sample['idx_target_future'] = self.idx_target_future
+        return sample
+
+    def __getitems__(self, idxs):
+        """Batched version of `__getitem__`, the windows of the whole batch are gathered at once
+
+        Args:
+            idxs (list): indexes of the samples in the batch
+
+        Returns:
+            dict: the batch
+        """
+        starts = self.starts[np.asarray(idxs)]
+        sample = {}
+        for k,(key,offset,length) in self.windows.items():
+            sample[k] = torch.from_numpy(gather_windows(self.series[key],starts+offset,length))
+        return self._add_idx_target(sample,len(starts))
+
+
+class MyMemmapDataset(MyLazyDataset):
+
+    def __init__(self, path:str,series:dict,windows:dict,t:np.array,groups:np.array,starts:np.array,idx_target:Union[np.array,None],idx_target_future:Union[np.array,None])->torch.utils.data.Dataset:
+        """
+            Memory mapped version of `MyLazyDataset`: the normalized series are written in `.npy` files inside `path` and the windows are read directly from the files.
+            When the dataset is sent to the DataLoader workers only the file names are pickled, so all the workers share the same pages through the OS cache.
+            The files are named with a fingerprint of their content and reused if they already exist, so splitting again the same data (e.g. in the inference methods)
+            does not write new copies. The files are never deleted automatically: remove the folder when it is no longer needed
+
+        Args:
+            path (str): folder where to write the series
+            series (dict): see `MyLazyDataset`
+            windows (dict): see `MyLazyDataset`
+            t (np.array): see `MyLazyDataset`
+            groups (np.array): see `MyLazyDataset`
+            starts (np.array): see `MyLazyDataset`
+            idx_target (Union[np.array,None]): see `MyLazyDataset`
+            idx_target_future (Union[np.array,None]): see `MyLazyDataset`
+
+        Returns:
+            torch.utils.data.Dataset: a torch Dataset to be used in a Dataloader
+        """
+        os.makedirs(path,exist_ok=True)
+        mapped = {}
+        for k,v in series.items():
+            mapped[k] = self._to_memmap(path,k,v)
+        t = self._to_memmap(path,'time',t)
+        super().__init__(mapped,windows,t,groups,starts,idx_target,idx_target_future)
+
+    @staticmethod
+    def _to_memmap(path:str,name:str,x:np.array)->np.array:
+        """Write the array in a `.npy` file named with the sha1 of its content (if the file does not exist yet) and return it memory mapped (read only). 
+        The file is written with a temporary name and then renamed, so a partial file is never reused. Arrays of python objects are kept in memory
+        
+        :meta private:
+        """
+        if x.dtype.hasobject:
+            return x
+        x = np.ascontiguousarray(x)
+        h = hashlib.sha1()
+        h.update(f'{x.dtype.str}{x.shape}'.encode())
+        h.update(x.reshape(-1).view(np.uint8))
+        filename = os.path.join(path,f'{name}__{h.hexdigest()}.npy')
+        if not os.path.exists(filename):
+            tmp_filename = f'{filename}.tmp{os.getpid()}'
+            res = np.lib.format.open_memmap(tmp_filename,mode='w+',dtype=x.dtype,shape=x.shape)
+            res[:] = x
+            res.flush()
+            del res
+            os.replace(tmp_filename,filename)
+        return np.load(filename,mmap_mode='r')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['series'] = {k:v.filename if isinstance(v,np.memmap) else v for k,v in self.series.items()}
+        state['time'] = self.time.filename if isinstance(self.time,np.memmap) else self.time
+        return state
+
+    def __setstate__(self, state):
+        state['series'] = {k:np.load(v,mmap_mode='r') if isinstance(v,str) else v for k,v in state['series'].items()}
+        state['time'] = np.load(state['time'],mmap_mode='r') if isinstance(state['time'],str) else state['time']
+        self.__dict__.update(state)
+
+
+def collate_batch(batch:Union[dict,list])->dict:
+    """Collate function to use in the DataLoader. If the dataset returns a whole batch (see `MyDataset.__getitems__`) the batch is returned as is, skipping `default_collate`. 
+    Otherwise (for example the datasets generated by the modifiers) the default collate function is used
+
+    Args:
+        batch (Union[dict,list]): batch from `__getitems__` or list of samples
+
+    Returns:
+        dict: the batch
+    """
+    if isinstance(batch,dict):
+        return batch
+    return default_collate(batch)
+
+def shard_indices(dataset:Dataset,n_shards:int,shard_by:str='group')->list:
+    """Split the samples of an inference dataset in shards for the parallel inference (see `TimeSeries.parallel_inference_on_set`)
+
+    Args:
+        dataset (Dataset): dataset with the attributes `groups` and `t` (or the method `get_t`)
+        n_shards (int): maximum number of shards
+        shard_by (str, optional): `group`: each group is assigned entirely to a shard (the shards are balanced greedily by number of samples),
+            `time`: the samples are sorted by time and split in contiguous ranges of the same size. Defaults to 'group'.
+
+    Returns:
+        list: a list of arrays with the indexes of the samples of each (not empty) shard
+    """
+    n = len(dataset)
+    n_shards = max(1,min(n_shards,n))
+    if shard_by=='group':
+        groups = np.asarray(dataset.groups)
+        _,codes,counts = np.unique(groups,return_inverse=True,return_counts=True)
+        codes = codes.ravel()
+        load = np.zeros(n_shards,dtype=np.int64)
+        assignment = np.zeros(len(counts),dtype=np.int64)
+        ##largest groups first, each one to the least loaded shard
+        for g in np.argsort(-counts,kind='stable'):
+            assignment[g] = np.argmin(load)
+            load[assignment[g]]+=counts[g]
+        shard = assignment[codes]
+        shards = [np.where(shard==i)[0] for i in range(n_shards)]
+    elif shard_by=='time':
+        t = dataset.get_t(slice(None)) if hasattr(dataset,'get_t') else dataset.t
+        order = np.argsort(np.asarray(t)[:,0],kind='stable')
+        shards = np.array_split(order,n_shards)
+    else:
+        raise ValueError('shard_by must be group or time')
+    return [x for x in shards if len(x)>0]
+
+def write_chunks(chunks:Iterable[pd.DataFrame],filename:str)->int:
+    """Write incrementally a sequence of dataframes (e.g. the output of `TimeSeries.iterate_inference_on_set`) in a single Parquet or CSV file,
+    only one chunk at time is kept in memory. Parquet requires pyarrow.
+
+    Args:
+        chunks (Iterable[pd.DataFrame]): dataframes with the same columns
+        filename (str): output file, if it ends with `.parquet` or `.pq` a Parquet file is written otherwise a CSV
+
+    Returns:
+        int: number of written rows
+    """
+    parquet = filename.endswith('.parquet') or filename.endswith('.pq')
+    writer = None
+    n = 0
+    try:
+        for i,chunk in enumerate(chunks):
+            if parquet:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(chunk,preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(filename,table.schema)
+                writer.write_table(table.cast(writer.schema))
+            else:
+                chunk.to_csv(filename,index=False,mode='w' if i==0 else 'a',header=(i==0))
+            n+=chunk.shape[0]
+    finally:
+        if writer is not None:
+            writer.close()
+    return n
+
+
+def _group_indices(codes:np.array)->dict:
+    """Positions of each group code
+
+    :meta private:
+    """
+    return pd.DataFrame({'code':codes}).groupby('code',sort=True).indices
+
+
+class GroupScaler():
+
+    def __init__(self,scaler:str='StandardScaler()'):
+        """Scaler of the numerical variables respect to the groups. The statistics are stored in arrays (groups x columns) indexed by an integer 
+        group code so that fit, transform and inverse transform are computed in one vectorized pass.
+        Standard, MinMax, MaxAbs and Robust scalers are computed directly, for the other sklearn scalers one instance per group and column is fitted.
+
+        Args:
+            scaler (str, optional): instance of a sklearn.preprocessing scaler. Defaults to 'StandardScaler()'.
+        """
+        self.scaler = scaler
+        self.columns = []
+        self.center = None
+        self.scale = None
+        self.offset = 0.0
+        self.scalers = None
+
+    def fit(self,x:np.array,codes:np.array,columns:list)->'GroupScaler':
+        """Fit the scaler
+
+        Args:
+            x (np.array): data (samples x columns)
+            codes (np.array): integer code of the group of each sample
+            columns (list): name of the columns
+
+        Returns:
+            GroupScaler: the fitted scaler
+        """
+        self.columns = list(columns)
+        x = np.asarray(x,dtype=float)
+        codes = np.asarray(codes,dtype=int)
+        n_groups = codes.max()+1 if len(codes)>0 else 0
+        scaler = eval(self.scaler)
+        self.offset = 0.0
+        self.scalers = None
+        data = pd.DataFrame(x).groupby(codes)
+        if type(scaler) is StandardScaler:
+            center = data.mean() if scaler.with_mean else 0.0
+            scale = data.std(ddof=0) if scaler.with_std else 1.0
+        elif type(scaler) is MinMaxScaler and not scaler.clip:
+            center = data.min()
+            scale = (data.max()-center)
+            scale[scale<10*np.finfo(float).eps] = 1.0
+            scale = scale/(scaler.feature_range[1]-scaler.feature_range[0])
+            self.offset = float(scaler.feature_range[0])
+        elif type(scaler) is MaxAbsScaler:
+            center = 0.0
+            scale = pd.DataFrame(np.abs(x)).groupby(codes).max()
+        elif type(scaler) is RobustScaler and not scaler.unit_variance:
+            center = data.median() if scaler.with_centering else 0.0
+            scale = data.quantile(scaler.quantile_range[1]/100)-data.quantile(scaler.quantile_range[0]/100) if scaler.with_scaling else 1.0
+        else:
+            ##generic scaler: one instance for each group and column
+            self.scalers = {}
+            for code, idx in _group_indices(codes).items():
+                self.scalers[code] = []
+                for j in range(x.shape[1]):
+                    tmp = eval(self.scaler)
+                    tmp.fit(x[idx,j].reshape(-1,1))
+                    self.scalers[code].append(tmp)
+            return self
+
+        self.center = self._to_array(center,n_groups,x.shape[1])
+        self.scale = self._to_array(scale,n_groups,x.shape[1])
+        self.scale[self.scale<10*np.finfo(float).eps] = 1.0
+        return self
+
+    @staticmethod
+    def _to_array(stat:Union[pd.DataFrame,float],n_groups:int,n_columns:int)->np.array:
+        """Statistics as array (groups x columns), missing groups are NaN
+
+        :meta private:
+        """
+        if isinstance(stat,pd.DataFrame):
+            return stat.reindex(range(n_groups)).values.astype(float)
+        return np.full((n_groups,n_columns),stat,dtype=float)
+
+    @classmethod
+    def from_scalers(cls,scalers:dict,columns:list,groups:np.array)->'GroupScaler':
+        """Build the scaler from a dictionary of fitted sklearn scalers with keys `{column}_{group}` (old per group format)
+
+        Args:
+            scalers (dict): fitted scalers
+            columns (list): name of the columns
+            groups (np.array): groups, the position is the integer code
+
+        Returns:
+            GroupScaler: the scaler
+        """
+        res = cls()
+        res.columns = list(columns)
+        res.scalers = {}
+        for code, group in enumerate(groups):
+            if all(f'{c}_{group}' in scalers for c in columns):
+                res.scalers[code] = [scalers[f'{c}_{group}'] for c in columns]
+        return res
+
+    def _apply(self,x:np.array,codes:np.array,columns:Union[list,None],inverse:bool)->np.array:
+        """Apply the (inverse) transformation, the columns are in the last dimension of x
+
+        :meta private:
+        """
+        idx = list(range(len(self.columns))) if columns is None else [self.columns.index(c) for c in columns]
+        codes = np.asarray(codes,dtype=int)
+        x = np.asarray(x,dtype=float)
+        if self.scalers is None:
+            shape = (x.shape[0],)+(1,)*(x.ndim-2)+(len(idx),)
+            center = self.center[codes][:,idx].reshape(shape)
+            scale = self.scale[codes][:,idx].reshape(shape)
+            if inverse:
+                return (x-self.offset)*scale+center
+            return (x-center)/scale+self.offset
+
+        res = np.empty(x.shape)
+        for code, pos in _group_indices(codes).items():
+            for j,k in enumerate(idx):
+                tmp = x[pos,...,j]
+                fun = self.scalers[code][k].inverse_transform if inverse else self.scalers[code][k].transform
+                res[pos,...,j] = fun(tmp.reshape(-1,1)).reshape(tmp.shape)
+        return res
+
+    def transform(self,x:np.array,codes:np.array,columns:Union[list,None]=None)->np.array:
+        """Scale the data
+
+        Args:
+            x (np.array): data, the columns are in the last dimension and the samples in the first one
+            codes (np.array): integer code of the group of each sample
+            columns (Union[list,None], optional): name of the columns of x, if None all the fitted columns. Defaults to None.
+
+        Returns:
+            np.array: scaled data
+        """
+        return self._apply(x,codes,columns,False)
+
+    def inverse_transform(self,x:np.array,codes:np.array,columns:Union[list,None]=None)->np.array:
+        """Scale back the data, see `transform`
+
+        Args:
+            x (np.array): scaled data, the columns are in the last dimension and the samples in the first one
+            codes (np.array): integer code of the group of each sample
+            columns (Union[list,None], optional): name of the columns of x, if None all the fitted columns. Defaults to None.
+
+        Returns:
+            np.array: data in the original scale
+        """
+        return self._apply(x,codes,columns,True)
+
+
+class GroupLabelEncoder():
+
+    def __init__(self):
+        """Label encoder of the categorical variables respect to the groups: the values are encoded separately in each group (as a `LabelEncoder` per group) 
+        using one table (group code, value, label) for each column
+        """
+        self.columns = []
+        self.classes = []
+
+    def fit(self,x:np.array,codes:np.array,columns:list)->'GroupLabelEncoder':
+        """Fit the encoder
+
+        Args:
+            x (np.array): data (samples x columns)
+            codes (np.array): integer code of the group of each sample
+            columns (list): name of the columns
+
+        Returns:
+            GroupLabelEncoder: the fitted encoder
+        """
+        self.columns = list(columns)
+        self.classes = []
+        for j in range(len(self.columns)):
+            tmp = pd.DataFrame({'code':codes,'value':x[:,j]}).drop_duplicates().sort_values(['code','value'],ignore_index=True)
+            tmp['label'] = tmp.groupby('code').cumcount()
+            self.classes.append(tmp)
+        return self
+
+    @classmethod
+    def from_encoders(cls,encoders:dict,columns:list,groups:np.array)->'GroupLabelEncoder':
+        """Build the encoder from a dictionary of fitted `LabelEncoder` with keys `{column}_{group}` (old per group format)
+
+        Args:
+            encoders (dict): fitted encoders
+            columns (list): name of the columns
+            groups (np.array): groups, the position is the integer code
+
+        Returns:
+            GroupLabelEncoder: the encoder
+        """
+        res = cls()
+        res.columns = list(columns)
+        for c in columns:
+            tmp = [pd.DataFrame({'code':code,'value':encoders[f'{c}_{group}'].classes_,'label':np.arange(len(encoders[f'{c}_{group}'].classes_))}) 
+                   for code,group in enumerate(groups) if f'{c}_{group}' in encoders]
+            res.classes.append(pd.concat(tmp,ignore_index=True))
+        return res
+
+    def transform(self,x:np.array,codes:np.array)->np.array:
+        """Encode the data
+
+        Args:
+            x (np.array): data (samples x columns)
+            codes (np.array): integer code of the group of each sample
+
+        Returns:
+            np.array: encoded data
+        """
+        res = np.empty(x.shape,dtype=int)
+        for j in range(len(self.columns)):
+            tmp = pd.DataFrame({'code':codes,'value':x[:,j]}).merge(self.classes[j],how='left',on=['code','value'])
+            if tmp.label.isna().any():
+                raise ValueError(f'{self.columns[j]} contains previously unseen labels')
+            res[:,j] = tmp.label.values
+        return res
+
+
 class ActionEnum(Enum):
     """action of categorical variable
     
@@ -34,6 +34,8 @@ def copy_parameters(
 
 
 class D3VAE(Base):              
+    ##the denoising step of the inference uses the gradient of the score network
+    inference_requires_grad = True
     
     def __init__(self,
                  past_channels,
@@ -103,6 +105,8 @@ class D3VAE(Base):
   
         self.use_quantiles = False
         self.loss = nn.MSELoss()
+        ##pred_net is a copy of denoise_net, see sync_pred_net
+        self.pred_net_synced = False
         
     def configure_optimizers(self):
         """
@@ -142,18 +146,36 @@ class D3VAE(Base):
         :meta private:
         """
         
-        copy_parameters(self.denoise_net, self.pred_net)
-        batch_x = batch['x_num_past'].to(self.device)
-        batch_x_mark = batch['x_cat_past'].to(self.device)
-        batch_y = batch['y'].to(self.device)
-
-        import pdb
-        pdb.set_trace()
-        _, out, _, _ = self.pred_net(batch_x, batch_x_mark)
-        mse = self.loss(out.squeeze(1), batch_y)
+        ##the denoising step uses the gradient of the score network
+        with torch.enable_grad():
+            y_hat = self.inference(batch)
+        mse = self.loss(y_hat[:,:,0,:], batch['y'].to(self.device))
         
         
-        return mse
+        return mse.detach()
+
+    def train(self, mode:bool=True):
+        """
+        denoise_net changes only in training mode, the copy in pred_net is refreshed at the first inference after a change of mode
+
+        :meta private:
+        """
+        self.pred_net_synced = False
+        return super().train(mode)
+
+    def load_state_dict(self, *args, **kwargs):
+        """
+        :meta private:
+        """
+        self.pred_net_synced = False
+        return super().load_state_dict(*args, **kwargs)
+
+    def sync_pred_net(self)->None:
+        """Copy the parameters of denoise_net in pred_net if they may be changed since the last copy (training or loading of a checkpoint), not for each batch
+        """
+        if not self.pred_net_synced:
+            copy_parameters(self.denoise_net, self.pred_net)
+            self.pred_net_synced = True
 
         
         
@@ -191,7 +213,7 @@ class D3VAE(Base):
         Returns:
             torch.tensor: result
         """
-        copy_parameters(self.denoise_net, self.pred_net)
+        self.sync_pred_net()
 
         batch_x = batch['x_num_past'].float().to(self.device)
         batch_x_mark = batch['x_cat_past'].to(self.device)
@@ -36,6 +36,7 @@ class Diffusion(Base):
                  activation: str,
                  subnet:int,
                  perc_subnet_learning_for_step:float,
+                 inference_steps:Union[int,None]=None,
 
                  persistence_weight:float=0.0,
                  loss_type: str='l1',
@@ -66,6 +67,7 @@ class Diffusion(Base):
             activation (str): param for subnet
             subnet (int): =1 for attention subnet, =2 for linear subnet. Others can be added(wait for Black Friday for discounts)
             perc_subnet_learning_for_step (float): percentage to choose how many subnet has to be trained for every batch. Decrease this value if the loss blows up.
+            inference_steps (Union[int,None], optional): number of subnets used in inference. If None all the diffusion steps are used, otherwise the reverse process runs on a strided subset of steps and the skipped steps are merged (see `inference_schedule`). It can be changed after the training. Defaults to None.
             persistence_weight (float, optional): Defaults to 0.0.
             loss_type (str, optional): Defaults to 'l1'.
             quantiles (List[float], optional): Only [] accepted. Defaults to [].
@@ -125,6 +127,10 @@ class Diffusion(Base):
         # this percentage is controlled by the parameter 'perc_subnet_learning_for_step': 
         # - decrease or increase according to the efficiency of your machine
         self.simultaneous_steps = max(int(diffusion_steps*perc_subnet_learning_for_step), 1) 
+
+        # number of subnets used in inference, None means all of them
+        assert inference_steps is None or 0<inference_steps<=diffusion_steps, 'inference_steps must be between 1 and diffusion_steps'
+        self.inference_steps = inference_steps
         
 
         #* >>>>>>>>>>>>> specific diffusion setup
@@ -170,11 +176,11 @@ class Diffusion(Base):
         #* >>>>>>>>>>>>> LAYERS
         # for other numerical variables in the past
         self.aux_past_channels = past_channels - out_channels
-        self.linear_aux_past = nn.ModuleList([nn.Linear(1, d_model) for _ in range(self.aux_past_channels)])
+        self.linear_aux_past = sub_nn.embedding_num_variables(self.aux_past_channels, d_model)
 
         # for numerical variables in the future
         self.aux_fut_channels = future_channels
-        self.linear_aux_fut = nn.ModuleList([nn.Linear(1, d_model) for _ in range(self.aux_fut_channels)])
+        self.linear_aux_fut = sub_nn.embedding_num_variables(self.aux_fut_channels, d_model)
         
         # embedding categorical for both past and future (ASSUMING BOTH AVAILABLE OR NO ONE)
         self.seq_len = past_steps + future_steps
@@ -210,43 +216,8 @@ class Diffusion(Base):
         # LOADING TARGET VARIABLES
         y_to_be_pred = batch['y'].to(self.device)
 
-        # LOADING AUTOREGRESSIVE CONTEXT OF TARGET VARIABLES
-        num_past = batch['x_num_past'].to(self.device)
-        idx_target = batch['idx_target'][0]
-        y_past = num_past[:,:,idx_target]
-
-        # LOADING EMBEDDING CATEGORICAL VARIABLES
-        emb_cat_past, emb_cat_fut = self.cat_categorical_vars(batch)
-        emb_cat_past = torch.mean(emb_cat_past, dim = 2)
-        emb_cat_fut = torch.mean(emb_cat_fut, dim = 2)
-
-        ### LOADING PAST AND FUTURE NUMERICAL VARIABLES
-        # load in the model auxiliar numerical variables
-
-        if self.aux_past_channels>0: # if we have more numerical variables about past
-            aux_num_past = self.remove_var(num_past, idx_target, 2) # remove the autoregressive variable
-            assert self.aux_past_channels == aux_num_past.size(2),  beauty_string(f"{self.aux_past_channels} LAYERS FOR PAST VARS AND {aux_num_past.size(2)} VARS",'section',True) # to check if we are using the expected number of variables about past
-            # concat all embedded vars and mean of them
-            aux_emb_num_past = torch.Tensor().to(self.device)
-            for i, layer in enumerate(self.linear_aux_past):
-                aux_emb_past = layer(aux_num_past[:,:,[i]]).unsqueeze(2)
-                aux_emb_num_past = torch.cat((aux_emb_num_past, aux_emb_past), dim=2)
-            aux_emb_num_past = torch.mean(aux_emb_num_past, dim = 2)
-        else: 
-            aux_emb_num_past = None # non available vars
-            
-        if self.aux_fut_channels>0: # if we have more numerical variables about future
-            # AUX means AUXILIARY variables
-            aux_num_fut = batch['x_num_future'].to(self.device)
-            assert self.aux_fut_channels == aux_num_fut.size(2), beauty_string(f"{self.aux_fut_channels} LAYERS FOR PAST VARS AND {aux_num_fut.size(2)} VARS",'section',True)  # to check if we are using the expected number of variables about fut
-            # concat all embedded vars and mean of them
-            aux_emb_num_fut = torch.Tensor().to(self.device)
-            for j, layer in enumerate(self.linear_aux_fut):
-                aux_emb_fut = layer(aux_num_fut[:,:,[j]]).unsqueeze(2)
-                aux_emb_num_fut = torch.cat((aux_emb_num_fut, aux_emb_fut), dim=2)
-            aux_emb_num_fut = torch.mean(aux_emb_num_fut, dim = 2)
-        else:
-            aux_emb_num_fut = None # non available vars
+        # LOADING CONTEXT VARIABLES
+        y_past, emb_cat_past, emb_cat_fut, aux_emb_num_past, aux_emb_num_fut = self._context(batch)
 
         ### actual DIFFUSION process ----------------------------------------------
 
@@ -336,55 +307,50 @@ class Diffusion(Base):
         Returns:
             torch.Tensor: generated sequence [batch_size, future_steps, num_var]
         """
-        # LOADING AUTOREGRESSIVE CONTEXT OF TARGET VARIABLES
-        num_past = batch['x_num_past'].to(self.device)
-        batch_size = num_past.shape[0]
-        idx_target = batch['idx_target'][0]
-        y_past = num_past[:,:,idx_target]        
+        # LOADING CONTEXT VARIABLES, embedded once and shared by all the subnets
+        return self.reverse_process(self._context(batch))
 
-        # LOADING EMBEDDING CATEGORICAL VARIABLES
-        emb_cat_past, emb_cat_fut = self.cat_categorical_vars(batch)
-        emb_cat_past = torch.mean(emb_cat_past, dim = 2)
-        emb_cat_fut = torch.mean(emb_cat_fut, dim = 2)
+    def sample(self, batch:dict, num_samples:int) -> torch.Tensor:
+        """Monte Carlo samples of the forecast: the context is computed once and repeated num_samples times along the batch dimension,
+        then all the reverse processes run together
 
-        ### LOADING PAST AND FUTURE NUMERICAL VARIABLES
-        # this check is done simultaneously 
-        # because in the model we use auxiliar numerical variables 
-        # only if we have both them in the past and in the future
+        Args:
+            batch (dict): Keys checked ['x_num_past, 'idx_target', 'x_num_future', 'x_cat_past', 'x_cat_future']
+            num_samples (int): number of samples for each element of the batch
 
-        ### LOADING PAST AND FUTURE NUMERICAL VARIABLES
-        # load in the model auxiliar numerical variables
+        Returns:
+            torch.Tensor: samples [num_samples, batch_size, future_steps, num_var]
+        """
+        context = self._context(batch)
+        batch_size = context[0].shape[0]
+        context = [c.repeat(num_samples, *[1]*(c.dim()-1)) if c is not None else None for c in context]
+        out = self.reverse_process(context)
+        return out.view(num_samples, batch_size, self.future_steps, self.output_channels)
+
+    def reverse_process(self, context:List[Union[torch.Tensor,None]]) -> torch.Tensor:
+        """Reverse diffusion process starting from white noise
+
+        Args:
+            context (List[Union[torch.Tensor,None]]): output of `_context`
+
+        Returns:
+            torch.Tensor: generated sequence [batch_size, future_steps, num_var, 1]
+        """
+        y_past, emb_cat_past, emb_cat_fut, aux_emb_num_past, aux_emb_num_fut = context
+        batch_size = y_past.shape[0]
 
-        if self.aux_past_channels>0: # if we have more numerical variables about past
-            aux_num_past = self.remove_var(num_past, idx_target, 2) # remove the autoregressive variable
-            assert self.aux_past_channels == aux_num_past.size(2),  beauty_string(f"{self.aux_past_channels} LAYERS FOR PAST VARS AND {aux_num_past.size(2)} VARS",'section',True) # to check if we are using the expected number of variables about past
-            # concat all embedded vars and mean of them
-            aux_emb_num_past = torch.Tensor().to(self.device)
-            for i, layer in enumerate(self.linear_aux_past):
-                aux_emb_past = layer(aux_num_past[:,:,[i]]).unsqueeze(2)
-                aux_emb_num_past = torch.cat((aux_emb_num_past, aux_emb_past), dim=2)
-            aux_emb_num_past = torch.mean(aux_emb_num_past, dim = 2)
-        else: 
-            aux_emb_num_past = None # non available vars
-            
-        if self.aux_fut_channels>0: # if we have more numerical variables about future
-            # AUX means AUXILIARY variables
-            aux_num_fut = batch['x_num_future'].to(self.device)
-            assert self.aux_fut_channels == aux_num_fut.size(2), beauty_string(f"{self.aux_fut_channels} LAYERS FOR PAST VARS AND {aux_num_fut.size(2)} VARS",'section',True)  # to check if we are using the expected number of variables about fut
-            # concat all embedded vars and mean of them
-            aux_emb_num_fut = torch.Tensor().to(self.device)
-            for j, layer in enumerate(self.linear_aux_fut):
-                aux_emb_fut = layer(aux_num_fut[:,:,[j]]).unsqueeze(2)
-                aux_emb_num_fut = torch.cat((aux_emb_num_fut, aux_emb_fut), dim=2)
-            aux_emb_num_fut = torch.mean(aux_emb_num_fut, dim = 2)
-        else:
-            aux_emb_num_fut = None # non available vars
-        
         # DIFFUSION INFERENCE
         # import pdb; pdb.set_trace() # can use also torch.normal(0, 1, size=y_noised.shape)
         y_noised = torch.randn((batch_size, self.future_steps, self.output_channels)).to(self.device)
+
+        # strided reverse process: only the subnets of the selected steps are used, the skipped steps are merged (coef_y=1 and coef_eps=0 if there are no skipped steps)
+        if self.inference_steps is not None:
+            schedule = self.inference_schedule(self.inference_steps)
+        else:
+            schedule = [(t, 1.0, 0.0) for t in range(self.T-1, -1, -1)]
+
         # pass the white noise in sub nets
-        for t in range(self.T-1, -1, -1): # INVERSE cycle over all subnets, but not the last one
+        for t, coef_y, coef_eps in schedule: # INVERSE cycle over all subnets, but not the last one
             sub_net = self.sub_nets[t] # load the subnet
 
             ## CHECK THE NUMBER OF PARAMS
@@ -403,6 +369,8 @@ class Diffusion(Base):
             # Sample x_{t-1} from the model at the given timestep.
             # y_noised = self._extract_into_tensor(1/np.sqrt(self.alphas), t, y_noised.shape)*( y_noised - self._extract_into_tensor(np.sqrt(self.betas), t, eps_pred.shape)*eps_pred )
             y_noised = 1/torch.sqrt(1-post_sigma)*(y_noised - torch.sqrt(post_sigma)*eps_pred)
+            if coef_eps != 0.0:
+                y_noised = coef_y*y_noised + coef_eps*eps_pred
 
             # if t>0 :
             #     noise = torch.rand_like(y_noised).to(self.device)
@@ -411,12 +379,78 @@ class Diffusion(Base):
         out = y_noised.view(-1, self.future_steps, self.output_channels, 1)
         return out
 
+    def inference_schedule(self, inference_steps:int)-> List[tuple]:
+        """Steps of the reverse process on a strided subset of the diffusion steps.
+        At each selected step t the sample is updated as in the standard reverse process (with the learned variance if learn_var=True),
+        then the noise predicted by the subnet t is considered constant until the next selected step s (s<t) and the updates 
+        y = (y - sqrt(posterior_variance_k)*eps_pred)/sqrt(1-posterior_variance_k) of the skipped steps k = t-1, ..., s+1 are merged in coef_y*y + coef_eps*eps_pred.
+        With inference_steps=diffusion_steps there are no skipped steps and the process is the standard one.
+
+        Args:
+            inference_steps (int): number of steps, evenly spaced between T-1 and 0
+
+        Returns:
+            List[tuple]: (t, coef_y, coef_eps) from the first step of the reverse process to the last one
+        """
+        steps = np.unique(np.round(np.linspace(0, self.T-1, min(inference_steps, self.T))).astype(int))[::-1]
+        res = []
+        for i, t in enumerate(steps):
+            s = steps[i+1] if i+1<len(steps) else -1
+            coef_y, coef_eps = 1.0, 0.0
+            for k in range(t-1, s, -1):
+                coef_y /= np.sqrt(1-self.posterior_variance[k])
+                coef_eps = (coef_eps - np.sqrt(self.posterior_variance[k]))/np.sqrt(1-self.posterior_variance[k])
+            res.append((int(t), float(coef_y), float(coef_eps)))
+        return res
+
     # for validation extract the output from the self.inference method
     def validation_step(self, batch, batch_idx):
         out = self.inference(batch)
         loss = self.compute_loss(batch,out)
         return loss
 
+    def _context(self, batch:dict)-> List[Union[torch.Tensor,None]]:
+        """Past target, embedded categorical variables and embedded auxiliary numerical variables. They do not depend on the diffusion step
+        so they are computed once for all the subnets
+
+        Args:
+            batch (dict): Keys checked ['x_num_past, 'idx_target', 'x_num_future', 'x_cat_past', 'x_cat_future']
+
+        Returns:
+            List[torch.Tensor]: y_past, emb_cat_past, emb_cat_fut, aux_emb_num_past, aux_emb_num_fut (the last two are None if not available)
+        """
+        # LOADING AUTOREGRESSIVE CONTEXT OF TARGET VARIABLES
+        num_past = batch['x_num_past'].to(self.device)
+        idx_target = batch['idx_target'][0]
+        y_past = num_past[:,:,idx_target]
+
+        # LOADING EMBEDDING CATEGORICAL VARIABLES
+        emb_cat_past, emb_cat_fut = self.cat_categorical_vars(batch)
+        emb_cat_past = torch.mean(emb_cat_past, dim = 2)
+        emb_cat_fut = torch.mean(emb_cat_fut, dim = 2)
+
+        ### LOADING PAST AND FUTURE NUMERICAL VARIABLES
+        # load in the model auxiliar numerical variables
+
+        if self.aux_past_channels>0: # if we have more numerical variables about past
+            aux_num_past = self.remove_var(num_past, idx_target, 2) # remove the autoregressive variable
+            assert self.aux_past_channels == aux_num_past.size(2),  beauty_string(f"{self.aux_past_channels} LAYERS FOR PAST VARS AND {aux_num_past.size(2)} VARS",'section',True) # to check if we are using the expected number of variables about past
+            # embed all vars at once and mean of them
+            aux_emb_num_past = torch.mean(self.linear_aux_past(aux_num_past), dim = 2)
+        else: 
+            aux_emb_num_past = None # non available vars
+            
+        if self.aux_fut_channels>0: # if we have more numerical variables about future
+            # AUX means AUXILIARY variables
+            aux_num_fut = batch['x_num_future'].to(self.device)
+            assert self.aux_fut_channels == aux_num_fut.size(2), beauty_string(f"{self.aux_fut_channels} LAYERS FOR PAST VARS AND {aux_num_fut.size(2)} VARS",'section',True)  # to check if we are using the expected number of variables about fut
+            # embed all vars at once and mean of them
+            aux_emb_num_fut = torch.mean(self.linear_aux_fut(aux_num_fut), dim = 2)
+        else:
+            aux_emb_num_fut = None # non available vars
+
+        return [y_past, emb_cat_past, emb_cat_fut, aux_emb_num_past, aux_emb_num_fut]
+
     # function to concat embedded categorical variables
     def cat_categorical_vars(self, batch:dict):
         """Extracting categorical context about past and future
@@ -438,10 +472,6 @@ class Diffusion(Base):
         else:
             emb_cat_full = self.emb_cat_var(batch['x_num_past'].shape[0],self.device)
 
-        # CONCAT THEM, according to self.emb_cat_var usage  
-        cat_full = torch.cat((cat_past, cat_fut), dim = 1)
-        # actual embedding
-        emb_cat_full = self.emb_cat_var(cat_full,self.device)
         # split past and future categorical embedded variables
         cat_emb_past = emb_cat_full[:,:self.past_steps,:,:]
         cat_emb_fut = emb_cat_full[:,-self.future_steps:,:,:]
@@ -205,15 +205,9 @@ class RNN(Base):
             torch.tensor: result
         """
         x =  batch['x_num_past'].to(self.device)
-
-        if 'x_cat_future' in batch.keys():
-            cat_future = batch['x_cat_future'].to(self.device)
-        if 'x_cat_past' in batch.keys():
-            cat_past = batch['x_cat_past'].to(self.device)
-        if 'x_num_future' in batch.keys():
-            x_future = batch['x_num_future'].to(self.device)
-        else:
-            x_future = None
+        cat_past = batch['x_cat_past'].to(self.device) if 'x_cat_past' in batch.keys() else None
+        cat_future = batch['x_cat_future'].to(self.device) if 'x_cat_future' in batch.keys() else None
+        x_future = batch['x_num_future'].to(self.device) if 'x_num_future' in batch.keys() else None
         
         if self.remove_last:
             idx_target = batch['idx_target'][0]
@@ -222,6 +216,19 @@ class RNN(Base):
             ##BxC
             x[:,:,idx_target]-=x_start        
         
+        out, hidden = self.Encoder(self.conv_encoder(self._encoder_input(x,cat_past)))      
+        res = self._decode(out[:,-1:,:],hidden,cat_future,x_future)
+        
+        if self.remove_last:
+            res+=x_start.unsqueeze(1)
+      
+        return res
+
+    def _encoder_input(self,x:torch.tensor,cat_past:Union[torch.tensor,None])->torch.tensor:
+        """Input of the convolutional encoder, each row depends only on the same past step
+
+        :meta private:
+        """
         tmp = [self.initial_linear_encoder(x)]
         
         tmp_emb = None
@@ -235,11 +242,15 @@ class RNN(Base):
                 tmp.append(self.embs[i](cat_past[:,:,i]))
         if self.sum_emb and (len(self.embs)>0):
             tmp.append(tmp_emb)
-        tot = torch.cat(tmp,2)
+        return torch.cat(tmp,2)
 
-        out, hidden = self.Encoder(self.conv_encoder(tot))      
+    def _decode(self,last_out:torch.tensor,hidden,cat_future:Union[torch.tensor,None],x_future:Union[torch.tensor,None])->torch.tensor:
+        """Decoder part of the model given the state of the encoder and its last output
 
+        :meta private:
+        """
         tmp = []
+        tmp_emb = None
         for i in range(len(self.embs)):
             if self.sum_emb:
                 if i>0:
@@ -257,7 +268,7 @@ class RNN(Base):
         if len(tmp)>0:
             tot = torch.cat(tmp,2)
         else:
-            tot = out
+            tot = last_out
         out, _ = self.Decoder(self.conv_decoder(tot[:,-1:,:].repeat(1,self.future_steps,1)),hidden)  
         res = []
 
@@ -268,11 +279,79 @@ class RNN(Base):
         res = torch.cat(res,2)
         ##BxLxC
         B,L,_ = res.shape
-        res = res.reshape(B,L,-1,self.mul)
-        
-        if self.remove_last:
-            res+=x_start.unsqueeze(1)
-      
-        return res
+        return res.reshape(B,L,-1,self.mul)
 
-    
\ No newline at end of file
+    @staticmethod
+    def _copy_hidden(hidden):
+        """The xLSTM replaces the states of its blocks in the list it receives, the stored state must not be modified
+
+        :meta private:
+        """
+        return list(hidden) if isinstance(hidden,list) else hidden
+
+    def init_state(self,batch:dict)->dict:
+        """Stateful inference: encode the past of a batch and return the state of the encoder. New observations are added with `update_state`
+        and `stateful_inference` runs only the decoder, so that the cost of each forecast does not depend on the length of the past.
+        The state summarizes all the steps seen since `init_state`: the forecast is the same of `forward` on the whole history
+        (call again `init_state` on the last window to restart from the training context length). It is not available with `remove_last=True`
+        since in this case all the past steps depend on the last one.
+
+        Args:
+            batch (dict): batch with the past (`x_num_past` and `x_cat_past`)
+
+        Returns:
+            dict: the state
+        """
+        assert not self.remove_last, beauty_string('Stateful inference is not available with remove_last=True','section',True)
+        state = {'hidden':None,'out':None,'inputs':None,'steps':0}
+        return self.update_state(state,batch['x_num_past'],batch.get('x_cat_past',None))
+
+    def update_state(self,state:dict,x_num:torch.tensor,x_cat:Union[torch.tensor,None]=None)->dict:
+        """Advance the state with the new past steps. The convolution before the encoder uses `kernel_size//2` steps after each position:
+        the last ones are not absorbed in the state until the following steps arrive, they are encoded for each forecast
+
+        Args:
+            state (dict): the state (see `init_state`), it is not modified
+            x_num (torch.tensor): new numerical past variables (B x M x past_channels)
+            x_cat (Union[torch.tensor,None], optional): new categorical variables (B x M x len(embs)). Defaults to None.
+
+        Returns:
+            dict: the new state
+        """
+        kernel_size = self.conv_encoder[1].kernel_size[0]
+        right = kernel_size//2
+        with torch.no_grad():
+            new = self._encoder_input(x_num.to(self.device),None if x_cat is None else x_cat.to(self.device))
+            inputs = new if state['inputs'] is None else torch.cat([state['inputs'],new],1)
+            steps = state['steps']+new.shape[1]
+            ##position in the stream of the first stored input
+            start = steps-inputs.shape[1]
+            first = max(state['steps']-right,0)
+            last = max(steps-right,0)
+            hidden, out = state['hidden'], state['out']
+            if last>first:
+                out, hidden = self.Encoder(self.conv_encoder(inputs)[:,first-start:last-start],self._copy_hidden(hidden))
+                out = out[:,-1:,:]
+        ##inputs needed by the convolution of the positions not yet absorbed
+        return {'hidden':hidden,'out':out,'inputs':inputs[:,inputs.shape[1]-min(kernel_size-1,inputs.shape[1]):],'steps':steps}
+
+    def stateful_inference(self,state:dict,batch:dict)->torch.tensor:
+        """Forecast from a state (see `init_state`)
+
+        Args:
+            state (dict): the state, it is not modified
+            batch (dict): batch with the future variables (`x_num_future` and `x_cat_future`)
+
+        Returns:
+            torch.tensor: same output of `inference`
+        """
+        right = self.conv_encoder[1].kernel_size[0]//2
+        hidden, out = state['hidden'], state['out']
+        with torch.no_grad():
+            tail = min(right,state['steps'])
+            if tail>0:
+                out, hidden = self.Encoder(self.conv_encoder(state['inputs'])[:,-tail:,:],self._copy_hidden(hidden))
+                out = out[:,-1:,:]
+            cat_future = batch['x_cat_future'].to(self.device) if 'x_cat_future' in batch.keys() else None
+            x_future = batch['x_num_future'].to(self.device) if 'x_num_future' in batch.keys() else None
+            return self._decode(out,self._copy_hidden(hidden),cat_future,x_future)
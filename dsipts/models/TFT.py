@@ -79,12 +79,12 @@ class TFT(Base):
         self.target_linear = nn.Linear(out_channels, d_model) # same for past and fut! (same variable)
         # number of variables in the past different from the target one(s)
         self.aux_past_channels = past_channels - out_channels # -1 because one channel is occupied by the target variable
-        # one linear for each auxiliar past var
-        self.linear_aux_past = nn.ModuleList([nn.Linear(1, d_model) for _ in range(self.aux_past_channels)])
+        # one linear for each auxiliar past var (computed all together)
+        self.linear_aux_past = sub_nn.embedding_num_variables(self.aux_past_channels, d_model)
         # number of variables in the future used to predict the target one(s)
         self.aux_fut_channels = future_channels
-        # one linear for each auxiliar future var
-        self.linear_aux_fut = nn.ModuleList([nn.Linear(1, d_model) for _ in range(self.aux_fut_channels)])
+        # one linear for each auxiliar future var (computed all together)
+        self.linear_aux_fut = sub_nn.embedding_num_variables(self.aux_fut_channels, d_model)
         # length of the full sequence, parameter used for the embedding of all categorical variables
         # - we assume that these are no available or available both for past and future
         seq_len = past_steps+future_steps
@@ -182,10 +182,7 @@ class TFT(Base):
             # AUX = AUXILIARY variables
             aux_num_past = self.remove_var(num_past, idx_target, 2) # remove the target index on the second dimension
             assert self.aux_past_channels == aux_num_past.size(2), beauty_string(f"{self.aux_past_channels} LAYERS FOR PAST VARS AND {aux_num_past.shape(2)} VARS",'section',True) # to check if we are using the expected number of variables about past
-            aux_emb_num_past = torch.Tensor().to(aux_num_past.device)
-            for i, layer in enumerate(self.linear_aux_past):
-                aux_emb_past = layer(aux_num_past[:,:,[i]]).unsqueeze(2)
-                aux_emb_num_past = torch.cat((aux_emb_num_past, aux_emb_past), dim=2)
+            aux_emb_num_past = self.linear_aux_past(aux_num_past)
             ## update summary about past
             summary_past = torch.cat((summary_past, aux_emb_num_past), dim=2)
         
@@ -193,10 +190,7 @@ class TFT(Base):
         if self.aux_fut_channels>0: # so we have more numerical variables about future
             aux_num_fut = batch['x_num_future'].to(self.device)
             assert self.aux_fut_channels == aux_num_fut.size(2), beauty_string(f"{self.aux_fut_channels} LAYERS FOR PAST VARS AND {aux_num_fut.size(2)} VARS",'section',True)  # to check if we are using the expected number of variables about fut
-            aux_emb_num_fut = torch.Tensor().to(aux_num_fut.device)
-            for j, layer in enumerate(self.linear_aux_fut):
-                aux_emb_fut = layer(aux_num_fut[:,:,[j]]).unsqueeze(2)
-                aux_emb_num_fut = torch.cat((aux_emb_num_fut, aux_emb_fut), dim=2)
+            aux_emb_num_fut = self.linear_aux_fut(aux_num_fut)
             ## update summary about future
             summary_fut = torch.cat((summary_fut, aux_emb_num_fut), dim=2)
  
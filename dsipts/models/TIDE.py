@@ -99,11 +99,11 @@ class TIDE(Base):
 
         # for other numerical variables in the past
         self.aux_past_channels = past_channels - out_channels
-        self.linear_aux_past = nn.ModuleList([nn.Linear(1, self.hidden_size) for _ in range(self.aux_past_channels)])
+        self.linear_aux_past = sub_nn.embedding_num_variables(self.aux_past_channels, self.hidden_size)
 
         # for numerical variables in the future
         self.aux_fut_channels = future_channels
-        self.linear_aux_fut = nn.ModuleList([nn.Linear(1, self.hidden_size) for _ in range(self.aux_fut_channels)])
+        self.linear_aux_fut = sub_nn.embedding_num_variables(self.aux_fut_channels, self.hidden_size)
         
         # embedding categorical for both past and future (ASSUMING BOTH AVAILABLE OR NO ONE)
         self.seq_len = past_steps + future_steps
@@ -167,12 +167,8 @@ class TIDE(Base):
         if self.aux_past_channels>0: # if we have more numerical variables about past
             aux_num_past = self.remove_var(num_past, idx_target, 2) # remove the autoregressive variable
             assert self.aux_past_channels == aux_num_past.size(2),  beauty_string(f"{self.aux_past_channels} LAYERS FOR PAST VARS AND {aux_num_past.size(2)} VARS",'section',True) # to check if we are using the expected number of variables about past
-            # concat all embedded vars and mean of them
-            aux_emb_num_past = torch.Tensor().to(self.device)
-            for i, layer in enumerate(self.linear_aux_past):
-                aux_emb_past = layer(aux_num_past[:,:,[i]]).unsqueeze(2)
-                aux_emb_num_past = torch.cat((aux_emb_num_past, aux_emb_past), dim=2)
-            aux_emb_num_past = torch.mean(aux_emb_num_past, dim = 2)
+            # embed all vars at once and mean of them
+            aux_emb_num_past = torch.mean(self.linear_aux_past(aux_num_past), dim = 2)
         else: 
             aux_emb_num_past = None # non available vars
             
@@ -180,12 +176,8 @@ class TIDE(Base):
             # AUX means AUXILIARY variables
             aux_num_fut = batch['x_num_future'].to(self.device)
             assert self.aux_fut_channels == aux_num_fut.size(2), beauty_string(f"{self.aux_fut_channels} LAYERS FOR PAST VARS AND {aux_num_fut.size(2)} VARS",'section',True)  # to check if we are using the expected number of variables about fut
-            # concat all embedded vars and mean of them
-            aux_emb_num_fut = torch.Tensor().to(self.device)
-            for j, layer in enumerate(self.linear_aux_fut):
-                aux_emb_fut = layer(aux_num_fut[:,:,[j]]).unsqueeze(2)
-                aux_emb_num_fut = torch.cat((aux_emb_num_fut, aux_emb_fut), dim=2)
-            aux_emb_num_fut = torch.mean(aux_emb_num_fut, dim = 2)
+            # embed all vars at once and mean of them
+            aux_emb_num_fut = torch.mean(self.linear_aux_fut(aux_num_fut), dim = 2)
         else:
             aux_emb_num_fut = None # non available vars
 
@@ -8,9 +8,8 @@ import torch
 from torch.nn import functional as F
 from .base import Base
 from typing import List, Union
-from .vva.minigpt import Block
+from .vva.minigpt import Block, generate
 from .vva.vqvae import VQVAE
-import logging
 from random import random
 from ..data_structure.utils import beauty_string
 from .utils import  get_scope
@@ -43,6 +42,8 @@ class VQVAEA(Base):
                  n_heads:int,
                  out_channels:int,
                  epoch_vqvae: int,
+                 jitter:float=0.0,
+                 record_codebook_stats:bool=False,
                  persistence_weight:float=0.0,
                  loss_type: str='l1',
                  quantiles:List[int]=[],
@@ -58,6 +59,8 @@ class VQVAEA(Base):
             past_channels (int): number of numeric past variables, must be >0
             future_channels (int): number of future numeric variables 
             embs (List): list of the initial dimension of the categorical variables
+            jitter (float, optional): probability of replacing a latent vector with one of its neighbors before the decoder during the training (0.12 in the paper). Defaults to 0 (no jitter).
+            record_codebook_stats (bool, optional): if True the quantizer computes the distances between latent vectors and codebook entries at each forward and stores them in `self.vqvae._vq_vae.codebook_stats` (see `codebook_statistics`). Defaults to False.
             cat_emb_dim (int): final dimension of each categorical variable
             hidden_RNN (int): hidden size of the RNN block
             num_layers_RNN (int): number of RNN layers
@@ -91,7 +94,7 @@ class VQVAEA(Base):
         ##PRIMA VQVAE
         assert out_channels==1, beauty_string('Working only for one singal','section',True)
         assert past_steps%2==0 and future_steps%2==0, beauty_string('There are some issue with the deconder in case of odd length','section',True)
-        self.vqvae = VQVAE(in_channels=1, hidden_channels=hidden_channels,out_channels=1,num_embeddings= max_voc_size,embedding_dim=d_model,commitment_cost=commitment_cost,decay=decay  )
+        self.vqvae = VQVAE(in_channels=1, hidden_channels=hidden_channels,out_channels=1,num_embeddings= max_voc_size,embedding_dim=d_model,commitment_cost=commitment_cost,decay=decay,jitter=jitter,record_codebook_stats=record_codebook_stats)
         
         ##POI GPT
 
@@ -132,19 +135,21 @@ class VQVAEA(Base):
        
 
         
-    def gpt(self,tokens):
-    
+    def gpt(self,tokens,caches=None,start=0):
+        """
+        Logits of the tokens, with the key/value caches (one for each block) the tokens are the continuation of the cached ones starting from the position start
+        """
     
         b, t = tokens.size()
-        assert t <= self.block_size, beauty_string("Cannot forward sequence of length {t}, block size is only {self.block_size}",'section',True)
-        pos = torch.arange(0, t, dtype=torch.long, device=self.device).unsqueeze(0) # shape (1, t)
+        assert start+t <= self.block_size, beauty_string(f"Cannot forward sequence of length {start+t}, block size is only {self.block_size}",'section',True)
+        pos = torch.arange(start, start+t, dtype=torch.long, device=self.device).unsqueeze(0) # shape (1, t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(tokens) # token embeddings of shape (b, t, n_embd)
         pos_emb = self.transformer.wpe(pos) # position embeddings of shape (1, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        for i,block in enumerate(self.transformer.h):
+            x = block(x, None if caches is None else caches[i])
         x = self.transformer.ln_f(x)
         logits = self.transformer.lm_head(x)
         return logits
@@ -181,8 +186,9 @@ class VQVAEA(Base):
                 _, _, _,quantized_y,encodings_y = self.vqvae(batch['y'].permute(0,2,1))
             
             ##GPT
-            tokens = torch.cat([encodings_x.argmax(dim=2),encodings_y.argmax(dim=2)[:,0:-1]],1)
-            tokens_y = torch.cat([encodings_x.argmax(dim=2)[:,0:-1],encodings_y.argmax(dim=2)],1)
+            ##the encodings are the indices of the codebook entries (B x L)
+            tokens = torch.cat([encodings_x,encodings_y[:,0:-1]],1)
+            tokens_y = torch.cat([encodings_x[:,0:-1],encodings_y],1)
             tokens_y[:,0:encodings_x.shape[1]-1] = -1
             logits = self.gpt(tokens)
             loss_gpt = F.cross_entropy(logits.view(-1, logits.size(-1)),tokens_y.view(-1), ignore_index=-1)
@@ -190,10 +196,8 @@ class VQVAEA(Base):
             
             ##adesso devo ricostruire la y perche' e quello che voglio come output
             with torch.no_grad():
-                encoding_indices = torch.argmax(logits.reshape(-1,self.max_voc_size), dim=1).unsqueeze(1) ##
-                encodings = torch.zeros(encoding_indices.shape[0], self.vqvae._vq_vae._num_embeddings, device=self.device)
-                encodings.scatter_(1, encoding_indices, 1)
-                quantized = torch.matmul(encodings, self.vqvae._vq_vae._embedding.weight).view(data.shape[0],-1,self.d_model) ##B x L x hidden
+                encoding_indices = torch.argmax(logits, dim=2)
+                quantized = self.vqvae._vq_vae._embedding(encoding_indices) ##B x L x hidden
                 quantized = quantized.permute(0, 2, 1).contiguous()
                 y_hat = self.vqvae._decoder(quantized,False).squeeze()[:,-self.future_steps:]
             
@@ -227,62 +231,21 @@ class VQVAEA(Base):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
+        All the samples are generated in a single batch and each new token uses the key/value cache of the previous ones (see `vva.minigpt.generate`).
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
         """
-        assert do_sample is False,logging.info('NOT IMPLEMENTED YET')
-        if do_sample:
-            
-            idx = idx.repeat(num_samples,1,1)
-            for _ in range(max_new_tokens):
-                tmp = []
-                for i in range(num_samples):
-                    idx_cond = idx[i,:,:] if idx.size(2) <= self.block_size else idx[i,:, -self.block_size:]
-                    logits = self.gpt(idx_cond)
-                    logits = logits[:, -1, :] / temperature
-                    if top_k is not None:
-                        v, _ = torch.topk(logits, top_k)
-                        logits[logits < v[:, [-1]]] = -float('Inf')
-                    probs = F.softmax(logits, dim=-1)
-                    idx_next = torch.multinomial(probs, num_samples=1, replacement=True)
-                    tmp.append(idx_next)
-                tmp = torch.cat(tmp,dim=1).T.unsqueeze(2)
-                idx = torch.cat((idx, tmp), dim=2)
-            return idx
-        else:
-            for _ in range(max_new_tokens):
-                
-                # if the sequence context is growing too long we must crop it at block_size
-                idx_cond = idx if idx.size(1) <= self.block_size else idx[:, -self.block_size:]
-                # forward the model to get the logits for the index in the sequence
-                logits = self.gpt(idx_cond)
-                # pluck the logits at the final step and scale by desired temperature
-                logits = logits[:, -1, :] / temperature
-                # optionally crop the logits to only the top k options
-                if top_k is not None:
-                    v, _ = torch.topk(logits, top_k)
-                    logits[logits < v[:, [-1]]] = -float('Inf')
-                # apply softmax to convert logits to (normalized) probabilities
-                probs = F.softmax(logits, dim=-1)
-                # either sample from the distribution or take the most likely element
-                _, idx_next = torch.topk(probs, k=1, dim=-1)
-                # append sampled index to the running sequence and continue
-                idx = torch.cat((idx, idx_next), dim=1)
-
-            return idx
+        return generate(self.gpt, idx, max_new_tokens, self.block_size, len(self.transformer.h), temperature=temperature, do_sample=do_sample, top_k=top_k, num_samples=num_samples)
 
     def inference(self, batch:dict)->torch.tensor:
 
         idx_target = batch['idx_target'][0]
         data = batch['x_num_past'][:,:,idx_target].to(self.device)
         vq_loss, data_recon, perplexity,quantized_x,encodings_x = self.vqvae(data.permute(0,2,1))
-        x = encodings_x.argmax(dim=2)
+        x = encodings_x
         inp = x[:, :self.sentence_length]
         # let the model sample the rest of the sequence
         cat = self.generate(inp, self.sentence_length, do_sample=False) # non riesco a gestirla qui :-)
-        encoding_indices = cat.flatten().unsqueeze(1) ##
-        encodings = torch.zeros(encoding_indices.shape[0], self.vqvae._vq_vae._num_embeddings, device=self.device)
-        encodings.scatter_(1, encoding_indices, 1)
-        quantized = torch.matmul(encodings, self.vqvae._vq_vae._embedding.weight).view(x.shape[0],-1,self.d_model) ##B x L x hidden
+        quantized = self.vqvae._vq_vae._embedding(cat) ##B x L x hidden
         quantized = quantized.permute(0, 2, 1).contiguous()
         y_hat = self.vqvae._decoder(quantized,False).squeeze()[:,-self.future_steps:]
 
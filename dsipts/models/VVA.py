@@ -3,7 +3,7 @@ from torch import  nn
 import torch
 from .base import Base
 from typing import List, Union
-from .vva.minigpt import Block
+from .vva.minigpt import Block, generate
 import math
 from torch.nn import functional as F
 from ..data_structure.utils import beauty_string
@@ -163,16 +163,22 @@ class VVA(Base):
 
 
     def forward(self, batch):
-        b, t = batch['x_emb'].size()
-        assert t <= self.block_size, beauty_string("Cannot forward sequence of length {t}, block size is only {self.block_size}",'section',True)
-        pos = torch.arange(0, t, dtype=torch.long, device=self.device).unsqueeze(0) # shape (1, t)
+        return self.gpt(batch['x_emb'])
+
+    def gpt(self, tokens, caches=None, start=0):
+        """
+        Logits of the tokens, with the key/value caches (one for each block) the tokens are the continuation of the cached ones starting from the position start
+        """
+        b, t = tokens.size()
+        assert start+t <= self.block_size, beauty_string(f"Cannot forward sequence of length {start+t}, block size is only {self.block_size}",'section',True)
+        pos = torch.arange(start, start+t, dtype=torch.long, device=self.device).unsqueeze(0) # shape (1, t)
 
         # forward the GPT model itself
-        tok_emb = self.transformer.wte(batch['x_emb']) # token embeddings of shape (b, t, n_embd)
+        tok_emb = self.transformer.wte(tokens) # token embeddings of shape (b, t, n_embd)
         pos_emb = self.transformer.wpe(pos) # position embeddings of shape (1, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        for i,block in enumerate(self.transformer.h):
+            x = block(x, None if caches is None else caches[i])
         x = self.transformer.ln_f(x)
         logits = self.lm_head(x)
 
@@ -183,46 +189,11 @@ class VVA(Base):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
+        All the samples are generated in a single batch and each new token uses the key/value cache of the previous ones (see `vva.minigpt.generate`).
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
         """
-        if do_sample:
-            idx = idx.repeat(num_samples,1,1)
-            for _ in range(max_new_tokens):
-                tmp = []
-                for i in range(num_samples):
-                    idx_cond = idx[i,:,:] if idx.size(2) <= self.block_size else idx[i,:, -self.block_size:]
-                    logits = self({'x_emb':idx_cond})
-                    logits = logits[:, -1, :] / temperature
-                    if top_k is not None:
-                        v, _ = torch.topk(logits, top_k)
-                        logits[logits < v[:, [-1]]] = -float('Inf')
-                    probs = F.softmax(logits, dim=-1)
-                    idx_next = torch.multinomial(probs, num_samples=1, replacement=True)
-                    tmp.append(idx_next)
-                tmp = torch.cat(tmp,dim=1).T.unsqueeze(2)
-                idx = torch.cat((idx, tmp), dim=2)
-            return idx
-        else:
-            for _ in range(max_new_tokens):
-                
-                # if the sequence context is growing too long we must crop it at block_size
-                idx_cond = idx if idx.size(1) <= self.block_size else idx[:, -self.block_size:]
-                # forward the model to get the logits for the index in the sequence
-                logits = self({'x_emb':idx_cond})
-                # pluck the logits at the final step and scale by desired temperature
-                logits = logits[:, -1, :] / temperature
-                # optionally crop the logits to only the top k options
-                if top_k is not None:
-                    v, _ = torch.topk(logits, top_k)
-                    logits[logits < v[:, [-1]]] = -float('Inf')
-                # apply softmax to convert logits to (normalized) probabilities
-                probs = F.softmax(logits, dim=-1)
-                # either sample from the distribution or take the most likely element
-                _, idx_next = torch.topk(probs, k=1, dim=-1)
-                # append sampled index to the running sequence and continue
-                idx = torch.cat((idx, idx_next), dim=1)
-
-            return idx.unsqueeze(0)
+        idx = generate(self.gpt, idx, max_new_tokens, self.block_size, len(self.transformer.h), temperature=temperature, do_sample=do_sample, top_k=top_k, num_samples=num_samples)
+        return idx if do_sample else idx.unsqueeze(0)
 
     def inference(self, batch:dict)->torch.tensor:
         x = batch['x_emb'].to(self.device)
@@ -2,41 +2,15 @@
 from torch import optim
 import torch
 import pytorch_lightning as pl
+from typing import List, Union
 from torch.optim.lr_scheduler import StepLR
 from abc import  abstractmethod
-from .utils import SinkhornDistance, SoftDTWBatch,PathDTWBatch,pairwise_distances
+from .losses import get_loss, LossContext, standardize_momentum, dilate_loss
 from ..data_structure.utils import beauty_string
 from .utils import  get_scope
 import numpy as np
 from aim import Image
 import matplotlib.pyplot as plt
-def standardize_momentum(x,order):
-    mean = torch.mean(x,1).unsqueeze(1).repeat(1,x.shape[1],1)
-    num = torch.pow(x-mean,order).mean(axis=1)
-    den = torch.sqrt(torch.pow(x-mean,2).mean(axis=1)+1e-8)
-    den = torch.pow(den,order)
-    
-    return num/den
-
-
-def dilate_loss(outputs, targets, alpha, gamma, device):
-	# outputs, targets: shape (batch_size, N_output, 1)
-	batch_size, N_output = outputs.shape[0:2]
-	loss_shape = 0
-	softdtw_batch = SoftDTWBatch.apply
-	D = torch.zeros((batch_size, N_output,N_output )).to(device)
-	for k in range(batch_size):
-		Dk = pairwise_distances(targets[k,:,:].view(-1,1),outputs[k,:,:].view(-1,1))
-		D[k:k+1,:,:] = Dk     
-	loss_shape = softdtw_batch(D,gamma)
-	
-	path_dtw = PathDTWBatch.apply
-	path = path_dtw(D,gamma)           
-	Omega =  pairwise_distances(torch.range(1,N_output).view(N_output,1)).to(device)
-	loss_temporal =  torch.sum( path*Omega ) / (N_output*N_output) 
-	loss = alpha*loss_shape+ (1-alpha)*loss_temporal
-	return loss#, loss_shape, loss_temporal
-
 
 class Base(pl.LightningModule):
     
@@ -46,12 +20,18 @@ class Base(pl.LightningModule):
     handle_categorical_variables = False
     handle_quantile_loss = False
     description = get_scope(handle_multivariate,handle_future_covariates,handle_categorical_variables,handle_quantile_loss)
+    ##set it to True if the inference method uses autograd (it can not be executed in inference mode)
+    inference_requires_grad = False
     #####################################################################
     @abstractmethod
-    def __init__(self,verbose:bool):
+    def __init__(self,verbose:bool,loss_kwargs:Union[dict,None]=None):
         """
         This is the basic model, each model implemented must overwrite the init method and the forward method. The inference step is optional, by default it uses the forward method but for recurrent 
         network you should implement your own method
+
+        Args:
+            verbose (bool): verbosity
+            loss_kwargs (Union[dict,None], optional): additional parameters of the custom loss selected with `loss_type` (e.g. `{'max_iter':50,'check_every':5}` for sinkhorn). Defaults to None.
         """
         
         super(Base, self).__init__()
@@ -61,6 +41,8 @@ class Base(pl.LightningModule):
         self.train_loss_epoch = -100.0
         self.verbose = verbose
         self.name = self.__class__.__name__
+        self.loss_kwargs = dict(loss_kwargs) if loss_kwargs is not None else {}
+        self.custom_loss = None
         beauty_string(self.description,'info',True)
     @abstractmethod
     def forward(self, batch:dict)-> torch.tensor:
@@ -93,6 +75,39 @@ class Base(pl.LightningModule):
             torch.tensor: result
         """
         return self(batch)
+
+    def sample(self, batch:dict, num_samples:int)->torch.tensor:
+        """Monte Carlo samples of the prediction, useful for the stochastic models (e.g. Diffusion, D3VAE). The batch is repeated `num_samples` times along the batch dimension
+        and all the trajectories are computed with a single call of `inference` (the sample k of the element b is in position k*B+b)
+
+        Args:
+            batch (dict): batch
+            num_samples (int): number of samples for each element of the batch
+
+        Returns:
+            torch.tensor: samples [num_samples, B, L, C]
+        """
+        B = batch['x_num_past'].shape[0]
+        batch = {k:v.repeat(num_samples,*[1]*(v.dim()-1)) if isinstance(v,torch.Tensor) else v for k,v in batch.items()}
+        out = self.inference(batch)
+        ##the median if the model predicts the quantiles
+        out = out[:,:,:,1] if self.use_quantiles else out[:,:,:,0]
+        return out.reshape(num_samples,B,*out.shape[1:])
+
+    def sample_quantiles(self, batch:dict, num_samples:int=100, quantiles:List[float]=[0.1,0.5,0.9])->torch.tensor:
+        """Quantiles of the Monte Carlo samples (see `sample`), computed on the device of the model
+
+        Args:
+            batch (dict): batch
+            num_samples (int, optional): number of samples for each element of the batch. Defaults to 100.
+            quantiles (List[float], optional): quantiles, with three values the output has the same format of the models trained with the quantile loss (low, median, high). Defaults to [0.1,0.5,0.9].
+
+        Returns:
+            torch.tensor: quantiles [B, L, C, Q]
+        """
+        samples = self.sample(batch,num_samples)
+        q = torch.tensor(quantiles,dtype=samples.dtype,device=samples.device)
+        return torch.quantile(samples,q,dim=0).permute(1,2,3,0)
         
     def configure_optimizers(self):
         """
@@ -185,6 +200,37 @@ class Base(pl.LightningModule):
 
         self.train_loss_epoch = loss.item()
 
+    @property
+    def loss_type(self)->Union[str,None]:
+        """Name of the loss, setting it (together with `persistence_weight`) creates the associated custom loss"""
+        return getattr(self,'_loss_type',None)
+
+    @loss_type.setter
+    def loss_type(self,loss_type:Union[str,None]):
+        self._loss_type = loss_type
+        self.set_custom_loss()
+
+    @property
+    def persistence_weight(self)->float:
+        """Weight of the custom part of the loss"""
+        return getattr(self,'_persistence_weight',0.0)
+
+    @persistence_weight.setter
+    def persistence_weight(self,persistence_weight:float):
+        self._persistence_weight = persistence_weight
+        self.set_custom_loss()
+
+    def set_custom_loss(self):
+        """
+        Create the custom loss (see `dsipts.models.losses`) associated to `loss_type`. It is done once in the init of the model, as soon as both `loss_type` and `persistence_weight` are set
+
+        :meta private:
+        """
+        if '_loss_type' not in self.__dict__ or '_persistence_weight' not in self.__dict__:
+            return
+        loss = get_loss(self.loss_type)
+        self.custom_loss = loss(self.persistence_weight,**self.loss_kwargs) if loss is not None else None
+
     def compute_loss(self,batch,y_hat):
         """
         custom loss calculation
@@ -196,85 +242,14 @@ class Base(pl.LightningModule):
             initial_loss = self.loss(y_hat[:,:,:,0], batch['y'])
         else:
             initial_loss = self.loss(y_hat, batch['y'])
-        x =  batch['x_num_past'].to(self.device)
-        idx_target = batch['idx_target'][0]
-        x_start = x[:,-1,idx_target].unsqueeze(1)
-        y_persistence = x_start.repeat(1,self.future_steps,1)
-        #y_persistence =  batch['y'].to(self.device).mean(axis=1).unsqueeze(1).repeat(1,self.future_steps,1) ##quello che fa meno errori e' la media
+        custom_loss = self.custom_loss
+        if custom_loss is None:
+            return initial_loss
         
         ##generally you want to work without quantile loss
         if self.use_quantiles is False:
             x = y_hat[:,:,:,0]
         else:
             x = y_hat[:,:,:,1]
-        
-
-        if self.loss_type == 'linear_penalization':
-            persistence_error = self.persistence_weight*(2.0-10.0*torch.clamp( torch.abs((y_persistence-x)/(0.001+torch.abs(y_persistence))),min=0.0,max=0.1))
-            loss = torch.mean(torch.abs(x- batch['y'])*persistence_error)
-        
-        if self.loss_type == 'mda':
-            mda =  (1-torch.mean( torch.sign(torch.diff(x,axis=1))*torch.sign(torch.diff(batch['y'],axis=1)).flatten()))
-            loss =  torch.mean( torch.abs(x-batch['y']).mean(axis=1).flatten()) + self.persistence_weight*mda
-            
-            
-        
-        elif self.loss_type == 'exponential_penalization':
-            weights = (1+self.persistence_weight*torch.exp(-torch.abs(y_persistence-x)))
-            loss =  torch.mean(torch.abs(x- batch['y'])*weights)
-         
-        elif self.loss_type=='sinkhorn':
-            sinkhorn = SinkhornDistance(eps=0.1, max_iter=100, reduction='mean')
-            loss = sinkhorn.compute(x,batch['y'])
-
-            
-        elif self.loss_type == 'additive_iv':
-            std = torch.sqrt(torch.var(batch['y'], dim=(1))+ 1e-8) ##--> BSxChannel
-            x_std = torch.sqrt(torch.var(x, dim=(1))+ 1e-8)
-            loss = torch.mean( torch.abs(x-batch['y']).mean(axis=1).flatten() + self.persistence_weight*torch.abs(x_std-std).mean(axis=1).flatten())
-            
-        elif self.loss_type == 'multiplicative_iv':
-            std = torch.sqrt(torch.var(batch['y'], dim=(1))+ 1e-8) ##--> BSxChannel
-            x_std = torch.sqrt(torch.var(x, dim=(1))+ 1e-8)
-            if self.persistence_weight>0:
-                loss = torch.mean( torch.abs(x-batch['y']).mean(axis=1).flatten()*torch.abs(x_std-std).mean(axis=1).flatten())   
-            else:
-                loss = torch.mean( torch.abs(x-batch['y']).mean(axis=1).flatten())   
-        elif self.loss_type=='global_iv':
-            std_real = torch.sqrt(torch.var(batch['y'], dim=(0,1)))
-            std_predict = torch.sqrt(torch.var(x, dim=(0,1)))
-            loss = initial_loss +  self.persistence_weight*torch.abs(std_real-std_predict)
-
-        elif self.loss_type=='smape':
-            loss = torch.mean(2*torch.abs(x-batch['y']) / (torch.abs(x)+torch.abs(batch['y'])))
-            
-        elif self.loss_type=='triplet':
-            loss_fn = torch.nn.TripletMarginLoss(margin=0.1, p=1.0,swap=False)
-            loss = initial_loss +  self.persistence_weight*loss_fn(x, batch['y'], y_persistence)
-                
-        elif self.loss_type=='high_order':
-            loss = initial_loss
-            for i in range(2,5):
-                mom_real = standardize_momentum( batch['y'],i)
-                mom_pred = standardize_momentum(x,i)
-                mom_loss = torch.abs(mom_real-mom_pred).mean()
-                loss+=self.persistence_weight*mom_loss
-            
-        elif self.loss_type=='dilated':
-            #BxLxCxMUL
-            alpha = 0.5
-            gamma = 0.01
-            loss = 0
-            ##no multichannel here
-            for i in range(y_hat.shape[2]):
-                ##error here
-                
-                loss+= dilate_loss( batch['y'][:,:,i:i+1],x[:,:,i:i+1], alpha, gamma, y_hat.device)
-            
-            
-        else:
-            loss = initial_loss
-
-
-
-        return loss
\ No newline at end of file
+        context = LossContext(batch,x,self.future_steps,custom_loss.use_persistence)
+        return custom_loss(x,batch['y'],initial_loss,context)
\ No newline at end of file
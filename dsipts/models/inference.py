@@ -0,0 +1,268 @@
+import torch
+import torch.multiprocessing as mp
+import numpy as np
+import os
+import time
+import traceback
+import queue
+from functools import partial
+from typing import Union, Iterable, List
+from torch.utils.data import DataLoader, Dataset, Subset
+from .base import Base
+from ..data_structure.utils import beauty_string, collate_batch
+
+ENGINES = ['eager','compile','script']
+
+
+def move_batch(batch:dict,device:torch.device,non_blocking:bool=True)->dict:
+    """Move all the tensors of a batch to the device at once. If the device is a GPU the tensors are copied (non blocking) from pinned memory
+    so that the copies overlap with the computation; the `.to(self.device)` calls inside the `forward` methods then become no-ops.
+
+    Args:
+        batch (dict): the batch
+        device (torch.device): target device
+        non_blocking (bool, optional): use asynchronous copies. Defaults to True.
+
+    Returns:
+        dict: the batch on the device
+    """
+    non_blocking = non_blocking and device.type=='cuda'
+    res = {}
+    for k,v in batch.items():
+        if isinstance(v,torch.Tensor):
+            if non_blocking and not v.is_pinned() and v.device.type=='cpu':
+                v = v.pin_memory()
+            res[k] = v.to(device,non_blocking=non_blocking)
+        else:
+            res[k] = v
+    return res
+
+
+class InferenceEngine():
+
+    def __init__(self,model:Base,
+                 engine:str='eager',
+                 device:Union[str,torch.device,None]=None,
+                 inference_mode:bool=True,
+                 non_blocking:bool=True,
+                 num_samples:Union[int,None]=None,
+                 quantiles:List[float]=[0.1,0.5,0.9],
+                 verbose:bool=False):
+        """Execute the `inference` method of a model without building the autograd graph and moving each batch to the device with a single transfer.
+
+        Args:
+            model (Base): the model
+            engine (str, optional): `eager` (standard execution), `compile` (`torch.compile`, requires torch>=2) or `script` (TorchScript).
+                If the model can not be compiled the eager execution is used. Defaults to 'eager'.
+            device (Union[str,torch.device,None], optional): device, if None a GPU is used if available. Defaults to None.
+            inference_mode (bool, optional): if True `torch.inference_mode` is used otherwise `torch.no_grad`. The models with `inference_requires_grad=True` (e.g. D3VAE) are executed with the autograd enabled. Defaults to True.
+            non_blocking (bool, optional): see `move_batch`. Defaults to True.
+            num_samples (Union[int,None], optional): if not None the output is given by the quantiles of `num_samples` Monte Carlo samples (see `Base.sample_quantiles`), it makes sense for the stochastic models (e.g. Diffusion, D3VAE). The samples are computed in eager mode. Defaults to None.
+            quantiles (List[float], optional): quantiles used if num_samples is not None. Defaults to [0.1,0.5,0.9].
+            verbose (bool, optional): verbose. Defaults to False.
+        """
+        assert engine in ENGINES, f'engine must be one of {ENGINES}'
+        if device is None:
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.model = model
+        self.model.eval()
+        self.model.to(self.device)
+        self.inference_mode = inference_mode
+        self.non_blocking = non_blocking
+        self.verbose = verbose
+        self.engine = engine
+        self.num_samples = num_samples
+        self.quantiles = quantiles
+        self._fn = self._build(engine)
+
+    def _build(self,engine:str):
+        """
+        The function called for each batch
+
+        :meta private:
+        """
+        if self.num_samples is not None:
+            if engine!='eager':
+                beauty_string('The Monte Carlo samples are computed in eager mode','info',self.verbose)
+                self.engine = 'eager'
+            return partial(self.model.sample_quantiles,num_samples=self.num_samples,quantiles=self.quantiles)
+        if engine=='compile':
+            if not hasattr(torch,'compile'):
+                beauty_string('torch.compile requires torch>=2, using eager mode','info',self.verbose)
+                self.engine = 'eager'
+                return self.model.inference
+            return torch.compile(self.model.inference)
+        if engine=='script':
+            try:
+                return torch.jit.script(self.model).inference
+            except Exception as e:
+                beauty_string(f'Can not script {self.model.name} ({e.__class__.__name__}), using eager mode','info',self.verbose)
+                self.engine = 'eager'
+        return self.model.inference
+
+    def _context(self):
+        """
+        :meta private:
+        """
+        if getattr(self.model,'inference_requires_grad',False):
+            return torch.enable_grad()
+        return torch.inference_mode() if self.inference_mode else torch.no_grad()
+
+    def __call__(self,batch:dict)->torch.tensor:
+        """Prediction of a batch
+
+        Args:
+            batch (dict): the batch (on CPU or on the device)
+
+        Returns:
+            torch.tensor: the output of the `inference` method of the model
+        """
+        batch = move_batch(batch,self.device,self.non_blocking)
+        with self._context():
+            try:
+                return self._fn(batch)
+            except Exception as e:
+                if self.engine=='eager':
+                    raise e
+                ##some models can be compiled but fail at runtime (e.g. graph breaks with data dependent shapes)
+                beauty_string(f'{self.engine} failed for {self.model.name} ({e.__class__.__name__}), using eager mode','info',self.verbose)
+                self.engine = 'eager'
+                self._fn = self.model.inference
+                return self._fn(batch)
+
+
+def benchmark_inference(model:Base,
+                        batches:Iterable[dict],
+                        engine:str='eager',
+                        warmup:int=2,
+                        n_batches:Union[int,None]=None,
+                        device:Union[str,torch.device,None]=None,
+                        inference_mode:bool=True)->dict:
+    """Throughput of the inference of a model
+
+    Args:
+        model (Base): the model
+        batches (Iterable[dict]): the batches (e.g. a DataLoader)
+        engine (str, optional): see `InferenceEngine`. Defaults to 'eager'.
+        warmup (int, optional): number of batches not timed (compilation, allocation of the cache). Defaults to 2.
+        n_batches (Union[int,None], optional): maximum number of timed batches, if None all the batches are used (except the last one if it is smaller). Defaults to None.
+        device (Union[str,torch.device,None], optional): see `InferenceEngine`. Defaults to None.
+        inference_mode (bool, optional): see `InferenceEngine`. Defaults to True.
+
+    Returns:
+        dict: model, engine (the one actually used), device, samples, seconds and samples/s
+    """
+    runner = InferenceEngine(model,engine=engine,device=device,inference_mode=inference_mode)
+    samples = 0
+    seconds = 0.0
+    batch_size = None
+    for i,batch in enumerate(batches):
+        if n_batches is not None and i>=n_batches+warmup:
+            break
+        if batch_size is None:
+            batch_size = batch['y'].shape[0]
+        elif batch['y'].shape[0]!=batch_size:
+            ##the last (smaller) batch triggers a new compilation, it is not a steady state measure
+            continue
+        if runner.device.type=='cuda':
+            torch.cuda.synchronize(runner.device)
+        t0 = time.perf_counter()
+        runner(batch)
+        if runner.device.type=='cuda':
+            torch.cuda.synchronize(runner.device)
+        if i>=warmup:
+            seconds+=time.perf_counter()-t0
+            samples+=batch['y'].shape[0]
+    return {'model':model.name,
+            'engine':runner.engine,
+            'device':str(runner.device),
+            'samples':samples,
+            'seconds':seconds,
+            'samples/s':samples/seconds if seconds>0 else float('nan')}
+
+
+def _inference_worker(rank:int,model:Base,dataset:Dataset,indexes:np.array,batch_size:int,num_threads:int,engine:str,queue)->None:
+    """Inference of a shard in a worker process, the result (or the error) is sent back with the queue
+
+    :meta private:
+    """
+    try:
+        torch.set_num_threads(num_threads)
+        dl = DataLoader(Subset(dataset,indexes), batch_size=batch_size, shuffle=False,drop_last=False,num_workers=0,collate_fn=collate_batch)
+        runner = InferenceEngine(model,engine=engine,device='cpu')
+        res = []
+        real = []
+        for batch in dl:
+            res.append(runner(batch).detach().numpy())
+            real.append(batch['y'].numpy())
+        queue.put((rank,np.vstack(res),np.vstack(real),None))
+    except Exception as _:
+        queue.put((rank,None,None,traceback.format_exc()))
+
+
+def parallel_inference(model:Base,
+                       dataset:Dataset,
+                       shards:List[np.array],
+                       batch_size:int=100,
+                       num_threads:Union[int,None]=None,
+                       engine:str='eager',
+                       start_method:Union[str,None]=None)->tuple:
+    """CPU inference of a dataset with one process for each shard. The weights of the model are placed in shared memory so that all the processes read the same copy
+
+    Args:
+        model (Base): the model
+        dataset (Dataset): the dataset
+        shards (List[np.array]): indexes of the samples of each shard (see `shard_indices`)
+        batch_size (int, optional): batch size of each process. Defaults to 100.
+        num_threads (Union[int,None], optional): torch threads of each process, if None the cores are divided among the processes. Defaults to None.
+        engine (str, optional): see `InferenceEngine`. Defaults to 'eager'.
+        start_method (Union[str,None], optional): multiprocessing start method, if None `fork` is used if available (the dataset is not copied) otherwise `spawn`. Defaults to None.
+
+    Returns:
+        tuple: predictions and real values of all the samples in the order of the dataset
+    """
+    if num_threads is None:
+        num_threads = max(1,(os.cpu_count() or 1)//len(shards))
+    if start_method is None:
+        start_method = 'fork' if 'fork' in mp.get_all_start_methods() else 'spawn'
+    model.eval()
+    model.to('cpu')
+    model.share_memory()
+    ctx = mp.get_context(start_method)
+    results = ctx.Queue()
+    processes = []
+    for rank,indexes in enumerate(shards):
+        p = ctx.Process(target=_inference_worker,args=(rank,model,dataset,indexes,batch_size,num_threads,engine,results),daemon=True)
+        p.start()
+        processes.append(p)
+
+    ##the queue must be emptied before joining the processes
+    outputs = {}
+    errors = []
+    while len(outputs)<len(processes):
+        try:
+            rank,res,real,error = results.get(timeout=1)
+        except queue.Empty:
+            ##a process killed without sending its result (e.g. out of memory)
+            for rank,p in enumerate(processes):
+                if rank not in outputs and not p.is_alive() and p.exitcode!=0 and results.empty():
+                    for q in processes:
+                        q.terminate()
+                    raise RuntimeError(f'Parallel inference failed: process {rank} exited with code {p.exitcode}')
+            continue
+        if error is not None:
+            errors.append(error)
+        outputs[rank] = (res,real)
+    for p in processes:
+        p.join()
+    if len(errors)>0:
+        raise RuntimeError('Parallel inference failed:\n'+errors[0])
+
+    res = np.vstack([outputs[i][0] for i in range(len(shards))])
+    real = np.vstack([outputs[i][1] for i in range(len(shards))])
+    ##back to the order of the dataset
+    order = np.concatenate(shards)
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(len(order))
+    return res[inverse],real[inverse]
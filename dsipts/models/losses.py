@@ -0,0 +1,279 @@
+import torch
+from torch import nn
+from typing import Union
+from .utils import SinkhornDistance, SoftDTWBatch, PathDTWBatch
+from ..data_structure.utils import beauty_string
+
+
+LOSSES = {}
+
+def register_loss(name:str,loss:Union[type,None]=None):
+    """Register a custom loss so that it can be selected with `loss_type=name` in all the models.
+    It can be used as a function `register_loss('my_loss',MyLoss)` or as a class decorator `@register_loss('my_loss')`.
+    The loss must be a subclass of `CustomLoss`
+
+    Args:
+        name (str): name of the loss (the `loss_type` parameter of the models)
+        loss (Union[type,None], optional): class of the loss. Defaults to None (decorator usage).
+
+    Returns:
+        the class of the loss (or the decorator)
+    """
+    def _register(cls):
+        assert issubclass(cls,CustomLoss), 'The loss must be a subclass of CustomLoss'
+        LOSSES[name] = cls
+        return cls
+    if loss is None:
+        return _register
+    return _register(loss)
+
+
+def get_loss(name:str)->Union[type,None]:
+    """Class of a registered loss
+
+    Args:
+        name (str): name of the loss
+
+    Returns:
+        Union[type,None]: the class of the loss or None if the loss is not registered (the standard loss of the model is used)
+    """
+    return LOSSES.get(name,None)
+
+
+def standardize_momentum(x,order):
+    mean = torch.mean(x,1).unsqueeze(1).repeat(1,x.shape[1],1)
+    num = torch.pow(x-mean,order).mean(axis=1)
+    den = torch.sqrt(torch.pow(x-mean,2).mean(axis=1)+1e-8)
+    den = torch.pow(den,order)
+
+    return num/den
+
+
+def dilate_loss(outputs, targets, alpha, gamma, device):
+	# outputs, targets: shape (batch_size, N_output, 1)
+	batch_size, N_output = outputs.shape[0:2]
+	loss_shape = 0
+	softdtw_batch = SoftDTWBatch.apply
+	##squared distances of all the batch at once
+	D = torch.cdist(targets.reshape(batch_size,N_output,-1),outputs.reshape(batch_size,N_output,-1))**2
+	loss_shape = softdtw_batch(D,gamma)
+
+	path_dtw = PathDTWBatch.apply
+	path = path_dtw(D,gamma)
+	steps = torch.arange(1,N_output+1,dtype=D.dtype,device=D.device)
+	Omega =  (steps.view(-1,1)-steps.view(1,-1))**2
+	loss_temporal =  torch.sum( path*Omega ) / (N_output*N_output)
+	loss = alpha*loss_shape+ (1-alpha)*loss_temporal
+	return loss#, loss_shape, loss_temporal
+
+
+class LossContext():
+
+    def __init__(self,batch:dict,x:torch.tensor,future_steps:int,persistence:bool):
+        """Intermediate quantities shared by the custom losses, computed only once per step and only if used
+
+        Args:
+            batch (dict): the batch
+            x (torch.tensor): prediction BxLxC (the median in the case of quantile loss)
+            future_steps (int): number of future steps
+            persistence (bool): if True the persistence baseline is computed
+        """
+        self.x = x
+        self.y = batch['y']
+        self._abs_error = None
+        self._moments = {}
+        if persistence:
+            ##last observed value of the targets, expanded (not copied) along the future steps
+            x_start = batch['x_num_past'][:,-1,batch['idx_target'][0]].unsqueeze(1).to(x.device)
+            self.y_persistence = x_start.expand(-1,future_steps,-1)
+        else:
+            self.y_persistence = None
+
+    @property
+    def abs_error(self)->torch.tensor:
+        """
+        Returns:
+            torch.tensor: |x-y| BxLxC
+        """
+        if self._abs_error is None:
+            self._abs_error = torch.abs(self.x-self.y)
+        return self._abs_error
+
+    def standardized_moment(self,name:str,order:int)->torch.tensor:
+        """Same of `standardize_momentum` but the centered series and the standard deviation are computed once for all the orders
+
+        Args:
+            name (str): 'x' or 'y'
+            order (int): order of the moment
+
+        Returns:
+            torch.tensor: standardized moment BxC
+        """
+        if name not in self._moments:
+            t = self.x if name=='x' else self.y
+            centered = t-torch.mean(t,1).unsqueeze(1)
+            std = torch.sqrt(torch.pow(centered,2).mean(axis=1)+1e-8)
+            self._moments[name] = (centered,std)
+        centered,std = self._moments[name]
+        return torch.pow(centered,order).mean(axis=1)/torch.pow(std,order)
+
+
+class CustomLoss(nn.Module):
+    ##set it to True if the loss uses `context.y_persistence`
+    use_persistence = False
+
+    def __init__(self,persistence_weight:float=0.0):
+        """Base class of the custom losses (see `register_loss`). The losses are created once in the init of the model, 
+        with `persistence_weight` and the `loss_kwargs` of the model as parameters
+
+        Args:
+            persistence_weight (float, optional): weight of the custom part of the loss. Defaults to 0.0.
+        """
+        super().__init__()
+        self.persistence_weight = persistence_weight
+
+    def forward(self,x:torch.tensor,y:torch.tensor,initial_loss:torch.tensor,context:LossContext)->torch.tensor:
+        """Compute the loss
+
+        Args:
+            x (torch.tensor): prediction BxLxC (the median in the case of quantile loss)
+            y (torch.tensor): target BxLxC
+            initial_loss (torch.tensor): the standard loss of the model (L1, MSE or quantile)
+            context (LossContext): shared intermediate quantities
+
+        Returns:
+            torch.tensor: the loss
+        """
+        raise NotImplementedError
+
+
+@register_loss('linear_penalization')
+class LinearPenalization(CustomLoss):
+    def forward(self,x,y,initial_loss,context):
+        ##as in the original if/elif chain, where the penalized loss was overwritten by the final else
+        return initial_loss
+
+
+@register_loss('weighted_linear_penalization')
+class WeightedLinearPenalization(CustomLoss):
+    use_persistence = True
+    def __init__(self,persistence_weight:float=0.0):
+        """Opt-in version of `linear_penalization` that really applies the penalization: absolute error weighted by 
+        `persistence_weight*(2-10*clip(|y_persistence-x|/|y_persistence|,0,0.1))`, so the weights are in [persistence_weight, 2*persistence_weight]
+        and they are larger when the prediction is close to the persistence model. The scale of the loss depends on `persistence_weight`,
+        with `persistence_weight=0` the loss would be identically zero: in this case the standard loss is used.
+
+        Args:
+            persistence_weight (float, optional): scale of the weights. Defaults to 0.0.
+        """
+        super().__init__(persistence_weight)
+        if self.persistence_weight==0:
+            beauty_string('weighted_linear_penalization requires persistence_weight>0, using the standard loss','info',True)
+            self.use_persistence = False
+    def forward(self,x,y,initial_loss,context):
+        if self.persistence_weight==0:
+            return initial_loss
+        persistence_error = self.persistence_weight*(2.0-10.0*torch.clamp( torch.abs((context.y_persistence-x)/(0.001+torch.abs(context.y_persistence))),min=0.0,max=0.1))
+        return torch.mean(context.abs_error*persistence_error)
+
+
+@register_loss('mda')
+class MDA(CustomLoss):
+    def forward(self,x,y,initial_loss,context):
+        mda =  (1-torch.mean( torch.sign(torch.diff(x,axis=1))*torch.sign(torch.diff(y,axis=1)).flatten()))
+        return torch.mean( context.abs_error.mean(axis=1).flatten()) + self.persistence_weight*mda
+
+
+@register_loss('exponential_penalization')
+class ExponentialPenalization(CustomLoss):
+    use_persistence = True
+    def forward(self,x,y,initial_loss,context):
+        weights = (1+self.persistence_weight*torch.exp(-torch.abs(context.y_persistence-x)))
+        return torch.mean(context.abs_error*weights)
+
+
+@register_loss('sinkhorn')
+class Sinkhorn(CustomLoss):
+    def __init__(self,persistence_weight:float=0.0,eps:float=0.1,max_iter:int=100,**kwargs):
+        """Sinkhorn divergence between the prediction and the target
+
+        Args:
+            persistence_weight (float, optional): not used. Defaults to 0.0.
+            eps (float, optional): regularization coefficient. Defaults to 0.1.
+            max_iter (int, optional): maximum number of iterations. Defaults to 100.
+            kwargs: other parameters of `SinkhornDistance` (thresh, check_every, per_sample, fixed_iter)
+        """
+        super().__init__(persistence_weight)
+        ##see SinkhornDistance for the parameters (and last_iterations)
+        self.sinkhorn = SinkhornDistance(eps=eps, max_iter=max_iter, reduction='mean', **kwargs)
+    def forward(self,x,y,initial_loss,context):
+        return self.sinkhorn.compute(x,y)
+
+
+@register_loss('additive_iv')
+class AdditiveIV(CustomLoss):
+    def forward(self,x,y,initial_loss,context):
+        std = torch.sqrt(torch.var(y, dim=(1))+ 1e-8) ##--> BSxChannel
+        x_std = torch.sqrt(torch.var(x, dim=(1))+ 1e-8)
+        return torch.mean( context.abs_error.mean(axis=1).flatten() + self.persistence_weight*torch.abs(x_std-std).mean(axis=1).flatten())
+
+
+@register_loss('multiplicative_iv')
+class MultiplicativeIV(CustomLoss):
+    def forward(self,x,y,initial_loss,context):
+        if self.persistence_weight>0:
+            std = torch.sqrt(torch.var(y, dim=(1))+ 1e-8) ##--> BSxChannel
+            x_std = torch.sqrt(torch.var(x, dim=(1))+ 1e-8)
+            return torch.mean( context.abs_error.mean(axis=1).flatten()*torch.abs(x_std-std).mean(axis=1).flatten())
+        return torch.mean( context.abs_error.mean(axis=1).flatten())
+
+
+@register_loss('global_iv')
+class GlobalIV(CustomLoss):
+    def forward(self,x,y,initial_loss,context):
+        std_real = torch.sqrt(torch.var(y, dim=(0,1)))
+        std_predict = torch.sqrt(torch.var(x, dim=(0,1)))
+        return initial_loss +  self.persistence_weight*torch.abs(std_real-std_predict)
+
+
+@register_loss('smape')
+class SMAPE(CustomLoss):
+    def forward(self,x,y,initial_loss,context):
+        return torch.mean(2*context.abs_error / (torch.abs(x)+torch.abs(y)))
+
+
+@register_loss('triplet')
+class Triplet(CustomLoss):
+    use_persistence = True
+    def __init__(self,persistence_weight:float=0.0):
+        super().__init__(persistence_weight)
+        self.loss_fn = nn.TripletMarginLoss(margin=0.1, p=1.0,swap=False)
+    def forward(self,x,y,initial_loss,context):
+        return initial_loss +  self.persistence_weight*self.loss_fn(x, y, context.y_persistence)
+
+
+@register_loss('high_order')
+class HighOrder(CustomLoss):
+    def forward(self,x,y,initial_loss,context):
+        loss = initial_loss
+        for i in range(2,5):
+            mom_real = context.standardized_moment('y',i)
+            mom_pred = context.standardized_moment('x',i)
+            mom_loss = torch.abs(mom_real-mom_pred).mean()
+            loss = loss + self.persistence_weight*mom_loss
+        return loss
+
+
+@register_loss('dilated')
+class Dilated(CustomLoss):
+    def __init__(self,persistence_weight:float=0.0,alpha:float=0.5,gamma:float=0.01):
+        super().__init__(persistence_weight)
+        self.alpha = alpha
+        self.gamma = gamma
+    def forward(self,x,y,initial_loss,context):
+        #BxLxCxMUL
+        loss = 0
+        ##no multichannel here
+        for i in range(x.shape[2]):
+            loss+= dilate_loss( y[:,:,i:i+1],x[:,:,i:i+1], self.alpha, self.gamma, x.device)
+        return loss
@@ -70,11 +70,52 @@ class embedding_cat_variables(nn.Module):
         return is_fut
     
     def get_cat_n_embd(self, cat_vars):
-        cat_n_embd = torch.Tensor().to(cat_vars.device)
-        for index, layer in enumerate(self.cat_n_embd):
-            emb = layer(cat_vars[:, :, index])
-            cat_n_embd = torch.cat((cat_n_embd, emb.unsqueeze(2)),dim=2)
-        return cat_n_embd
+        cat_n_embd = [layer(cat_vars[:, :, index]) for index, layer in enumerate(self.cat_n_embd)]
+        return torch.stack(cat_n_embd, dim=2)
+
+class embedding_num_variables(nn.Module):
+    def __init__(self, num_vars: int, d_model: int):
+        """Class for embedding numerical variables: each variable has its own linear layer (1 -> d_model),
+        all of them are computed at once as a grouped linear with stacked weights
+
+        Args:
+            num_vars (int): number of numerical variables
+            d_model (int): dimension of all variables after they are embedded
+        """
+        super().__init__()
+        self.num_vars = num_vars
+        self.weight = nn.Parameter(torch.empty(num_vars, d_model))
+        self.bias = nn.Parameter(torch.empty(num_vars, d_model))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same initialization (and random stream) of one nn.Linear(1, d_model) for each variable
+        with torch.no_grad():
+            for i in range(self.num_vars):
+                self.weight[i].uniform_(-1, 1)
+                self.bias[i].uniform_(-1, 1)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            x (torch.Tensor): [bs, seq_len, num_vars]
+
+        Returns:
+            torch.Tensor: [bs, seq_len, num_vars, n_embd]
+        """
+        return torch.addcmul(self.bias, x.unsqueeze(3), self.weight)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved with one nn.Linear for each variable (ModuleList), an empty ModuleList has no keys at all
+        old_keys = [f'{prefix}{i}.{k}' for i in range(self.num_vars) for k in ['weight', 'bias']]
+        if f'{prefix}weight' not in state_dict and all(k in state_dict for k in old_keys):
+            if self.num_vars == 0:
+                state_dict[f'{prefix}weight'] = torch.empty_like(self.weight)
+                state_dict[f'{prefix}bias'] = torch.empty_like(self.bias)
+            else:
+                state_dict[f'{prefix}weight'] = torch.stack([state_dict.pop(f'{prefix}{i}.weight').view(-1) for i in range(self.num_vars)])
+                state_dict[f'{prefix}bias'] = torch.stack([state_dict.pop(f'{prefix}{i}.bias') for i in range(self.num_vars)])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 class LSTM_Model(nn.Module):
     def __init__(self, num_var: int, d_model: int, pred_step: int, num_layers: int, dropout: float):
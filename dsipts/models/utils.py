@@ -2,8 +2,9 @@ import torch
 import torch.nn.init as init
 from torch import nn
 import numpy as np
-from numba import jit
+from numba import jit, prange
 from torch.autograd import Function
+from functools import lru_cache
 
 
 def get_scope(handle_multivariate,handle_future_covariates,handle_categorical_variables,handle_quantile_loss):
@@ -22,6 +23,10 @@ class SinkhornDistance():
     Given two empirical measures each with :math:`P_1` locations
     :math:`x\in\mathbb{R}^{D_1}` and :math:`P_2` locations :math:`y\in\mathbb{R}^{D_2}`,
     outputs an approximation of the regularized OT cost for point clouds.
+    The object can be reused across the training steps: the log-marginals are cached and the number of iterations 
+    of the last call (for each sample) is stored in `last_iterations` for tuning `eps` and `max_iter`.
+    When no gradient is required (e.g. validation) the cost matrix and the modified cost of the iterations are computed in place in a 
+    workspace reused by the calls with the same shape; with autograd every intermediate is kept for the backward pass, so no buffer is reused.
 
     Args:
         eps (float): regularization coefficient
@@ -30,20 +35,52 @@ class SinkhornDistance():
             'none' | 'mean' | 'sum'. 'none': no reduction will be applied,
             'mean': the sum of the output will be divided by the number of
             elements in the output, 'sum': the output will be summed. Default: 'none'
+        thresh (float, optional): stopping threshold on the update of the dual variable. Default: 0.1
+        check_every (int, optional): the convergence is checked (forcing a device synchronization) every `check_every` iterations,
+            so up to `check_every-1` iterations more than needed can be performed. Default: 10
+        per_sample (bool, optional): if True each sample of the batch stops updating when it converges and the loop ends when all the samples have converged,
+            otherwise the loop ends when the mean error of the batch is below `thresh`. Default: False
+        fixed_iter (bool, optional): if True exactly `max_iter` iterations are performed without checking the convergence (no synchronizations). Default: False
 
     Shape:
         - Input: :math:`(N, P_1, D_1)`, :math:`(N, P_2, D_2)`
         - Output: :math:`(N)` or :math:`()`, depending on `reduction`
     """
-    def __init__(self, eps, max_iter, reduction='none'):
+    def __init__(self, eps, max_iter, reduction='none', thresh=1e-1, check_every=10, per_sample=False, fixed_iter=False):
         super(SinkhornDistance, self).__init__()
         self.eps = eps
         self.max_iter = max_iter
         self.reduction = reduction
+        self.thresh = thresh
+        self.check_every = check_every
+        self.per_sample = per_sample
+        self.fixed_iter = fixed_iter
+        self.last_iterations = None
+        self._marginals = {}
+        self._workspace = None
+
+    def _log_marginals(self, batch_size, x_points, y_points, device):
+        "Log of the (uniform) marginals, cached by shape and device"
+        key = (batch_size, x_points, y_points, device)
+        if key not in self._marginals:
+            # both marginals are fixed with equal weights
+            mu = torch.empty(batch_size, x_points, dtype=torch.float).fill_(1.0 / x_points).squeeze().to(device)
+            nu = torch.empty(batch_size, y_points, dtype=torch.float).fill_(1.0 / y_points).squeeze().to(device)
+            self._marginals[key] = (torch.log(mu+1e-8), torch.log(nu+1e-8))
+        return self._marginals[key]
+
+    def _get_workspace(self, C):
+        "Buffer for the modified cost, reused across the calls with the same shape, device and type"
+        if self._workspace is None or self._workspace.shape != C.shape or self._workspace.device != C.device or self._workspace.dtype != C.dtype:
+            self._workspace = torch.empty_like(C)
+        return self._workspace
 
     def compute(self, x, y):
+        ## without autograd the intermediate matrices are computed in place
+        in_place = not (torch.is_grad_enabled() and (x.requires_grad or y.requires_grad))
         # The Sinkhorn algorithm takes as input three variables :
-        C = self._cost_matrix(x, y).to(x.device)  # Wasserstein cost function
+        C = self._cost_matrix(x, y, in_place=in_place).to(x.device)  # Wasserstein cost function
+        workspace = self._get_workspace(C) if in_place else None
         x_points = x.shape[-2]
         y_points = y.shape[-2]
         if x.dim() == 2:
@@ -51,36 +88,50 @@ class SinkhornDistance():
         else:
             batch_size = x.shape[0]
 
-        # both marginals are fixed with equal weights
-        mu = torch.empty(batch_size, x_points, dtype=torch.float,
-                         requires_grad=False).fill_(1.0 / x_points).squeeze().to(x.device)
-        nu = torch.empty(batch_size, y_points, dtype=torch.float,
-                         requires_grad=False).fill_(1.0 / y_points).squeeze().to(x.device)
-
-        u = torch.zeros_like(mu).to(x.device)
-        v = torch.zeros_like(nu).to(x.device)
-        # To check if algorithm terminates because of threshold
-        # or max iterations reached
-        actual_nits = 0
+        log_mu, log_nu = self._log_marginals(batch_size, x_points, y_points, x.device)
+        u = torch.zeros_like(log_mu)
+        v = torch.zeros_like(log_nu)
+        # number of iterations of each sample, it is updated on the device
+        iterations = torch.zeros(batch_size, dtype=torch.long, device=x.device)
+        active = torch.ones(batch_size, dtype=torch.bool, device=x.device)
         # Stopping criterion
-        thresh = 1e-1
+        thresh = self.thresh
 
         # Sinkhorn iterations
         for i in range(self.max_iter):
             u1 = u  # useful to check the update
-            u = self.eps * (torch.log(mu+1e-8) - torch.logsumexp(self.M(C, u, v), dim=-1)) + u
-            v = self.eps * (torch.log(nu+1e-8) - torch.logsumexp(self.M(C, u, v).transpose(-2, -1), dim=-1)) + v
-            err = (u - u1).abs().sum(-1).mean()
-
-            actual_nits += 1
-            if err.item() < thresh:
+            u_new = self.eps * (log_mu - torch.logsumexp(self.M(C, u, v, workspace), dim=-1)) + u
+            v_new = self.eps * (log_nu - torch.logsumexp(self.M(C, u_new, v, workspace).transpose(-2, -1), dim=-1)) + v
+            if self.per_sample:
+                ## converged samples are not updated anymore
+                mask = active.view((-1,)+(1,)*(u.dim()-1)) if u.dim()>1 else active
+                u = torch.where(mask, u_new, u)
+                v = torch.where(mask, v_new, v)
+            else:
+                u, v = u_new, v_new
+            iterations += active
+
+            if self.fixed_iter or (i+1) % self.check_every != 0:
+                continue
+            err = (u - u1).abs().sum(-1)
+            if self.per_sample:
+                active = active & (err.view(-1) >= thresh)
+                if not active.any().item():
+                    break
+            elif err.mean().item() < thresh:
                 break
+        self.last_iterations = iterations
 
         U, V = u, v
         # Transport plan pi = diag(a)*K*diag(b)
-        pi = torch.exp(self.M(C, U, V))
-        # Sinkhorn distance
-        cost = torch.sum(pi * C, dim=(-2, -1))
+        if in_place:
+            pi = self.M(C, U, V, workspace).exp_()
+            # Sinkhorn distance
+            cost = torch.sum(pi.mul_(C), dim=(-2, -1))
+        else:
+            pi = torch.exp(self.M(C, U, V))
+            # Sinkhorn distance
+            cost = torch.sum(pi * C, dim=(-2, -1))
 
         if self.reduction == 'mean':
             cost = cost.mean()
@@ -89,14 +140,20 @@ class SinkhornDistance():
 
         return cost#, pi, C
 
-    def M(self, C, u, v):
-        "Modified cost for logarithmic updates"
+    def M(self, C, u, v, out=None):
+        "Modified cost for logarithmic updates, computed in `out` if it is not None"
         "$M_{ij} = (-c_{ij} + u_i + v_j) / \epsilon$"
+        if out is not None:
+            return torch.neg(C, out=out).add_(u.unsqueeze(-1)).add_(v.unsqueeze(-2)).div_(self.eps)
         return (-C + u.unsqueeze(-1) + v.unsqueeze(-2)) / self.eps
 
     @staticmethod
-    def _cost_matrix(x, y, p=2):
+    def _cost_matrix(x, y, p=2, in_place=False):
         "Returns the matrix of $|x_i-y_j|^p$."
+        if p == 2 and x.dim() == 3:
+            ## no temporary NxP1xP2xD tensor
+            C = torch.cdist(x, y, compute_mode='donot_use_mm_for_euclid_dist')
+            return C.pow_(2) if in_place else C**2
         x_col = x.unsqueeze(-2)
         y_lin = y.unsqueeze(-3)
         C = torch.sum((torch.abs(x_col - y_lin)) ** p, -1)
@@ -351,41 +408,109 @@ def compute_softdtw_backward(D_, R, gamma):
   return E[1:N + 1, 1:M + 1]
  
 
+@lru_cache(maxsize=None)
+def antidiagonals(N:int,M:int,device:torch.device)->tuple:
+    """Indexes (starting from 1) of the anti-diagonals of a NxM matrix. The cells of an anti-diagonal depend only on the previous (next) ones 
+    in the DTW recursions so they can be computed together for all the batch (wavefront)
+
+    Args:
+        N (int): number of rows
+        M (int): number of columns
+        device (torch.device): device of the indexes
+
+    Returns:
+        tuple: tuple of (i,j) pairs of index tensors
+    """
+    res = []
+    for d in range(2,N+M+1):
+        i = torch.arange(max(1,d-M),min(N,d-1)+1,device=device)
+        res.append((i,d-i))
+    return tuple(res)
+
+
+def compute_softdtw_batch(D:torch.tensor,gamma:float)->torch.tensor:
+    """Batched version of `compute_softdtw`
+
+    Args:
+        D (torch.tensor): distance matrices BxNxM
+        gamma (float): smoothing parameter
+
+    Returns:
+        torch.tensor: the matrices R Bx(N+2)x(M+2) (float64)
+    """
+    B,N,M = D.shape
+    D = D.double()
+    R = torch.full((B,N+2,M+2),1e8,dtype=torch.float64,device=D.device)
+    R[:,0,0] = 0
+    for i,j in antidiagonals(N,M,D.device):
+        r = torch.stack([R[:,i-1,j-1],R[:,i-1,j],R[:,i,j-1]],-1)
+        R[:,i,j] = D[:,i-1,j-1] - gamma*torch.logsumexp(-r/gamma,-1)
+    return R
+
+
+def compute_softdtw_backward_batch(D_:torch.tensor,R:torch.tensor,gamma:float)->torch.tensor:
+    """Batched version of `compute_softdtw_backward`
+
+    Args:
+        D_ (torch.tensor): distance matrices BxNxM
+        R (torch.tensor): output of `compute_softdtw_batch`
+        gamma (float): smoothing parameter
+
+    Returns:
+        torch.tensor: the gradient BxNxM (float64)
+    """
+    B,N,M = D_.shape
+    D = torch.zeros((B,N+2,M+2),dtype=torch.float64,device=D_.device)
+    E = torch.zeros((B,N+2,M+2),dtype=torch.float64,device=D_.device)
+    D[:,1:N+1,1:M+1] = D_
+    E[:,-1,-1] = 1
+    R = R.clone()
+    R[:,:,-1] = -1e8
+    R[:,-1,:] = -1e8
+    R[:,-1,-1] = R[:,-2,-2]
+    for i,j in reversed(antidiagonals(N,M,D.device)):
+        a = torch.exp((R[:,i+1,j]-R[:,i,j]-D[:,i+1,j])/gamma)
+        b = torch.exp((R[:,i,j+1]-R[:,i,j]-D[:,i,j+1])/gamma)
+        c = torch.exp((R[:,i+1,j+1]-R[:,i,j]-D[:,i+1,j+1])/gamma)
+        E[:,i,j] = E[:,i+1,j]*a + E[:,i,j+1]*b + E[:,i+1,j+1]*c
+    return E[:,1:N+1,1:M+1]
+
+
+@jit(nopython = True, parallel = True)
+def compute_softdtw_batch_cpu(D, gamma):
+  R = np.zeros((D.shape[0], D.shape[1] + 2, D.shape[2] + 2))
+  for k in prange(D.shape[0]):
+    R[k] = compute_softdtw(D[k], gamma)
+  return R
+
+@jit(nopython = True, parallel = True)
+def compute_softdtw_backward_batch_cpu(D, R, gamma):
+  E = np.zeros(D.shape)
+  for k in prange(D.shape[0]):
+    E[k] = compute_softdtw_backward(D[k], R[k].copy(), gamma)
+  return E
+
 class SoftDTWBatch(Function):
     @staticmethod
     def forward(ctx, D, gamma = 1.0): # D.shape: [batch_size, N , N]
-        dev = D.device
-        batch_size,N,N = D.shape
-        gamma = torch.FloatTensor([gamma]).to(dev)
-        D_ = D.detach().cpu().numpy()
-        g_ = gamma.item()
-
-        total_loss = 0
-        R = torch.zeros((batch_size, N+2 ,N+2)).to(dev)   
-        for k in range(0, batch_size): # loop over all D in the batch    
-            Rk = torch.FloatTensor(compute_softdtw(D_[k,:,:], g_)).to(dev)
-            R[k:k+1,:,:] = Rk
-            total_loss = total_loss + Rk[-2,-2]
-        ctx.save_for_backward(D, R, gamma)
-        return total_loss / batch_size
+        ##all the batch is processed together: wavefront on the GPU, parallel numba kernels on the CPU
+        batch_size = D.shape[0]
+        if D.is_cuda:
+            R = compute_softdtw_batch(D.detach(),gamma)
+        else:
+            R = torch.from_numpy(compute_softdtw_batch_cpu(D.detach().double().numpy(),gamma))
+        ctx.save_for_backward(D, R)
+        ctx.gamma = gamma
+        return (R[:,-2,-2].sum()/batch_size).to(D.dtype)
   
     @staticmethod
     def backward(ctx, grad_output):
-        dev = grad_output.device
-        D, R, gamma = ctx.saved_tensors
-        batch_size,N,N = D.shape
-        D_ = D.detach().cpu().numpy()
-        R_ = R.detach().cpu().numpy()
-        g_ = gamma.item()
-
-        E = torch.zeros((batch_size, N ,N)).to(dev) 
-        for k in range(batch_size):         
-            Ek = torch.FloatTensor(compute_softdtw_backward(D_[k,:,:], R_[k,:,:], g_)).to(dev)
-            E[k:k+1,:,:] = Ek
-
-        return grad_output * E, None
-
-
+        D, R = ctx.saved_tensors
+        if D.is_cuda:
+            E = compute_softdtw_backward_batch(D.detach(),R,ctx.gamma)
+        else:
+            E = torch.from_numpy(compute_softdtw_backward_batch_cpu(D.detach().double().numpy(),R.numpy(),ctx.gamma))
+        return grad_output * E.to(D.dtype), None
 
 
 
@@ -478,41 +603,159 @@ def dtw_hessian_prod(theta, Z, Q, E, gamma):
     return V_dot[m, n], E_dot[1:m + 1, 1:n + 1]
 
 
+def dtw_grad_batch(theta:torch.tensor,gamma:float)->tuple:
+    """Batched version of `dtw_grad`
+
+    Args:
+        theta (torch.tensor): distance matrices BxNxM
+        gamma (float): smoothing parameter
+
+    Returns:
+        tuple: same outputs of `dtw_grad` with the batch as first dimension (float64)
+    """
+    B,m,n = theta.shape
+    theta = theta.double()
+    V = torch.zeros((B,m+1,n+1),dtype=torch.float64,device=theta.device)
+    V[:,:,0] = 1e10
+    V[:,0,:] = 1e10
+    V[:,0,0] = 0
+    Q = torch.zeros((B,m+2,n+2,3),dtype=torch.float64,device=theta.device)
+    diagonals = antidiagonals(m,n,theta.device)
+    for i,j in diagonals:
+        x = -torch.stack([V[:,i,j-1],V[:,i-1,j-1],V[:,i-1,j]],-1)/gamma
+        Q[:,i,j] = torch.softmax(x,-1)
+        V[:,i,j] = theta[:,i-1,j-1] - gamma*torch.logsumexp(x,-1)
+
+    E = torch.zeros((B,m+2,n+2),dtype=torch.float64,device=theta.device)
+    E[:,m+1,n+1] = 1
+    Q[:,m+1,n+1] = 1
+    for i,j in reversed(diagonals):
+        E[:,i,j] = Q[:,i,j+1,0]*E[:,i,j+1] + Q[:,i+1,j+1,1]*E[:,i+1,j+1] + Q[:,i+1,j,2]*E[:,i+1,j]
+    return V[:,m,n], E[:,1:m+1,1:n+1], Q, E
+
+
+def dtw_hessian_prod_batch(Z:torch.tensor,Q:torch.tensor,E:torch.tensor,gamma:float)->torch.tensor:
+    """Batched version of `dtw_hessian_prod`
+
+    Args:
+        Z (torch.tensor): direction NxM or BxNxM
+        Q (torch.tensor): output of `dtw_grad_batch`
+        E (torch.tensor): output of `dtw_grad_batch`
+        gamma (float): smoothing parameter
+
+    Returns:
+        torch.tensor: the hessian product BxNxM (float64)
+    """
+    B = Q.shape[0]
+    m,n = Z.shape[-2:]
+    Z = Z.double().expand(B,m,n)
+    V_dot = torch.zeros((B,m+1,n+1),dtype=torch.float64,device=Q.device)
+    Q_dot = torch.zeros((B,m+2,n+2,3),dtype=torch.float64,device=Q.device)
+    diagonals = antidiagonals(m,n,Q.device)
+    for i,j in diagonals:
+        v = torch.stack([V_dot[:,i,j-1],V_dot[:,i-1,j-1],V_dot[:,i-1,j]],-1)
+        p = Q[:,i,j]
+        pv = p*v
+        V_dot[:,i,j] = Z[:,i-1,j-1] + pv.sum(-1)
+        Q_dot[:,i,j] = -(pv - p*pv.sum(-1,keepdim=True))/gamma
+    E_dot = torch.zeros((B,m+2,n+2),dtype=torch.float64,device=Q.device)
+    for i,j in reversed(diagonals):
+        E_dot[:,i,j] = Q_dot[:,i,j+1,0]*E[:,i,j+1] + Q[:,i,j+1,0]*E_dot[:,i,j+1] + \
+                       Q_dot[:,i+1,j+1,1]*E[:,i+1,j+1] + Q[:,i+1,j+1,1]*E_dot[:,i+1,j+1] + \
+                       Q_dot[:,i+1,j,2]*E[:,i+1,j] + Q[:,i+1,j,2]*E_dot[:,i+1,j]
+    return E_dot[:,1:m+1,1:n+1]
+
+
+@jit(nopython = True, parallel = True)
+def dtw_grad_batch_cpu(theta, gamma):
+  # same of dtw_grad, parallel on the batch and without temporary arrays
+  B, m, n = theta.shape
+  G = np.zeros((B, m, n))
+  Q = np.zeros((B, m + 2, n + 2, 3))
+  E = np.zeros((B, m + 2, n + 2))
+  for k in prange(B):
+    V = np.zeros((m + 1, n + 1))
+    V[:, 0] = 1e10
+    V[0, :] = 1e10
+    V[0, 0] = 0
+    for i in range(1, m + 1):
+      for j in range(1, n + 1):
+        x0 = V[i, j - 1]
+        x1 = V[i - 1, j - 1]
+        x2 = V[i - 1, j]
+        min_x = min(min(x0, x1), x2)
+        e0 = np.exp((min_x - x0) / gamma)
+        e1 = np.exp((min_x - x1) / gamma)
+        e2 = np.exp((min_x - x2) / gamma)
+        Z = e0 + e1 + e2
+        Q[k, i, j, 0] = e0 / Z
+        Q[k, i, j, 1] = e1 / Z
+        Q[k, i, j, 2] = e2 / Z
+        V[i, j] = theta[k, i - 1, j - 1] + min_x - gamma * np.log(Z)
+    E[k, m + 1, n + 1] = 1
+    Q[k, m + 1, n + 1] = 1
+    for i in range(m, 0, -1):
+      for j in range(n, 0, -1):
+        E[k, i, j] = Q[k, i, j + 1, 0] * E[k, i, j + 1] + \
+                     Q[k, i + 1, j + 1, 1] * E[k, i + 1, j + 1] + \
+                     Q[k, i + 1, j, 2] * E[k, i + 1, j]
+    G[k] = E[k, 1:m + 1, 1:n + 1]
+  return G, Q, E
+
+@jit(nopython = True, parallel = True)
+def dtw_hessian_prod_batch_cpu(Z, Q, E, gamma):
+  # same of dtw_hessian_prod, parallel on the batch and without temporary arrays
+  B = Q.shape[0]
+  m = Z.shape[0]
+  n = Z.shape[1]
+  H = np.zeros((B, m, n))
+  for k in prange(B):
+    V_dot = np.zeros((m + 1, n + 1))
+    Q_dot = np.zeros((m + 2, n + 2, 3))
+    for i in range(1, m + 1):
+      for j in range(1, n + 1):
+        v0 = V_dot[i, j - 1]
+        v1 = V_dot[i - 1, j - 1]
+        v2 = V_dot[i - 1, j]
+        p0 = Q[k, i, j, 0]
+        p1 = Q[k, i, j, 1]
+        p2 = Q[k, i, j, 2]
+        pv = p0 * v0 + p1 * v1 + p2 * v2
+        V_dot[i, j] = Z[i - 1, j - 1] + pv
+        Q_dot[i, j, 0] = - (p0 * v0 - p0 * pv) / gamma
+        Q_dot[i, j, 1] = - (p1 * v1 - p1 * pv) / gamma
+        Q_dot[i, j, 2] = - (p2 * v2 - p2 * pv) / gamma
+    E_dot = np.zeros((m + 2, n + 2))
+    for j in range(n, 0, -1):
+      for i in range(m, 0, -1):
+        E_dot[i, j] = Q_dot[i, j + 1, 0] * E[k, i, j + 1] + \
+                      Q[k, i, j + 1, 0] * E_dot[i, j + 1] + \
+                      Q_dot[i + 1, j + 1, 1] * E[k, i + 1, j + 1] + \
+                      Q[k, i + 1, j + 1, 1] * E_dot[i + 1, j + 1] + \
+                      Q_dot[i + 1, j, 2] * E[k, i + 1, j] + \
+                      Q[k, i + 1, j, 2] * E_dot[i + 1, j]
+    H[k] = E_dot[1:m + 1, 1:n + 1]
+  return H
+
+
 class PathDTWBatch(Function):
     @staticmethod
     def forward(ctx, D, gamma): # D.shape: [batch_size, N , N]
-        batch_size,N,N = D.shape
-        device = D.device
-        D_cpu = D.detach().cpu().numpy()
-        gamma_gpu = torch.FloatTensor([gamma]).to(device)
-        
-        grad_gpu = torch.zeros((batch_size, N ,N)).to(device)
-        Q_gpu = torch.zeros((batch_size, N+2 ,N+2,3)).to(device)
-        E_gpu = torch.zeros((batch_size, N+2 ,N+2)).to(device)  
-        
-        for k in range(0,batch_size): # loop over all D in the batch    
-            _, grad_cpu_k, Q_cpu_k, E_cpu_k = dtw_grad(D_cpu[k,:,:], gamma)     
-            grad_gpu[k,:,:] = torch.FloatTensor(grad_cpu_k).to(device)
-            Q_gpu[k,:,:,:] = torch.FloatTensor(Q_cpu_k).to(device)
-            E_gpu[k,:,:] = torch.FloatTensor(E_cpu_k).to(device)
-        ctx.save_for_backward(grad_gpu,D, Q_gpu ,E_gpu, gamma_gpu) 
-        return torch.mean(grad_gpu, dim=0) 
+        ##all the batch is processed together: wavefront on the GPU, parallel numba kernels on the CPU
+        if D.is_cuda:
+            _, grad, Q, E = dtw_grad_batch(D.detach(),gamma)
+        else:
+            grad, Q, E = [torch.from_numpy(x) for x in dtw_grad_batch_cpu(D.detach().double().numpy(),gamma)]
+        ctx.save_for_backward(Q, E)
+        ctx.gamma = gamma
+        ctx.dtype = D.dtype
+        return torch.mean(grad, dim=0).to(D.dtype)
     
     @staticmethod
     def backward(ctx, grad_output):
-        device = grad_output.device
-        grad_gpu, D_gpu, Q_gpu, E_gpu, gamma = ctx.saved_tensors
-        D_cpu = D_gpu.detach().cpu().numpy()
-        Q_cpu = Q_gpu.detach().cpu().numpy()
-        E_cpu = E_gpu.detach().cpu().numpy()
-        gamma = gamma.detach().cpu().numpy()[0]
-        Z = grad_output.detach().cpu().numpy()
-        
-        batch_size,N,N = D_cpu.shape
-        Hessian = torch.zeros((batch_size, N ,N)).to(device)
-        for k in range(0,batch_size):
-            _, hess_k = dtw_hessian_prod(D_cpu[k,:,:], Z, Q_cpu[k,:,:,:], E_cpu[k,:,:], gamma)
-            Hessian[k:k+1,:,:] = torch.FloatTensor(hess_k).to(device)
-
-        return  Hessian, None
-    
+        Q, E = ctx.saved_tensors
+        if Q.is_cuda:
+            hessian = dtw_hessian_prod_batch(grad_output.detach(),Q,E,ctx.gamma)
+        else:
+            hessian = torch.from_numpy(dtw_hessian_prod_batch_cpu(grad_output.detach().double().numpy(),Q.numpy(),E.numpy(),ctx.gamma))
+        return hessian.to(ctx.dtype), None
@@ -39,7 +39,7 @@ class CausalSelfAttention(nn.Module):
         self.n_head = n_head
         self.n_embd = n_embd
 
-    def forward(self, x):
+    def forward(self, x, cache=None):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -48,12 +48,20 @@ class CausalSelfAttention(nn.Module):
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
+        # key/value cache for the generation: the new tokens attend also to the previous ones, S is the total length
+        if cache is not None:
+            if 'k' in cache:
+                k = torch.cat((cache['k'], k), dim=2)
+                v = torch.cat((cache['v'], v), dim=2)
+            cache['k'], cache['v'] = k, v
+        S = k.size(2)
+
+        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, S) -> (B, nh, T, S)
         att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-        att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
+        att = att.masked_fill(self.bias[:,:,S-T:S,:S] == 0, float('-inf'))
         att = F.softmax(att, dim=-1)
         att = self.attn_dropout(att)
-        y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        y = att @ v # (B, nh, T, S) x (B, nh, S, hs) -> (B, nh, T, hs)
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
 
         # output projection
@@ -77,7 +85,49 @@ class Block(nn.Module):
         m = self.mlp
         self.mlpf = lambda x: m.dropout(m.c_proj(m.act(m.c_fc(x)))) # MLP forward
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, cache=None):
+        x = x + self.attn(self.ln_1(x), cache)
         x = x + self.mlpf(self.ln_2(x))
         return x
+
+
+def generate(gpt, idx, max_new_tokens, block_size, num_layers, temperature=1.0, do_sample=False, top_k=None, num_samples=1):
+    """
+    Complete the sequences of indices idx (LongTensor of shape (b,t)) max_new_tokens times using a key/value cache in each block:
+    the prefix is processed once and each new token is a single incremental step. With do_sample all the samples are generated
+    together (num_samples*b sequences), the output is (num_samples,b,t+max_new_tokens) otherwise (b,t+max_new_tokens) with the greedy choice.
+    gpt is a function (tokens, caches, start) -> logits where caches is a list of dictionaries (one for each block) and start is the position of the first token.
+    If the sequence is longer than block_size the context is cropped and the cache is computed again.
+    """
+    b = idx.size(0)
+    if do_sample:
+        idx = idx.repeat(num_samples, 1)
+    caches, length = None, 0
+    for _ in range(max_new_tokens):
+        if caches is None or length >= block_size:
+            # (re)fill the cache with the context cropped at block_size
+            caches = [dict() for _ in range(num_layers)]
+            idx_cond = idx[:, -block_size:]
+            logits = gpt(idx_cond, caches, 0)
+            length = idx_cond.size(1)
+        else:
+            logits = gpt(idx[:, -1:], caches, length)
+            length += 1
+        # pluck the logits at the final step and scale by desired temperature
+        logits = logits[:, -1, :] / temperature
+        # optionally crop the logits to only the top k options
+        if top_k is not None:
+            v, _ = torch.topk(logits, top_k)
+            logits[logits < v[:, [-1]]] = -float('Inf')
+        # apply softmax to convert logits to (normalized) probabilities
+        probs = F.softmax(logits, dim=-1)
+        # either sample from the distribution or take the most likely element
+        if do_sample:
+            idx_next = torch.multinomial(probs, num_samples=1, replacement=True)
+        else:
+            _, idx_next = torch.topk(probs, k=1, dim=-1)
+        # append sampled index to the running sequence and continue
+        idx = torch.cat((idx, idx_next), dim=1)
+    if do_sample:
+        return idx.view(num_samples, b, -1)
+    return idx
@@ -1,171 +1,109 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import numpy as np
 import logging
 
-'''
-class VectorQuantizer(nn.Module):
-    """
-    Inspired from Sonnet implementation of VQ-VAE https://arxiv.org/abs/1711.00937,
-    in https://github.com/deepmind/sonnet/blob/master/sonnet/python/modules/nets/vqvae.py and
-    pytorch implementation of it from zalandoresearch in https://github.com/zalandoresearch/pytorch-vq-vae/blob/master/vq-vae.ipynb.
-
-    Implements the algorithm presented in
-    'Neural Discrete Representation Learning' by van den Oord et al.
-    https://arxiv.org/abs/1711.00937
-
-    Input any tensor to be quantized. Last dimension will be used as space in
-    which to quantize. All other dimensions will be flattened and will be seen
-    as different examples to quantize.
-    The output tensor will have the same shape as the input.
-    For example a tensor with shape [16, 32, 32, 64] will be reshaped into
-    [16384, 64] and all 16384 vectors (each of 64 dimensions)  will be quantized
-    independently.
-    Args:
-        embedding_dim: integer representing the dimensionality of the tensors in the
-            quantized space. Inputs to the modules must be in this format as well.
-        num_embeddings: integer, the number of vectors in the quantized space.
-            commitment_cost: scalar which controls the weighting of the loss terms
-            (see equation 4 in the paper - this variable is Beta).
-    """
-    
-    def __init__(self, num_embeddings, embedding_dim, commitment_cost, device):
-        super(VectorQuantizer, self).__init__()
-
-        self._embedding_dim = embedding_dim
-        self._num_embeddings = num_embeddings
-        
-        self._embedding = nn.Embedding(self._num_embeddings, self._embedding_dim)
-        self._embedding.weight.data.uniform_(-1/self._num_embeddings, 1/self._num_embeddings)
+## maximum number of latent-codebook distances computed at once (about 64MB in float32)
+MAX_DISTANCES = 2**24
 
-        self._commitment_cost = commitment_cost
-        self._device = device
 
-    def forward(self, inputs, compute_distances_if_possible=True, record_codebook_stats=False):
-        """
-        Connects the module to some inputs.
-
-        Args:
-            inputs: Tensor, final dimension must be equal to embedding_dim. All other
-                leading dimensions will be flattened and treated as a large batch.
-
-        Returns:
-            loss: Tensor containing the loss to optimize.
-            quantize: Tensor containing the quantized version of the input.
-            perplexity: Tensor containing the perplexity of the encodings.
-            encodings: Tensor containing the discrete encodings, ie which element
-                of the quantized space each input element was mapped to.
-            distances
-        """
+def nearest_code(flat_input, codebook, max_distances=MAX_DISTANCES):
+    """
+    Index of the nearest codebook entry of each row of flat_input (N x D) using ||x||^2 + ||e||^2 - 2 x e^T.
+    The rows are processed in chunks so that at most max_distances distances are in memory, allowing large codebooks.
+    """
+    codebook = codebook.detach()
+    codebook_norm = torch.sum(codebook**2, dim=1)
+    rows = max(1, max_distances // codebook.shape[0])
+    indices = []
+    for chunk in flat_input.detach().split(rows):
+        distances = torch.addmm(codebook_norm, chunk, codebook.t(), alpha=-2) + torch.sum(chunk**2, dim=1, keepdim=True)
+        indices.append(torch.argmin(distances, dim=1))
+    return torch.cat(indices)
 
-        # Convert inputs from BCHW -> BHWC
-        inputs = inputs.permute(1, 2, 0).contiguous()
-        input_shape = inputs.shape
-        _, time, batch_size = input_shape
 
-        # Flatten input
+def pairwise_distances(x, y=None, max_distances=MAX_DISTANCES):
+    """
+    Euclidean distances between the rows of x and the rows of y computed with cdist in chunks of rows of x.
+    If y is None the distances between all the pairs of rows of x are returned in the order of itertools.combinations:
+    each chunk of rows is compared only with the following rows and its upper triangle is written in the preallocated output,
+    so that the full N x N matrix is never built.
+    """
+    if y is not None:
+        rows = max(1, max_distances // y.shape[0])
+        return torch.cat([torch.cdist(chunk, y) for chunk in x.split(rows)])
+    n = x.shape[0]
+    rows = max(1, max_distances // n)
+    distances = x.new_empty(n*(n-1)//2)
+    offset = 0
+    for start in range(0, n, rows):
+        chunk = x[start:start+rows]
+        ## row start+i keeps the columns > start+i, i.e. the columns >= i of the following rows
+        chunk_distances = torch.cdist(chunk, x[start+1:])
+        mask = torch.arange(chunk_distances.shape[1], device=x.device) >= torch.arange(chunk.shape[0], device=x.device).unsqueeze(1)
+        chunk_distances = chunk_distances[mask]
+        distances[offset:offset+chunk_distances.shape[0]] = chunk_distances
+        offset += chunk_distances.shape[0]
+    return distances
+
+
+class Quantizer(nn.Module):
+    """
+    Common part of the vector quantizers: nearest codebook assignment, perplexity and codebook statistics.
+    The encodings are returned as indices (B x L) and not as one-hot vectors (B x L x num_embeddings) so that large codebooks (4k+ entries) fit in memory.
+    """
+    
+    def _quantize(self, inputs):
+        # convert inputs from BCHW -> BHWC
+        inputs = inputs.permute(0, 2, 1).contiguous()
         flat_input = inputs.view(-1, self._embedding_dim)
+        encoding_indices = nearest_code(flat_input, self._embedding.weight, self.max_distances)
+        quantized = F.embedding(encoding_indices, self._embedding.weight).view(inputs.shape)
+        return inputs, flat_input, encoding_indices, quantized
 
-        # Compute distances between encoded audio frames and embedding vectors
-        distances = (torch.sum(flat_input**2, dim=1, keepdim=True)
-            + torch.sum(self._embedding.weight**2, dim=1)
-            - 2 * torch.matmul(flat_input, self._embedding.weight.t()))
-
+    def _perplexity(self, encoding_indices):
         """
-        encoding_indices: Tensor containing the discrete encoding indices, ie
-        which element of the quantized space each input element was mapped to.
+        The perplexity a useful value to track during training.
+        It indicates how many codes are 'active' on average.
         """
-        encoding_indices = torch.argmin(distances, dim=1).unsqueeze(1)
-        encodings = torch.zeros(encoding_indices.shape[0], self._num_embeddings, dtype=torch.float).to(self._device)
-        encodings.scatter_(1, encoding_indices, 1)
-
-        # Compute distances between encoding vectors
-        if not self.training and compute_distances_if_possible:
-            _encoding_distances = [torch.dist(items[0], items[1], 2).to(self._device) for items in combinations(flat_input, r=2)]
-            encoding_distances = torch.tensor(_encoding_distances).to(self._device).view(batch_size, -1)
-        else:
-            encoding_distances = None
-
-        # Compute distances between embedding vectors
-        if not self.training and compute_distances_if_possible:
-            _embedding_distances = [torch.dist(items[0], items[1], 2).to(self._device) for items in combinations(self._embedding.weight, r=2)]
-            embedding_distances = torch.tensor(_embedding_distances).to(self._device)
-        else:
-            embedding_distances = None
-
-        # Sample nearest embedding
-        if not self.training and compute_distances_if_possible:
-            _frames_vs_embedding_distances = [torch.dist(items[0], items[1], 2).to(self._device) for items in product(flat_input, self._embedding.weight.detach())]
-            frames_vs_embedding_distances = torch.tensor(_frames_vs_embedding_distances).to(self._device).view(batch_size, time, -1)
-        else:
-            frames_vs_embedding_distances = None
-
-        # Quantize and unflatten
-        quantized = torch.matmul(encodings, self._embedding.weight).view(input_shape)
-        # TODO: Check if the more readable self._embedding.weight.index_select(dim=1, index=encoding_indices) works better
-
-        concatenated_quantized = self._embedding.weight[torch.argmin(distances, dim=1).detach().cpu()] if not self.training or record_codebook_stats else None
-
-        # Losses
-        e_latent_loss = torch.mean((quantized.detach() - inputs)**2)
-        q_latent_loss = torch.mean((quantized - inputs.detach())**2)
-        commitment_loss = self._commitment_cost * e_latent_loss
-        vq_loss = q_latent_loss + commitment_loss
-
-        quantized = inputs + (quantized - inputs).detach() # Trick to prevent backpropagation of quantized
-        avg_probs = torch.mean(encodings, dim=0)
+        avg_probs = torch.bincount(encoding_indices, minlength=self._num_embeddings).float() / encoding_indices.shape[0]
+        return torch.exp(-torch.sum(avg_probs * torch.log(avg_probs + 1e-10)))
 
+    def codebook_statistics(self, inputs):
         """
-        The perplexity a useful value to track during training.
-        It indicates how many codes are 'active' on average.
+        Distances between the latent vectors of each sample (pairs of positions), between the codebook entries (pairs of entries)
+        and between the latent vectors and the codebook entries (B x L x num_embeddings).
+        If record_codebook_stats is True they are computed at each forward and stored in codebook_stats.
         """
-        perplexity = torch.exp(-torch.sum(avg_probs * torch.log(avg_probs + 1e-10))) # Exponential entropy
-
-        # Convert quantized from BHWC -> BCHW
-        return vq_loss, quantized.permute(2, 0, 1).contiguous(), \
-            perplexity, encodings.view(batch_size, time, -1), \
-            distances.view(batch_size, time, -1), encoding_indices, \
-            {'e_latent_loss': e_latent_loss.item(), 'q_latent_loss': q_latent_loss.item(),
-            'commitment_loss': commitment_loss.item(), 'vq_loss': vq_loss.item()}, \
-            encoding_distances, embedding_distances, frames_vs_embedding_distances, concatenated_quantized
-
-    @property
-    def embedding(self):
-        return self._embedding
-'''
-
-class VectorQuantizer(nn.Module):
-    def __init__(self, num_embeddings, embedding_dim, commitment_cost):
+        with torch.no_grad():
+            inputs = inputs.permute(0, 2, 1)
+            codebook = self._embedding.weight
+            encoding_distances = torch.stack([pairwise_distances(sample, max_distances=self.max_distances) for sample in inputs])
+            embedding_distances = pairwise_distances(codebook, max_distances=self.max_distances)
+            frames_vs_embedding_distances = pairwise_distances(inputs.reshape(-1, self._embedding_dim), codebook, self.max_distances).view(inputs.shape[0], inputs.shape[1], -1)
+        return {'encoding_distances': encoding_distances,
+                'embedding_distances': embedding_distances,
+                'frames_vs_embedding_distances': frames_vs_embedding_distances}
+
+
+class VectorQuantizer(Quantizer):
+    def __init__(self, num_embeddings, embedding_dim, commitment_cost, max_distances=MAX_DISTANCES, record_codebook_stats=False):
         super(VectorQuantizer, self).__init__()
         
         self._embedding_dim = embedding_dim
         self._num_embeddings = num_embeddings
+        self.max_distances = max_distances
+        self.record_codebook_stats = record_codebook_stats
+        self.codebook_stats = None
         
         self._embedding = nn.Embedding(self._num_embeddings, self._embedding_dim)
         self._embedding.weight.data.uniform_(-1/self._num_embeddings, 1/self._num_embeddings)
         self._commitment_cost = commitment_cost
 
     def forward(self, inputs):
-        # convert inputs from BCHW -> BHWC
-        inputs = inputs.permute(0, 2, 1).contiguous()
-        input_shape = inputs.shape
-        
-        # Flatten input
-        flat_input = inputs.view(-1, self._embedding_dim)
-        
-        # Calculate distances
-        distances = (torch.sum(flat_input**2, dim=1, keepdim=True) 
-                    + torch.sum(self._embedding.weight**2, dim=1)
-                    - 2 * torch.matmul(flat_input, self._embedding.weight.t()))
-            
-        # Encoding
-        encoding_indices = torch.argmin(distances, dim=1).unsqueeze(1)
-        encodings = torch.zeros(encoding_indices.shape[0], self._num_embeddings, device=inputs.device)
-        encodings.scatter_(1, encoding_indices, 1)
-        
-        # Quantize and unflatten
-        quantized = torch.matmul(encodings, self._embedding.weight).view(input_shape)
+        if self.record_codebook_stats:
+            self.codebook_stats = self.codebook_statistics(inputs)
+        inputs, _, encoding_indices, quantized = self._quantize(inputs)
         
         # Loss
         e_latent_loss = F.mse_loss(quantized.detach(), inputs)
@@ -173,20 +111,22 @@ class VectorQuantizer(nn.Module):
         loss = q_latent_loss + self._commitment_cost * e_latent_loss
         
         quantized = inputs + (quantized - inputs).detach()
-        avg_probs = torch.mean(encodings, dim=0)
-        perplexity = torch.exp(-torch.sum(avg_probs * torch.log(avg_probs + 1e-10)))
+        perplexity = self._perplexity(encoding_indices)
         
         # convert quantized from BHWC -> BCHW
-        #return loss, quantized.permute(0, 3, 1, 2).contiguous(), perplexity, encodings
-        return loss, quantized.permute(0, 2, 1).contiguous(), perplexity, encodings.view(input_shape[0],-1,encodings.shape[1])
+        return loss, quantized.permute(0, 2, 1).contiguous(), perplexity, encoding_indices.view(inputs.shape[0],-1)
+
 
-class VectorQuantizerEMA(nn.Module):
+class VectorQuantizerEMA(Quantizer):
     
-    def __init__(self, num_embeddings, embedding_dim, commitment_cost, decay, epsilon=1e-5):
+    def __init__(self, num_embeddings, embedding_dim, commitment_cost, decay, epsilon=1e-5, max_distances=MAX_DISTANCES, record_codebook_stats=False):
         super(VectorQuantizerEMA, self).__init__()
         
         self._embedding_dim = embedding_dim
         self._num_embeddings = num_embeddings
+        self.max_distances = max_distances
+        self.record_codebook_stats = record_codebook_stats
+        self.codebook_stats = None
         
         self._embedding = nn.Embedding(self._num_embeddings, self._embedding_dim)
         self._embedding.weight.data.normal_()
@@ -200,30 +140,15 @@ class VectorQuantizerEMA(nn.Module):
         self._epsilon = epsilon
 
     def forward(self, inputs):
-        # convert inputs from BCHW -> BHWC
-        inputs = inputs.permute(0, 2, 1).contiguous()
-        input_shape = inputs.shape
-        
-        # Flatten input
-        flat_input = inputs.view(-1, self._embedding_dim)
-        
-        # Calculate distances
-        distances = (torch.sum(flat_input**2, dim=1, keepdim=True) 
-                    + torch.sum(self._embedding.weight**2, dim=1)
-                    - 2 * torch.matmul(flat_input, self._embedding.weight.t()))
-            
-        # Encoding
-        encoding_indices = torch.argmin(distances, dim=1).unsqueeze(1)
-        encodings = torch.zeros(encoding_indices.shape[0], self._num_embeddings, device=inputs.device)
-        encodings.scatter_(1, encoding_indices, 1)
-        
-        # Quantize and unflatten
-        quantized = torch.matmul(encodings, self._embedding.weight).view(input_shape)
+        if self.record_codebook_stats:
+            self.codebook_stats = self.codebook_statistics(inputs)
+        inputs, flat_input, encoding_indices, quantized = self._quantize(inputs)
         
         # Use EMA to update the embedding vectors
         if self.training:
+            counts = torch.bincount(encoding_indices, minlength=self._num_embeddings).to(flat_input.dtype)
             self._ema_cluster_size = self._ema_cluster_size * self._decay + \
-                                     (1 - self._decay) * torch.sum(encodings, 0)
+                                     (1 - self._decay) * counts
             
             # Laplace smoothing of the cluster size
             n = torch.sum(self._ema_cluster_size.data)
@@ -231,7 +156,7 @@ class VectorQuantizerEMA(nn.Module):
                 (self._ema_cluster_size + self._epsilon)
                 / (n + self._num_embeddings * self._epsilon) * n)
             
-            dw = torch.matmul(encodings.t(), flat_input)
+            dw = torch.zeros_like(self._ema_w).index_add_(0, encoding_indices, flat_input.detach())
             self._ema_w = nn.Parameter(self._ema_w * self._decay + (1 - self._decay) * dw)
             
             self._embedding.weight = nn.Parameter(self._ema_w / self._ema_cluster_size.unsqueeze(1))
@@ -242,11 +167,10 @@ class VectorQuantizerEMA(nn.Module):
         
         # Straight Through Estimator
         quantized = inputs + (quantized - inputs).detach()
-        avg_probs = torch.mean(encodings, dim=0)
-        perplexity = torch.exp(-torch.sum(avg_probs * torch.log(avg_probs + 1e-10)))
+        perplexity = self._perplexity(encoding_indices)
         
         # convert quantized from BHWC -> BCHW
-        return loss, quantized.permute(0, 2, 1).contiguous(), perplexity, encodings.view(input_shape[0],-1,encodings.shape[1])
+        return loss, quantized.permute(0, 2, 1).contiguous(), perplexity, encoding_indices.view(inputs.shape[0],-1)
     
     
 class Residual(nn.Module):
@@ -361,36 +285,32 @@ class Jitter(nn.Module):
         self._probability = probability
 
     def forward(self, quantized):
-        original_quantized = quantized.detach().clone()
-        length = original_quantized.size(2)
-        for i in range(length):
-            """
-            Each latent vector is replace with either of its neighbors with a certain probability
-            (0.12 from the paper).
-            """
-            replace = [True, False][np.random.choice([1, 0], p=[self._probability, 1 - self._probability])]
-            if replace:
-                if i == 0:
-                    neighbor_index = i + 1
-                elif i == length - 1:
-                    neighbor_index = i - 1
-                else:
-                    """
-                    "We independently sample whether it is to
-                    be replaced with the token right after
-                    or before it."
-                    """
-                    neighbor_index = i + np.random.choice([-1, 1], p=[0.5, 0.5])
-                quantized[:, :, i] = original_quantized[:, :, neighbor_index]
-
-        return quantized
+        """
+        Each latent vector (all the channels of a position) is replaced with either of its neighbors with a certain probability
+        (0.12 from the paper), independently for each sample and position. The replaced values come from the input (not from other replacements)
+        and, as the assignment of the loop implementation, they do not propagate the gradient.
+        """
+        B, _, length = quantized.shape
+        if length < 2:
+            return quantized
+        replace = torch.rand(B, 1, length, device=quantized.device) < self._probability
+        """
+        "We independently sample whether it is to
+        be replaced with the token right after
+        or before it."
+        """
+        neighbor = torch.where(torch.rand(B, 1, length, device=quantized.device) < 0.5, -1, 1)
+        neighbor[:, :, 0] = 1
+        neighbor[:, :, -1] = -1
+        index = torch.arange(length, device=quantized.device) + neighbor * replace
+        return torch.where(replace, quantized.detach().gather(2, index.expand_as(quantized)), quantized)
     
 class Decoder(nn.Module):
-    def __init__(self, in_channels, hidden_channels,out_channels,num_residual_layers=3):
+    def __init__(self, in_channels, hidden_channels,out_channels,num_residual_layers=3,jitter=0.0):
         super(Decoder, self).__init__()
         
-        
-        self._jitter = Jitter(0.125)
+        ##jitter probability, 0 for no jitter (the paper uses 0.12)
+        self._jitter = Jitter(jitter) if jitter > 0 else None
         
         self._conv_1 = nn.Conv1d(in_channels=in_channels,
                                  out_channels=hidden_channels,
@@ -420,8 +340,8 @@ class Decoder(nn.Module):
                                                 kernel_size=4,  padding=1)
 
     def forward(self, x,is_training=True):
-        #if is_training:
-        #     x = self._jitter(x)
+        if is_training and self.training and self._jitter is not None:
+            x = self._jitter(x)
         x = self._conv_1(x)
         x = self._upsample(x)
         x = self._residual_stack(x)
@@ -431,7 +351,7 @@ class Decoder(nn.Module):
         return x
     
 class VQVAE(nn.Module):
-    def __init__(self,in_channels, hidden_channels, out_channels,num_embeddings, embedding_dim, commitment_cost, decay):
+    def __init__(self,in_channels, hidden_channels, out_channels,num_embeddings, embedding_dim, commitment_cost, decay, jitter=0.0, record_codebook_stats=False):
         super(VQVAE, self).__init__()
         
         self._encoder = Encoder(in_channels, hidden_channels)
@@ -441,12 +361,12 @@ class VQVAE(nn.Module):
                                       stride=1)
         if decay > 0.0:
             self._vq_vae = VectorQuantizerEMA(num_embeddings, embedding_dim, 
-                                              commitment_cost, decay)
+                                              commitment_cost, decay, record_codebook_stats=record_codebook_stats)
         else:
             logging.info('CARE NOT TESTED')
             self._vq_vae = VectorQuantizer(num_embeddings, embedding_dim,
-                                           commitment_cost)
-        self._decoder = Decoder(in_channels=embedding_dim,hidden_channels=hidden_channels,out_channels=out_channels)
+                                           commitment_cost, record_codebook_stats=record_codebook_stats)
+        self._decoder = Decoder(in_channels=embedding_dim,hidden_channels=hidden_channels,out_channels=out_channels,jitter=jitter)
 
 
     def forward(self, x,is_training=True):
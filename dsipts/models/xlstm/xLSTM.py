@@ -1,37 +1,105 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-
+import math
+import warnings
+from typing import List
+
+
+def _slstm_recurrence(gates_x:torch.Tensor, h:torch.Tensor, c:torch.Tensor, weight:torch.Tensor, bias_f:torch.Tensor, hidden_size:int):
+    """Recurrence of a sLSTM layer. The input projection of all the steps (`gates_x`, B x L x 4H) is computed before the loop,
+    `weight` stacks the recurrent weights of the cell and the forget gate of the cell state so that each step needs a single matmul
+
+    :meta private:
+    """
+    L = gates_x.shape[1]
+    ##a list and not a preallocated tensor: the backward of L slice assignments would copy the whole gradient L times
+    out: List[torch.Tensor] = []
+    ##unbind and not gates_x[:, t]: the backward of each slice would create a zero tensor with the size of the whole sequence
+    inputs = gates_x.unbind(1)
+    weight_t = weight.t()
+    rec = torch.mm(h, weight_t[:, :4 * hidden_size])
+    for t in range(L):
+        gates = inputs[t] + rec
+        i, f, g, o = gates.chunk(4, 1)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        h = torch.sigmoid(o) * torch.tanh(c)
+        z = torch.mm(h, weight_t)
+        rec = z[:, :4 * hidden_size]
+        c = torch.exp(z[:, 4 * hidden_size:] + bias_f) * c
+        out.append(h)
+    return torch.stack(out, 1), h, c
+
+
+_SCRIPTED = {}
+
+
+def _scripted(fn):
+    """TorchScript version of a function (compiled once), the python one if it can not be scripted
+
+    :meta private:
+    """
+    if fn not in _SCRIPTED:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                _SCRIPTED[fn] = torch.jit.script(fn)
+        except Exception:
+            _SCRIPTED[fn] = fn
+    return _SCRIPTED[fn]
+
+
+def _mlstm_chunk(q, k, v, i_pre, log_f, C, n, m):
+    """Chunkwise parallel mLSTM: output of L steps and state at the end of the chunk. The input gate is exponential, the forget gate is given in log scale,
+    both act on the rows of the memory (B x H x H); all the quantities are stabilized by `m` (log scale of the state, B x H) as in the xLSTM paper
+
+    :meta private:
+    """
+    L = q.shape[1]
+    b = torch.cumsum(log_f, 1)
+    ##the log weight of the step s in the output of the step t (s<=t) is b_t-b_s+i_s, the one of the initial state b_t+m:
+    ##the stabilizer is m_t = b_t+g_t with g_t = max(m, max_{s<=t} i_s-b_s)
+    a = i_pre - b
+    g = torch.maximum(torch.cummax(a, 1)[0], m.unsqueeze(1))
+    mask = torch.full((L, L), float('-inf'), device=q.device, dtype=q.dtype).triu(1).unsqueeze(2)
+    d = torch.exp(a.unsqueeze(1) - g.unsqueeze(2) + mask)
+    qk = torch.bmm(q, k.transpose(1, 2)).unsqueeze(2)
+    inter = torch.exp(m.unsqueeze(1) - g)
+    num = torch.matmul(qk, d * v.unsqueeze(1)).squeeze(2) + inter * torch.bmm(q, C.transpose(1, 2))
+    den = torch.matmul(qk, d).squeeze(2) + inter * torch.bmm(q, n.transpose(1, 2))
+    h = num / torch.maximum(den.abs(), torch.exp(-b - g))
+
+    m_new = b[:, -1] + g[:, -1]
+    w = torch.exp(a - g[:, -1:])
+    decay = torch.exp(m - g[:, -1]).unsqueeze(2)
+    C = decay * C + torch.bmm((w * v).transpose(1, 2), k)
+    n = decay * n + torch.bmm(w.transpose(1, 2), k)
+    return h, C, n, m_new
 
 
 class mLSTM(nn.Module):
-    def __init__(self, input_size, hidden_size, num_layers, dropout=0.0):
+    def __init__(self, input_size, hidden_size, num_layers, dropout=0.0, chunk_size=16):
         super(mLSTM, self).__init__()
         self.input_size = input_size
         self.hidden_size = hidden_size
         self.num_layers = num_layers
         self.dropout = dropout
+        ##steps computed in parallel, 1 is the recurrent form
+        self.chunk_size = chunk_size
 
-        self.lstms = nn.ModuleList([nn.LSTMCell(input_size, hidden_size) for _ in range(num_layers)])
         self.dropout_layers = nn.ModuleList([nn.Dropout(dropout) for _ in range(num_layers - 1)])
 
         self.W_q = nn.Linear(input_size, hidden_size)
         self.W_k = nn.Linear(input_size, hidden_size)
         self.W_v = nn.Linear(input_size, hidden_size)
 
-        self.exp_input_gates = nn.ModuleList([nn.Linear(input_size, hidden_size) for _ in range(num_layers)])
-        self.exp_forget_gates = nn.ModuleList([nn.Linear(input_size, hidden_size) for _ in range(num_layers)])
-        self.output_gates = nn.ModuleList([nn.Linear(hidden_size, hidden_size) for _ in range(num_layers)])
+        self.exp_input_gates = nn.ModuleList([nn.Linear(input_size if i == 0 else hidden_size, hidden_size) for i in range(num_layers)])
+        self.exp_forget_gates = nn.ModuleList([nn.Linear(input_size if i == 0 else hidden_size, hidden_size) for i in range(num_layers)])
+        self.output_gates = nn.ModuleList([nn.Linear(input_size if i == 0 else hidden_size, hidden_size) for i in range(num_layers)])
         
         self.reset_parameters()
 
     def reset_parameters(self):
-        for lstm in self.lstms:
-            nn.init.xavier_uniform_(lstm.weight_ih)
-            nn.init.xavier_uniform_(lstm.weight_hh)
-            nn.init.zeros_(lstm.bias_ih) 
-            nn.init.zeros_(lstm.bias_hh)
-        
         nn.init.xavier_uniform_(self.W_q.weight)
         nn.init.xavier_uniform_(self.W_k.weight)
         nn.init.xavier_uniform_(self.W_v.weight)
@@ -45,52 +113,49 @@ class mLSTM(nn.Module):
 
     def forward(self, input_seq, hidden_state=None):
         batch_size = input_seq.size(0)
-        seq_length = input_seq.size(1)
 
         if hidden_state is None:
             hidden_state = self.init_hidden(batch_size)
 
-        output_seq = []
-        for t in range(seq_length):
-            x = input_seq[:, t, :]
-            queries = self.W_q(x)
-            keys = self.W_k(x)
-            values = self.W_v(x)
-
-            new_hidden_state = []
-            for i, (lstm, dropout, i_gate, f_gate, o_gate) in enumerate(zip(self.lstms, self.dropout_layers, self.exp_input_gates, self.exp_forget_gates, self.output_gates)):
-                if hidden_state[i][0] is None:
-                    h, C = lstm(x)
-                else:
-                    h, C = hidden_state[i]
-                
-                ii = torch.exp(i_gate(x))
-                f = torch.exp(f_gate(x))
-
-                C_t = f * C + ii * torch.matmul(values.unsqueeze(2), keys.unsqueeze(1)).squeeze(1)
-                attn_output = torch.matmul(queries, C_t).squeeze(2)
-                
-                o = torch.sigmoid(o_gate(h))
-                h = o * attn_output
-                new_hidden_state.append((h, C_t))
-                
-                if i < self.num_layers - 1:
-                    x = dropout(h)
-                else:
-                    x = h
-            hidden_state = new_hidden_state
-            output_seq.append(x)
-
-        output_seq = torch.stack(output_seq, dim=1)
-        return output_seq, hidden_state
+        ##queries, keys and values depend only on the input of the block
+        queries = self.W_q(input_seq)
+        keys = self.W_k(input_seq) / math.sqrt(self.hidden_size)
+        values = self.W_v(input_seq)
+
+        x = input_seq
+        new_hidden_state = []
+        for i in range(self.num_layers):
+            i_pre = self.exp_input_gates[i](x)
+            ##sigmoid forget gate (one of the choices of the paper): with the exponential one the state grows without bounds along the sequence
+            ##and the normalizer does not prevent the overflow of the gradients
+            log_f = F.logsigmoid(self.exp_forget_gates[i](x))
+            o = torch.sigmoid(self.output_gates[i](x))
+            C, n, m = hidden_state[i]
+            h = []
+            ##split and not slices: the backward of each slice would create a zero tensor with the size of the whole sequence
+            for chunk in zip(*[t.split(self.chunk_size, 1) for t in [queries, keys, values, i_pre, log_f]]):
+                h_chunk, C, n, m = _mlstm_chunk(*chunk, C, n, m)
+                h.append(h_chunk)
+            h = o * torch.cat(h, 1)
+            new_hidden_state.append((C, n, m))
+            if i < self.num_layers - 1:
+                x = self.dropout_layers[i](h)
+            else:
+                x = h
+
+        return x, new_hidden_state
 
     def init_hidden(self, batch_size):
         hidden_state = []
-        for lstm in self.lstms:
-            h = torch.zeros(batch_size, self.hidden_size, device=lstm.weight_ih.device)
-            C = torch.zeros(batch_size, self.hidden_size, self.hidden_size, device=lstm.weight_ih.device)
-            hidden_state.append((h, C))
+        weight = self.W_q.weight
+        for _ in range(self.num_layers):
+            C = weight.new_zeros(batch_size, self.hidden_size, self.hidden_size)
+            n = weight.new_zeros(batch_size, self.hidden_size, self.hidden_size)
+            m = weight.new_zeros(batch_size, self.hidden_size)
+            hidden_state.append((C, n, m))
         return hidden_state
+
+
 class sLSTM(nn.Module):
     def __init__(self, input_size, hidden_size, num_layers, dropout=0.0):
         super(sLSTM, self).__init__()
@@ -98,11 +163,14 @@ class sLSTM(nn.Module):
         self.hidden_size = hidden_size
         self.num_layers = num_layers
         self.dropout = dropout
+        ##run the recurrence with TorchScript
+        self.use_script = True
 
         self.lstms = nn.ModuleList([nn.LSTMCell(input_size if i == 0 else hidden_size, hidden_size) for i in range(num_layers)])
         self.dropout_layers = nn.ModuleList([nn.Dropout(dropout) for _ in range(num_layers - 1)])
 
         self.exp_forget_gates = nn.ModuleList([nn.Linear(hidden_size, hidden_size) for _ in range(num_layers)])
+        ##the input gate multiplies a zero tensor, it is kept for the compatibility with the trained weights
         self.exp_input_gates = nn.ModuleList([nn.Linear(hidden_size, hidden_size) for _ in range(num_layers)])
         
         self.reset_parameters()
@@ -120,41 +188,29 @@ class sLSTM(nn.Module):
 
     def forward(self, input_seq, hidden_state=None):
         batch_size = input_seq.size(0)
-        seq_length = input_seq.size(1)
 
         if hidden_state is None:
             hidden_state = self.init_hidden(batch_size)
 
-        output_seq = []
-        for t in range(seq_length):
-            x = input_seq[:, t, :]
-            new_hidden_state = []
-            for i, (lstm, dropout, f_gate, i_gate) in enumerate(zip(self.lstms, self.dropout_layers, self.exp_forget_gates, self.exp_input_gates)):
-                if hidden_state[i][0] is None:
-                    h, c = lstm(x)
-                else:
-                    h, c = lstm(x, (hidden_state[i][0], hidden_state[i][1]))
-
-                f = torch.exp(f_gate(h))
-                ii = torch.exp(i_gate(h))
-                c = f * c + ii * lstm.weight_hh.new_zeros(batch_size, self.hidden_size)
-                new_hidden_state.append((h, c))
-
-                if i < self.num_layers - 1:
-                    x = dropout(h)
-                else:
-                    x = h
-            hidden_state = new_hidden_state
-            output_seq.append(x)
-
-        output_seq = torch.stack(output_seq, dim=1)
-        return output_seq, hidden_state
+        recurrence = _scripted(_slstm_recurrence) if self.use_script else _slstm_recurrence
+        ##the layers are computed one after the other on the whole sequence so that the input projection is a single matmul.
+        ##As in the original implementation only the first num_layers-1 layers are used (zip with the dropout layers)
+        x = input_seq
+        new_hidden_state = []
+        for i, (lstm, dropout, f_gate) in enumerate(zip(self.lstms, self.dropout_layers, self.exp_forget_gates)):
+            gates_x = F.linear(x, lstm.weight_ih, lstm.bias_ih + lstm.bias_hh)
+            weight = torch.cat([lstm.weight_hh, f_gate.weight], 0)
+            out, h, c = recurrence(gates_x, hidden_state[i][0], hidden_state[i][1], weight, f_gate.bias, self.hidden_size)
+            new_hidden_state.append((h, c))
+            x = dropout(out)
+
+        return x, new_hidden_state
 
     def init_hidden(self, batch_size):
         hidden_state = []
         for lstm in self.lstms:
-            h = torch.zeros(batch_size, self.hidden_size, device=lstm.weight_ih.device)
-            c = torch.zeros(batch_size, self.hidden_size, device=lstm.weight_ih.device)
+            h = lstm.weight_ih.new_zeros(batch_size, self.hidden_size)
+            c = lstm.weight_ih.new_zeros(batch_size, self.hidden_size)
             hidden_state.append((h, c))
         return hidden_state
 